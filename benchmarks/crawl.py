@@ -0,0 +1,159 @@
+"""
+Time the crawls behind describe, get_db_info and `file_plan important` against a fake cluster
+
+    python -m benchmarks.crawl [--dbs 2000] [--nodes 3] [--latency 0.002] [--update-baselines]
+
+Run it from the root of the repository. Each scenario runs in its own process (so peak RSS is its own)
+against a FakeCluster served from that process, and reports total requests, requests per second,
+wall time, peak RSS and peak requests in flight.
+
+Results are compared with benchmarks/baselines.json, recorded for the same cluster size and latency.
+Any increase in the number of requests is a regression, and so is a wall time more than --tolerance
+slower than the baseline. Exits non-zero on regressions. Wall times depend on the machine,
+so re-record them with --update-baselines when moving to a different one.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_FILE = os.path.join(REPO_ROOT, 'benchmarks', 'baselines.json')
+
+SCENARIOS = ['describe', 'get_db_info', 'file_plan_important']
+
+
+def _crawl_describe(config):
+    # what describe does before printing
+    from couchdb_cluster_admin.cluster_state import get_cluster_state
+    from couchdb_cluster_admin.describe import get_all_shard_allocation_docs
+    get_cluster_state(config).get_membership()
+    get_all_shard_allocation_docs(config)
+
+
+def _crawl_get_db_info(config):
+    from couchdb_cluster_admin.suggest_shard_allocation import get_db_info
+    get_db_info(config)
+
+
+def _get_plan(config):
+    # read without the config's ClusterState, so that the crawl being timed doesn't find the shard maps cached
+    from couchdb_cluster_admin.utils import get_shard_allocations, iter_db_pages
+    return {
+        shard_allocation_doc.db_name: shard_allocation_doc
+        for page in iter_db_pages(config.get_control_node())
+        for shard_allocation_doc in get_shard_allocations(config, page)
+    }
+
+
+def _crawl_file_plan_important(config, plan):
+    from couchdb_cluster_admin.file_plan import get_node_files
+    get_node_files(config, plan)
+
+
+def run_scenario(scenario, n_dbs, n_nodes, latency):
+    """
+    Run one scenario in this process; gevent must already be monkey-patched
+    """
+    import resource
+    from couchdb_cluster_admin.fake_cluster import FakeCluster
+
+    with FakeCluster(n_nodes=n_nodes, n_dbs=n_dbs, latency=latency) as cluster:
+        config = cluster.get_config()
+        args = ()
+        if scenario == 'file_plan_important':
+            args = (_get_plan(config),)
+        cluster.reset_stats()
+        start = time.perf_counter()
+        globals()['_crawl_{}'.format(scenario)](config, *args)
+        wall_seconds = time.perf_counter() - start
+        return {
+            'requests': cluster.request_count,
+            'requests_per_second': cluster.request_count / wall_seconds,
+            'wall_seconds': wall_seconds,
+            # kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'peak_in_flight': cluster.peak_in_flight,
+        }
+
+
+def run_scenario_in_subprocess(scenario, args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [REPO_ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    output = subprocess.check_output([
+        sys.executable, '-m', 'benchmarks.crawl', '--run-one', scenario,
+        '--dbs', str(args.n_dbs), '--nodes', str(args.n_nodes), '--latency', str(args.latency),
+    ], env=env, cwd=REPO_ROOT, universal_newlines=True)
+    return json.loads(output)
+
+
+def get_baseline_key(args):
+    return 'dbs={},nodes={},latency={}'.format(args.n_dbs, args.n_nodes, args.latency)
+
+
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+    if result['requests'] > baseline['requests']:
+        regressions.append(u'requests {} > {}'.format(result['requests'], baseline['requests']))
+    if result['wall_seconds'] > baseline['wall_seconds'] * (1 + tolerance):
+        regressions.append(u'wall time {:.2f}s > {:.2f}s'.format(result['wall_seconds'], baseline['wall_seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Benchmark the crawls against a fake cluster')
+    parser.add_argument('--dbs', dest='n_dbs', default=2000, type=int)
+    parser.add_argument('--nodes', dest='n_nodes', default=3, type=int)
+    parser.add_argument('--latency', dest='latency', default=0.002, type=float,
+                        help=u'Average seconds the fake cluster takes to answer each request')
+    parser.add_argument('--scenarios', dest='scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--tolerance', dest='tolerance', default=0.5, type=float,
+                        help=u'How much slower than the baseline wall time counts as a regression. Default: 0.5')
+    parser.add_argument('--update-baselines', dest='update_baselines', action='store_true')
+    parser.add_argument('--run-one', dest='run_one', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        from gevent import monkey; monkey.patch_all()
+        print(json.dumps(run_scenario(args.run_one, args.n_dbs, args.n_nodes, args.latency)))
+        return
+
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE) as f:
+            baselines = json.load(f)
+    else:
+        baselines = {}
+    key = get_baseline_key(args)
+
+    row = u'{: <22}{: >10}{: >10}{: >10}{: >10}{: >10}  {}'
+    print(row.format(u'Scenario', u'Requests', u'Req/s', u'Wall s', u'RSS MB', u'In flight', u''))
+    any_regressions = False
+    for scenario in args.scenarios:
+        result = run_scenario_in_subprocess(scenario, args)
+        baseline = baselines.get(key, {}).get(scenario)
+        regressions = find_regressions(result, baseline, args.tolerance) if baseline else []
+        any_regressions = any_regressions or bool(regressions)
+        print(row.format(
+            scenario, result['requests'], u'{:.0f}'.format(result['requests_per_second']),
+            u'{:.2f}'.format(result['wall_seconds']), u'{:.0f}'.format(result['peak_rss_mb']),
+            result['peak_in_flight'],
+            u'REGRESSION: ' + u'; '.join(regressions) if regressions else (u'' if baseline else u'(no baseline)'),
+        ))
+        if args.update_baselines:
+            baselines.setdefault(key, {})[scenario] = {
+                'requests': result['requests'], 'wall_seconds': round(result['wall_seconds'], 3)}
+
+    if args.update_baselines:
+        with open(BASELINES_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    elif any_regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Time how long `couchdb-cluster-admin [<command>] --help` takes to start
+
+    python -m benchmarks.startup [--budget-ms 100] [--repeat 5]
+
+Run it from the root of the repository; the package doesn't need to be installed.
+
+Exits non-zero if any command is slower than the budget (best of --repeat runs).
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from couchdb_cluster_admin.cli import COMMANDS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_command(argv, repeat):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [REPO_ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-m', 'couchdb_cluster_admin.cli'] + argv,
+                              stdout=subprocess.DEVNULL, env=env)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Benchmark CLI startup time')
+    parser.add_argument('--budget-ms', dest='budget_ms', default=100, type=float)
+    parser.add_argument('--repeat', dest='repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    over_budget = []
+    for argv in [['--help']] + [[command.name, '--help'] for command in COMMANDS]:
+        elapsed_ms = time_command(argv, args.repeat) * 1000
+        print(u'{: <40}{: >8.1f} ms'.format(u' '.join(argv), elapsed_ms))
+        if elapsed_ms > args.budget_ms:
+            over_budget.append(argv)
+
+    if over_budget:
+        print(u'Over the {} ms budget: {}'.format(args.budget_ms, u', '.join(u' '.join(argv) for argv in over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
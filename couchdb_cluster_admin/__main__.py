@@ -0,0 +1,4 @@
+from __future__ import absolute_import
+from .cli import main
+
+main()
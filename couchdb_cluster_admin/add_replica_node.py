@@ -1,29 +1,34 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import copy
 import sys
 
+from .journal import add_journal_arguments, open_journal, undo_journal
 from .utils import (
     add_node_to_cluster,
     check_connection,
     confirm,
     do_node_local_request,
     get_arg_parser,
-    get_db_list,
     is_node_in_cluster,
+    iter_db_list,
     node_details_from_args,
 )
 
 
-def _update_db_doc_with_new_node(node_details, db_name, new_node):
+def _update_db_doc_with_new_node(node_details, db_name, new_node, journal=None):
     db_doc = do_node_local_request(node_details, '_dbs/{}'.format(db_name))
+    before = copy.deepcopy(db_doc)
     by_node = db_doc['by_node']
     if new_node in by_node:
         print('  Node "{}" already has shards for db "{}"'.format(new_node, db_name))
+        if journal:
+            journal.record_done(db_name, changed=False)
         return
 
     shards_for_new_node = None
     for node_name, shards in by_node.items():
-        if args.control_node_ip in node_name:
+        if node_details.ip in node_name:
             shards_for_new_node = shards
             break
 
@@ -45,6 +50,8 @@ def _update_db_doc_with_new_node(node_details, db_name, new_node):
 
     print('  Updating db config for {}'.format(db_name))
     do_node_local_request(node_details, '_dbs/{}'.format(db_name), method='put', json=db_doc)
+    if journal:
+        journal.record_done(db_name, before=before)
 
 
 def _add_node(node_details, new_node):
@@ -54,16 +61,24 @@ def _add_node(node_details, new_node):
         add_node_to_cluster(node_details, new_node)
 
 
-if __name__ == '__main__':
+def main():
     parser = get_arg_parser('Add a replica node to a couchdb2 cluster')
     parser.add_argument('--new-node', dest='new_node', required=True,
                         help='New node e.g. couchdb@node-ip')
+    add_journal_arguments(parser)
     args = parser.parse_args()
 
     node_details = node_details_from_args(args)
     check_connection(node_details)
 
     new_node = args.new_node
+    journal = open_journal(args, 'add-replica-node', {'new_node': new_node})
+    if args.undo:
+        with journal:
+            undo_journal(node_details, journal)
+        print('{} was left in the cluster; remove it with remove-node if it should go too'.format(new_node))
+        return
+
     _add_node(node_details, new_node)
 
     if not confirm("Have you copied the shard files from {} to {}?".format(node_details.ip, new_node)):
@@ -73,10 +88,19 @@ if __name__ == '__main__':
         print(line)
         sys.exit(1)
 
-    for db_name in get_db_list(node_details):
-        if db_name.startswith('_'):
-            # TODO: remove this once there's a workaround for https://github.com/apache/couchdb/issues/858
-            print('Skipping {}'.format(db_name))
-            continue
-        if confirm('Add shards from db "{}" to new node?'.format(db_name)):
-            _update_db_doc_with_new_node(node_details, db_name, new_node)
+    done = journal.get_done()
+    with journal:
+        for db_name in iter_db_list(node_details):
+            if db_name.startswith('_'):
+                # TODO: remove this once there's a workaround for https://github.com/apache/couchdb/issues/858
+                print('Skipping {}'.format(db_name))
+                continue
+            if db_name in done:
+                print('Already done {}'.format(db_name))
+                continue
+            if confirm('Add shards from db "{}" to new node?'.format(db_name)):
+                _update_db_doc_with_new_node(node_details, db_name, new_node, journal)
+
+
+if __name__ == '__main__':
+    main()
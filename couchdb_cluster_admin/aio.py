@@ -0,0 +1,279 @@
+from __future__ import absolute_import
+import asyncio
+import json as jsonlib
+import time
+
+from .doc_models import MembershipDoc, ShardAllocationDoc
+from .instrumentation import record_request
+from .retry import get_circuit_breaker, get_retry_policy, is_idempotent, RETRY_STATUS_CODES
+from .utils import NodeDetails, cache_capabilities, get_cached_capabilities, get_node_local_path_and_port, \
+    make_capabilities, warn_about_configured_version
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncClient(object):
+    """
+    asyncio counterpart of the request layer in utils and of the crawl in get_db_info
+
+    Requests share one pooled aiohttp session and at most `concurrency` are in flight at a time,
+    so cluster planning can be embedded in an asyncio service without gevent monkey-patching.
+
+        async with AsyncClient(config) as client:
+            db_info = await client.get_db_info()
+
+    `config` may be a Config or, like get_membership and get_shard_allocation, a NodeDetails.
+    Requests go through the same per-node circuit breakers as the gevent commands.
+    Connecting through a socks proxy is not supported.
+    """
+    def __init__(self, config, concurrency=20, retry_policy=None):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for the asyncio client. "
+                              "Please run 'pip install couchdb-cluster-admin[async]'")
+        if isinstance(config, NodeDetails):
+            self.node_details = config
+            self.config = None
+        else:
+            self.node_details = config.get_control_node()
+            self.config = config
+        if self.node_details.socks_port:
+            raise ValueError("The asyncio client can't connect through a socks proxy. "
+                             "Use the gevent based functions in utils instead.")
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy or get_retry_policy()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        # (ip, port)->the task detecting that node's capabilities, so that it's only probed once
+        self._capabilities_tasks = {}
+
+    async def __aenter__(self):
+        auth = None
+        if self.node_details.username:
+            auth = aiohttp.BasicAuth(self.node_details.username, self.node_details.password)
+        self._session = aiohttp.ClientSession(
+            auth=auth,
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.retry_policy.timeout),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def do_couch_request(self, path, method='get', params=None, json=None, node_details=None):
+        node_details = node_details or self.node_details
+        return await self._do_request(node_details, path, node_details.port, method, params, json)
+
+    async def do_node_local_request(self, path, method='get', params=None, json=None, node_details=None):
+        node_details = node_details or self.node_details
+        capabilities = await self.get_capabilities(node_details)
+        path, node_local_port = get_node_local_path_and_port(node_details, path, capabilities)
+        return await self._do_request(node_details, path, node_local_port, method, params, json)
+
+    async def get_capabilities(self, node_details=None):
+        """
+        Async version of utils.get_capabilities, sharing its cache
+
+        Like it, a node is only probed once: tasks that ask while it's being probed wait for that probe.
+        """
+        node_details = node_details or self.node_details
+        capabilities = get_cached_capabilities(node_details)
+        if capabilities is not None:
+            return capabilities
+        key = (node_details.ip, node_details.port)
+        task = self._capabilities_tasks.get(key)
+        if task is None:
+            task = self._capabilities_tasks[key] = asyncio.ensure_future(
+                self._detect_and_cache_capabilities(node_details))
+        try:
+            # shielded, so that one waiter being cancelled doesn't cancel the probe for the rest
+            return await asyncio.shield(task)
+        finally:
+            if task.done() and self._capabilities_tasks.get(key) is task:
+                # cached (or failed, in which case the next call probes again)
+                del self._capabilities_tasks[key]
+
+    async def _detect_and_cache_capabilities(self, node_details):
+        capabilities = await self._detect_capabilities(node_details)
+        cache_capabilities(node_details, capabilities)
+        return capabilities
+
+    async def _detect_capabilities(self, node_details):
+        async def _get_status(path, port):
+            try:
+                await self._do_request(node_details, path, port, 'get', None, None)
+            except aiohttp.ClientResponseError as e:
+                return e.status
+            return 200
+
+        welcome = await self._do_request(node_details, '', node_details.port, 'get', None, None)
+        node_local_api = await _get_status('_node/_local/_dbs', node_details.port) == 200
+        if node_local_api:
+            dbs_path, node_local_port = '_node/_local/_dbs', node_details.port
+        else:
+            dbs_path, node_local_port = '_dbs', node_details.node_local_port
+        capabilities = make_capabilities(
+            welcome, node_local_api,
+            dbs_bulk_docs=await _get_status(dbs_path + '/_bulk_docs', node_local_port) == 405,
+        )
+        warn_about_configured_version(node_details, capabilities)
+        return capabilities
+
+    async def _do_request(self, node_details, path, port, method, params, json):
+        if self._session is None:
+            raise RuntimeError('AsyncClient is not open. '
+                               'Use it as "async with AsyncClient(config) as client:"')
+        if params:
+            params = {key: str(value) for key, value in params.items()}
+        circuit_breaker = get_circuit_breaker(node_details.ip, port)
+        can_retry = is_idempotent(method, path)
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            probe = await _wait_for_circuit_breaker(circuit_breaker)
+            try:
+                async with self._semaphore:
+                    async with self._session.request(
+                            method, "http://{}:{}/{}".format(node_details.ip, port, path),
+                            params=params, json=json) as response:
+                        body = await response.read()
+                        response.raise_for_status()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if _is_retryable_error(e):
+                    circuit_breaker.on_failure()
+                    if can_retry and attempt < self.retry_policy.max_retries:
+                        await asyncio.sleep(self.retry_policy.get_backoff(attempt))
+                        attempt += 1
+                        continue
+                else:
+                    circuit_breaker.on_success()
+                record_request(method, path, time.perf_counter() - start, retries=attempt, error=e)
+                raise
+            finally:
+                # a no-op unless the request was cancelled or failed in some other way
+                circuit_breaker.release_probe(probe)
+            circuit_breaker.on_success()
+            record_request(method, path, time.perf_counter() - start, retries=attempt,
+                           bytes_sent=len(jsonlib.dumps(json)) if json is not None else 0,
+                           bytes_received=len(body))
+            return jsonlib.loads(body)
+
+    async def iter_db_list(self, page_size=1000):
+        """
+        Async generator version of utils.iter_db_list
+        """
+        async def _get_page(last_db_name):
+            params = {'limit': page_size}
+            if last_db_name is not None:
+                params['start_key'] = jsonlib.dumps(last_db_name)
+                params['skip'] = 1
+            return await self.do_couch_request('_all_dbs', params=params)
+
+        page = await _get_page(None)
+        while page:
+            next_page = asyncio.ensure_future(_get_page(page[-1])) if len(page) == page_size else None
+            for db_name in page:
+                yield db_name
+            page = await next_page if next_page else None
+
+    async def get_db_list(self):
+        return [db_name async for db_name in self.iter_db_list()]
+
+    async def get_membership(self):
+        membership_doc = MembershipDoc.wrap(await self.do_couch_request('_membership'))
+        membership_doc.set_config(self.config)
+        return membership_doc
+
+    async def get_shard_allocation(self, db_name, create=False):
+        try:
+            shard_allocation_doc = ShardAllocationDoc.wrap(
+                await self.do_node_local_request('_dbs/{}'.format(db_name)))
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                if create:
+                    shard_allocation_doc = ShardAllocationDoc(_id=db_name)
+                else:
+                    raise Exception('Database "{}" does not exist. Use "--create-missing-databases" flag if you '
+                                    'want to have the database created when the plan is committed.'.format(db_name))
+            else:
+                raise
+
+        shard_allocation_doc.set_config(self.config)
+        return shard_allocation_doc
+
+    async def put_shard_allocation(self, shard_allocation_doc):
+        return await self.do_node_local_request(
+            '_dbs/{}'.format(shard_allocation_doc.db_name),
+            method='PUT',
+            json=shard_allocation_doc.to_json(),
+        )
+
+    async def get_db_size(self, db_name, size_metric='file'):
+        return (await self.do_couch_request(db_name))['sizes'][size_metric]
+
+    async def get_views_list(self, db_name):
+        view_response = await self.do_couch_request(
+            '{db_name}/_all_docs'.format(db_name=db_name),
+            params={'startkey': '"_design/"', 'endkey': '"_design0"'},
+        )
+        return [row['id'][len('_design/'):] for row in view_response['rows'] if row['id'].startswith('_design/')]
+
+    async def get_view_signature_and_size(self, db_name, view_name, size_metric='file'):
+        view_info = await self.do_couch_request(
+            '{db_name}/_design/{view_name}/_info'.format(db_name=db_name, view_name=view_name))
+        return view_info['view_index']['signature'], view_info['view_index']['sizes'][size_metric]
+
+    async def _get_view_sizes(self, db_name, size_metric):
+        view_sizes = {}
+        view_names = await self.get_views_list(db_name)
+        signatures_and_sizes = await asyncio.gather(*[
+            self.get_view_signature_and_size(db_name, view_name, size_metric) for view_name in view_names
+        ])
+        for view_name, (signature, size) in zip(view_names, signatures_and_sizes):
+            view_sizes[signature] = (view_name, size)
+        return {name: size for name, size in view_sizes.values()}
+
+    async def _get_one_db_info(self, db_name, size_metric):
+        size, view_sizes, shard_allocation_doc = await asyncio.gather(
+            self.get_db_size(db_name, size_metric),
+            self._get_view_sizes(db_name, size_metric),
+            self.get_shard_allocation(db_name),
+        )
+        return db_name, size, view_sizes, sorted(shard_allocation_doc.by_range), shard_allocation_doc
+
+    async def get_db_info(self, size_metric='file'):
+        """
+        Same result as suggest_shard_allocation.get_db_info:
+        [(db_name, size, view_sizes, shards, shard_allocation_doc), ...]
+        """
+        tasks = []
+        async for db_name in self.iter_db_list():
+            tasks.append(asyncio.ensure_future(self._get_one_db_info(db_name, size_metric)))
+        return list(await asyncio.gather(*tasks))
+
+    async def get_shard_allocations(self, db_names, create=False):
+        return list(await asyncio.gather(*[
+            self.get_shard_allocation(db_name, create) for db_name in db_names
+        ]))
+
+
+async def _wait_for_circuit_breaker(circuit_breaker):
+    while True:
+        wait, probe = circuit_breaker.check_request()
+        if wait is None:
+            return probe
+        await asyncio.sleep(wait)
+
+
+def _is_retryable_error(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUS_CODES
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
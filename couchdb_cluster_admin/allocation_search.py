@@ -0,0 +1,255 @@
+from __future__ import absolute_import
+import itertools
+import os
+import random
+import time
+from array import array
+from collections import namedtuple
+
+from .suggest_shard_allocation import Allocator, ShardIndex, _NodeAllocation
+
+# How many bytes of imbalance moving one byte is worth: at 0.1, copying 10 GB more
+# is only worth it if it takes at least 1 GB off what nodes hold over their targets
+DEFAULT_MOVE_WEIGHT = 0.1
+
+# How many smaller copies to try swapping for a copy that doesn't fit on a node by itself
+SWAP_CANDIDATES = 8
+
+SearchResult = namedtuple('SearchResult', 'nodes score excess moved seed n_starts')
+
+
+class _Problem(object):
+    """
+    Everything a search start needs, shared by all of them
+
+    In a process pool, it's sent to each worker once (see _init_worker) rather than with every start.
+    """
+    def __init__(self, shard_sizes, n_nodes, n_copies, existing_allocation=None, capacities=None,
+                 move_weight=DEFAULT_MOVE_WEIGHT, noise=0.2):
+        self.shard_sizes = shard_sizes
+        self.n_nodes = n_nodes
+        self.n_copies = n_copies
+        self.capacities = capacities
+        self.move_weight = move_weight
+        self.noise = noise
+        # shards are shard ids from here on
+        self.index = ShardIndex(shard_sizes, n_nodes, existing_allocation)
+        # target sizes as the Allocator works them out
+        self.target_sizes = self.make_allocator()._target_sizes
+
+    def make_allocator(self, allocator_class=Allocator, **kwargs):
+        return allocator_class(self.shard_sizes, self.n_nodes, self.n_copies, capacities=self.capacities,
+                               shard_index=self.index, **kwargs)
+
+    def get_excess(self, sizes):
+        """
+        How much nodes hold over their targets, all together; 0 is perfectly even
+
+        Unlike how far the fullest node is over, this goes down with every copy
+        moved off a node that is over its target, even when other nodes are just as full.
+        """
+        return sum(max(size - target, 0) for size, target in zip(sizes, self.target_sizes))
+
+    def get_moved(self, node_shards):
+        return sum(self.index.sizes[shard]
+                   for i, shards in enumerate(node_shards)
+                   for shard in shards if not self.index.existing[i][shard])
+
+    def get_score(self, excess, moved):
+        return excess + self.move_weight * moved
+
+
+class _PerturbedAllocator(Allocator):
+    """
+    An Allocator that breaks near-ties at random, so that each seed starts the search somewhere else
+
+    Shards are placed in roughly (not exactly) largest-first order, and nodes that are
+    nearly as empty as each other are picked between at random.
+    """
+    def __init__(self, shard_sizes, n_nodes, n_copies, existing_allocation=None, capacities=None,
+                 shard_index=None, seed=0, noise=0.2):
+        super(_PerturbedAllocator, self).__init__(
+            shard_sizes, n_nodes, n_copies, existing_allocation, capacities, shard_index)
+        self._random = random.Random(seed)
+        self._noise = noise
+
+    def _jitter(self):
+        return self._random.uniform(1 - self._noise, 1 + self._noise)
+
+    def _get_shard_sizes_largest_to_smallest(self):
+        sizes = self.index.sizes
+        return [shard for _, shard in sorted(
+            ((sizes[shard] * self._jitter(), shard) for shard in range(len(self.index))), reverse=True)]
+
+    def _select_shard_locations(self, shard):
+        return sorted(
+            self.nodes,
+            key=lambda node: (not self._is_original_location(node, shard), self._get_fill(node) * self._jitter())
+        )[:self.n_copies]
+
+
+def improve_allocation(problem, node_shards, deadline=None):
+    """
+    Local search: move single copies off nodes over their targets, or swap them for smaller ones,
+    for as long as that improves the score
+
+    As in the Allocator, more than half of a shard's copies stay where they are now.
+
+    :param node_shards: list of sets of shard ids, one per node; changed in place
+    :return: the final score
+    """
+    sizes_by_shard = problem.index.sizes
+    existing = problem.index.existing
+    sizes = [sum(sizes_by_shard[shard] for shard in shards) for shards in node_shards]
+    moved = problem.get_moved(node_shards)
+    score = problem.get_score(problem.get_excess(sizes), moved)
+    in_place_by_shard = array('i', bytes(4 * len(problem.index)))
+    for i, shards in enumerate(node_shards):
+        for shard in shards:
+            in_place_by_shard[shard] += existing[i][shard]
+
+    def _can_move_from(i, shard):
+        return not existing[i][shard] or in_place_by_shard[shard] > problem.n_copies / 2 + 1
+
+    def _out_of_time():
+        return deadline is not None and time.time() >= deadline
+
+    def _try(changes):
+        # changes: list of (shard, from_i, to_i); return the new state if it improves the score
+        new_sizes = list(sizes)
+        new_moved = moved
+        for shard, from_i, to_i in changes:
+            size = sizes_by_shard[shard]
+            new_sizes[from_i] -= size
+            new_sizes[to_i] += size
+            new_moved += size * (existing[from_i][shard] - existing[to_i][shard])
+        new_score = problem.get_score(problem.get_excess(new_sizes), new_moved)
+        if new_score < score:
+            return new_sizes, new_moved, new_score
+
+    def _apply(changes):
+        for shard, from_i, to_i in changes:
+            in_place_by_shard[shard] += existing[to_i][shard] - existing[from_i][shard]
+            node_shards[from_i].remove(shard)
+            node_shards[to_i].add(shard)
+
+    def _find_improvement(source, others, shards_by_size):
+        for shard in shards_by_size[source]:
+            if _out_of_time():
+                return None
+            if not _can_move_from(source, shard):
+                continue
+            for other in others:
+                if shard in node_shards[other]:
+                    continue
+                changes = [(shard, source, other)]
+                result = _try(changes)
+                if result is None:
+                    # the copy doesn't fit there; try taking back one of the largest smaller copies instead
+                    swaps = (
+                        other_shard for other_shard in shards_by_size[other]
+                        if sizes_by_shard[other_shard] < sizes_by_shard[shard]
+                        and other_shard not in node_shards[source] and _can_move_from(other, other_shard)
+                    )
+                    for other_shard in itertools.islice(swaps, SWAP_CANDIDATES):
+                        result = _try(changes + [(other_shard, other, source)])
+                        if result is not None:
+                            changes.append((other_shard, other, source))
+                            break
+                if result is not None:
+                    return changes, result
+        return None
+
+    while not _out_of_time():
+        # fullest (relative to target) first
+        by_fill = sorted(range(problem.n_nodes), key=lambda i: sizes[i] - problem.target_sizes[i], reverse=True)
+        shards_by_size = {i: sorted(node_shards[i], key=lambda shard: (-sizes_by_shard[shard], shard))
+                          for i in by_fill}
+        improvement = None
+        for source in by_fill:
+            if sizes[source] <= problem.target_sizes[source]:
+                break
+            improvement = _find_improvement(source, by_fill[::-1], shards_by_size)
+            if improvement is not None:
+                break
+        if improvement is None:
+            break
+        changes, (sizes, moved, score) = improvement
+        _apply(changes)
+    return score
+
+
+def run_start(problem, seed, deadline=None):
+    """
+    One start of the search: seed 0 is the plain Allocator, any other seed a perturbed one,
+    each followed by improve_allocation
+
+    :return: tuple(score, seed, excess, moved, node_shards)
+    """
+    if seed == 0:
+        allocator = problem.make_allocator()
+    else:
+        allocator = problem.make_allocator(_PerturbedAllocator, seed=seed, noise=problem.noise)
+    node_shards = [set(node.shards) for node in allocator.allocate()]
+    score = improve_allocation(problem, node_shards, deadline)
+    sizes = [sum(problem.index.sizes[shard] for shard in shards) for shards in node_shards]
+    return score, seed, problem.get_excess(sizes), problem.get_moved(node_shards), node_shards
+
+
+_worker_problem = None
+
+
+def _init_worker(problem):
+    global _worker_problem
+    _worker_problem = problem
+
+
+def _run_worker_start(seed, deadline):
+    return run_start(_worker_problem, seed, deadline)
+
+
+def search_shard_allocation(shard_sizes, n_nodes, n_copies, existing_allocation=None, capacities=None,
+                            time_budget=10, max_starts=None, workers=None, move_weight=DEFAULT_MOVE_WEIGHT):
+    """
+    Multi-start version of suggest_shard_allocation
+
+    Runs the Allocator from many perturbed starting points, improves each with a local search,
+    and keeps the allocation with the lowest score: how much nodes hold over their targets,
+    plus move_weight times the bytes that have to be copied. Starts run in a pool of `workers`
+    processes (by default one per core) until time_budget seconds are up or max_starts have been run.
+    The first start is the plain Allocator, so the result is never worse than suggest_shard_allocation's.
+    Ties go to the lowest seed, so with enough time the result doesn't depend on how many workers there are.
+
+    :return: SearchResult, whose nodes are a list of _NodeAllocation as from suggest_shard_allocation
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    problem = _Problem(shard_sizes, n_nodes, n_copies, existing_allocation, capacities, move_weight)
+    workers = workers or os.cpu_count() or 1
+    deadline = time.time() + time_budget
+    best = None
+    n_starts = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(problem,)) as executor:
+        running = set()
+        seed = 0
+        while True:
+            # keep every worker busy, with one more start queued behind each
+            while (len(running) < workers * 2 and (max_starts is None or seed < max_starts)
+                   and (seed == 0 or time.time() < deadline)):
+                running.add(executor.submit(_run_worker_start, seed, deadline))
+                seed += 1
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                n_starts += 1
+                if best is None or result[:2] < best[:2]:
+                    best = result
+    score, seed, excess, moved, node_shards = best
+    sizes = problem.index.sizes
+    nodes = problem.index.get_node_allocations([
+        _NodeAllocation(i, sum(sizes[shard] for shard in shards),
+                        sorted(shards, key=lambda shard: (-sizes[shard], shard)))
+        for i, shards in enumerate(node_shards)
+    ])
+    return SearchResult(nodes, score, excess, moved, seed, n_starts)
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import itertools
+import threading
+from contextlib import contextmanager
+
+from .retry import get_circuit_breaker
+
+
+class ReadBalancer(object):
+    """
+    Spread clustered reads addressed to the control node across every node in the cluster
+
+    Each read goes to the node with the fewest requests in flight, skipping nodes whose
+    circuit breaker is open unless every node's is. Ties go to the node picked least recently.
+    Only requests addressed to the control node are spread;
+    requests meant for a specific node (e.g. monitor's shard replicas) stay where they are.
+    """
+    def __init__(self, control_node, cluster_node_details):
+        self.control_node = control_node
+        self.node_details = list(cluster_node_details)
+        self._outstanding = {node_details: 0 for node_details in self.node_details}
+        self._last_picked = {node_details: 0 for node_details in self.node_details}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _choose(self):
+        healthy = [node_details for node_details in self.node_details
+                   if get_circuit_breaker(node_details.ip, node_details.port).is_closed]
+        return min(healthy or self.node_details,
+                   key=lambda node_details: (self._outstanding[node_details], self._last_picked[node_details]))
+
+    @contextmanager
+    def acquire(self):
+        """
+        Pick a node and count the request as outstanding on it until the block exits
+        """
+        with self._lock:
+            node_details = self._choose()
+            self._outstanding[node_details] += 1
+            self._last_picked[node_details] = next(self._counter)
+        try:
+            yield node_details
+        finally:
+            with self._lock:
+                self._outstanding[node_details] -= 1
+
+    def get_outstanding(self):
+        with self._lock:
+            return {node_details.ip: outstanding for node_details, outstanding in self._outstanding.items()}
+
+
+# (ip, port) of each cluster's control node->its ReadBalancer,
+# so that commands talking to several clusters (e.g. fleet) spread each one's reads over its own nodes
+_read_balancers = {}
+_read_balancers_lock = threading.Lock()
+
+
+def get_read_balancer(node_details):
+    """
+    :return: the ReadBalancer for requests addressed to node_details, or None if they aren't spread
+    """
+    with _read_balancers_lock:
+        return _read_balancers.get((node_details.ip, node_details.port))
+
+
+def set_read_balancer(control_node, read_balancer):
+    """
+    Spread reads addressed to control_node with read_balancer, or stop spreading them if it's None
+    """
+    with _read_balancers_lock:
+        if read_balancer is None:
+            _read_balancers.pop((control_node.ip, control_node.port), None)
+        else:
+            _read_balancers[(control_node.ip, control_node.port)] = read_balancer
+
+
+def add_balancer_arguments(parser):
+    parser.add_argument('--spread-reads', dest='spread_reads', action='store_true',
+                        help='Send read-only clustered requests to every node in the cluster instead of just '
+                             'the control node. All nodes must listen on the control node\'s ports.')
+
+
+def set_up_read_balancer(args, config):
+    """
+    If --spread-reads was given, find the cluster's nodes from _membership and start balancing reads across them
+    """
+    control_node = config.get_control_node()
+    if not getattr(args, 'spread_reads', False):
+        set_read_balancer(control_node, None)
+        return None
+    from .utils import get_membership
+    cluster_nodes = get_membership(config).cluster_nodes
+    read_balancer = ReadBalancer(control_node, [config.get_node_details(node) for node in cluster_nodes])
+    set_read_balancer(control_node, read_balancer)
+    return read_balancer
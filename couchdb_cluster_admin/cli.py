@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import importlib
+import sys
+from collections import namedtuple
+
+Command = namedtuple('Command', 'name module help uses_gevent')
+
+# Command modules are only imported once we know which one is being run,
+# so that `couchdb-cluster-admin --help` doesn't pay for requests, jsonobject, gevent etc.
+COMMANDS = [
+    Command('describe', 'describe',
+            u'Describe a couchdb cluster', False),
+    Command('fleet', 'fleet',
+            u'Describe several clusters at once', True),
+    Command('suggest-shard-allocation', 'suggest_shard_allocation',
+            u'Suggest shard allocation for a cluster', True),
+    Command('file-plan', 'file_plan',
+            u'Helper for various manual database file operations', True),
+    Command('plan-cost', 'plan_cost',
+            u'Estimate how much data plans move and how long copying it takes', True),
+    Command('plan-waves', 'waves',
+            u'Split a plan into stages that fit the free disk space on each node', True),
+    Command('compact', 'compact',
+            u'Compact the shards a plan will copy, before copying them', True),
+    Command('monitor', 'monitor',
+            u'Monitor internal replication after a plan has been committed', True),
+    Command('simulate', 'simulate',
+            u'Simulate node and zone failures against the shard allocation', True),
+    Command('reshard', 'reshard',
+            u'Split oversized shards (CouchDB 3 and later)', True),
+    Command('add-replica-node', 'add_replica_node',
+            u'Add a replica node to a couchdb2 cluster', False),
+    Command('remove-node', 'remove_node',
+            u'Remove a node from the cluster', False),
+    Command('replicate-db-to-new-node', 'replicate_db_to_new_node',
+            u'Replicate DB shards to a new node', False),
+    Command('copy-db-to-new-cluster', 'copy_db_to_new_cluster',
+            u'Copy a database from one cluster to another', False),
+]
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='couchdb-cluster-admin',
+        description=u'Utility for managing multi-node couchdb clusters',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=u'commands:\n' + u'\n'.join(
+            u'  {: <26}{}'.format(command.name, command.help) for command in COMMANDS
+        ) + u'\n\nRun "couchdb-cluster-admin <command> --help" for the options of each command.',
+    )
+    parser.add_argument('command', choices=[command.name for command in COMMANDS], metavar='command',
+                        help=u'One of the commands listed below')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = get_arg_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    command, = [command for command in COMMANDS if command.name == args.command]
+    if command.uses_gevent and not {'-h', '--help'} & set(args.args):
+        # patch before anything imports socket or ssl;
+        # skipped for --help since patching alone takes longer than the rest of startup
+        from gevent import monkey; monkey.patch_all()
+    module = importlib.import_module('couchdb_cluster_admin.{}'.format(command.module))
+    # the command parses its own options from sys.argv
+    sys.argv = ['couchdb-cluster-admin {}'.format(command.name)] + args.args
+    return module.main()
+
+
+if __name__ == '__main__':
+    main()
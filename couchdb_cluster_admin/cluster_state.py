@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+import copy
+import threading
+
+from .utils import get_db_docs, get_dbs_metadata, get_membership, make_shard_allocation_doc
+
+
+class ClusterState(object):
+    """
+    Membership, shard maps and database info of one cluster, each fetched at most once per process
+
+    Commands that look at the same databases more than once (e.g. file_plan finding shard suffixes
+    and then missing files) read them from here instead of asking the cluster again.
+    Fetches are single-flight: if several greenlets ask for the same database at once,
+    it is fetched by the first and the rest wait for that fetch rather than making their own.
+
+    What is cached is a snapshot; anything that has to watch the cluster change (e.g. monitor)
+    should keep asking the cluster directly.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.node_details = config.get_control_node()
+        self._lock = threading.Lock()
+        self._values = {}
+        self._in_flight = {}
+
+    def _get_many(self, kind, names, fetch):
+        """
+        :param fetch: function taking a list of names and returning a dict of name->value
+                      for those that have one; the rest are cached as None
+        :return: list of values, in the order of names
+        """
+        keys = [(kind, name) for name in names]
+        while True:
+            to_fetch = []
+            to_wait = []
+            with self._lock:
+                for key in keys:
+                    if key in self._values:
+                        continue
+                    if key in self._in_flight:
+                        to_wait.append(self._in_flight[key])
+                    elif key not in to_fetch:
+                        self._in_flight[key] = threading.Event()
+                        to_fetch.append(key)
+            if to_fetch:
+                try:
+                    values = fetch([name for _, name in to_fetch])
+                    with self._lock:
+                        for key in to_fetch:
+                            self._values[key] = values.get(key[1])
+                finally:
+                    with self._lock:
+                        for key in to_fetch:
+                            self._in_flight.pop(key).set()
+            if not to_wait:
+                break
+            for event in to_wait:
+                event.wait()
+            # go round again: whatever failed to fetch elsewhere is fetched here
+
+        with self._lock:
+            return [self._values[key] for key in keys]
+
+    def get_membership(self):
+        from .doc_models import MembershipDoc
+        membership_json, = self._get_many(
+            'membership', [None], lambda _: {None: get_membership(self.node_details).to_json()})
+        membership_doc = MembershipDoc.wrap(copy.deepcopy(membership_json))
+        membership_doc.set_config(self.config)
+        return membership_doc
+
+    def get_shard_allocations(self, db_names, create=False):
+        """
+        Same as utils.get_shard_allocations. Each call gets its own copies of the docs, to change as it likes.
+        """
+        db_names = list(db_names)
+        db_docs = self._get_many('shard_map', db_names, lambda names: get_db_docs(self.node_details, names))
+        return [make_shard_allocation_doc(self.config, db_name, copy.deepcopy(db_doc), create)
+                for db_name, db_doc in zip(db_names, db_docs)]
+
+    def get_shard_allocation(self, db_name, create=False):
+        return self.get_shard_allocations([db_name], create)[0]
+
+    def get_dbs_metadata(self, db_names):
+        """
+        Same as utils.get_dbs_metadata
+        """
+        db_names = list(db_names)
+        metadata = self._get_many('db_info', db_names, lambda names: get_dbs_metadata(self.node_details, names))
+        return {db_name: db_metadata for db_name, db_metadata in zip(db_names, metadata) if db_metadata is not None}
+
+    def forget_shard_allocations(self, db_names):
+        """
+        Drop cached shard maps, e.g. once new ones have been saved
+        """
+        with self._lock:
+            for db_name in db_names:
+                self._values.pop(('shard_map', db_name), None)
+
+
+def get_cluster_state(config):
+    """
+    The ClusterState shared by everything in this process that talks to config's cluster
+    """
+    cluster_state = getattr(config, '_cluster_state', None)
+    if cluster_state is None:
+        cluster_state = config._cluster_state = ClusterState(config)
+    return cluster_state
@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+from collections import namedtuple
+
+from .cluster_state import get_cluster_state
+from .file_plan import read_plan_file
+from .monitor import get_shard_file_path
+from .utils import (
+    check_connection,
+    do_couch_request,
+    do_node_local_request,
+    get_arg_parser,
+    get_config_from_args,
+    humansize,
+)
+
+ShardCopy = namedtuple('ShardCopy', 'db_name shard shard_suffix node')
+ShardCopySizes = namedtuple('ShardCopySizes', 'shard_copy file active')
+
+
+def get_reclaimable(shard_copy_sizes):
+    return max(shard_copy_sizes.file - shard_copy_sizes.active, 0)
+
+
+def get_copies_to_compact(config, plan):
+    """
+    Find the copies that a plan's new replicas will be copied from
+
+    Like file_plan, the source of a range is the first node currently holding it.
+
+    :return: list of ShardCopy
+    """
+    shard_copies = []
+    for shard_allocation_doc in get_cluster_state(config).get_shard_allocations(sorted(plan)):
+        plan_allocation_doc = plan[shard_allocation_doc.db_name]
+        for shard, nodes in sorted(plan_allocation_doc.by_range.items()):
+            current_nodes = shard_allocation_doc.by_range.get(shard, [])
+            if current_nodes and set(nodes) - set(current_nodes):
+                shard_copies.append(ShardCopy(
+                    shard_allocation_doc.db_name, shard, shard_allocation_doc.usable_shard_suffix,
+                    current_nodes[0]))
+    return shard_copies
+
+
+def _get_shard_copy_info(config, shard_copy):
+    return do_node_local_request(
+        config.get_node_details(shard_copy.node),
+        get_shard_file_path(shard_copy.db_name, shard_copy.shard, shard_copy.shard_suffix))
+
+
+def get_shard_copy_sizes(config, shard_copy):
+    sizes = _get_shard_copy_info(config, shard_copy)['sizes']
+    return ShardCopySizes(shard_copy, sizes['file'], sizes['active'])
+
+
+def get_all_shard_copy_sizes(config, shard_copies, concurrency=20):
+    import gevent.pool
+    pool = gevent.pool.Pool(concurrency)
+    jobs = [pool.spawn(get_shard_copy_sizes, config, shard_copy) for shard_copy in shard_copies]
+    gevent.joinall(jobs, raise_error=True)
+    return [job.value for job in jobs]
+
+
+class CompactionOrchestrator(object):
+    """
+    Compact shard copies and their view indexes, at most `per_node_concurrency` copies per node at a time
+
+    Compaction is started on the node holding the copy, through its node-local API,
+    and the copy counts as done once the node reports neither the database nor any of its views compacting.
+    """
+    def __init__(self, config, per_node_concurrency=1, poll_interval=10):
+        self.config = config
+        self.per_node_concurrency = per_node_concurrency
+        self.poll_interval = poll_interval
+        self._views_by_db_name = {}
+
+    def _get_views(self, db_name):
+        from .suggest_shard_allocation import get_views_list
+        if db_name not in self._views_by_db_name:
+            self._views_by_db_name[db_name] = get_views_list(self.config.get_control_node(), db_name)
+        return self._views_by_db_name[db_name]
+
+    def is_compacting(self, shard_copy):
+        if _get_shard_copy_info(self.config, shard_copy).get('compact_running'):
+            return True
+        shard_file = 'shards/{}/{}{}'.format(shard_copy.shard, shard_copy.db_name, shard_copy.shard_suffix)
+        return any(
+            task.get('type') in ('database_compaction', 'view_compaction')
+            and task.get('node') == shard_copy.node and task.get('database') == shard_file
+            for task in do_couch_request(self.config.get_control_node(), '_active_tasks')
+        )
+
+    def compact(self, shard_copy):
+        node_details = self.config.get_node_details(shard_copy.node)
+        path = get_shard_file_path(shard_copy.db_name, shard_copy.shard, shard_copy.shard_suffix)
+        print(u'Compacting {} {} on {}'.format(
+            shard_copy.db_name, shard_copy.shard, self.config.format_node_name(shard_copy.node)))
+        do_node_local_request(node_details, '{}/_compact'.format(path), method='post', json={})
+        for view_name in self._get_views(shard_copy.db_name):
+            do_node_local_request(node_details, '{}/_compact/{}'.format(path, view_name), method='post', json={})
+        while self.is_compacting(shard_copy):
+            time.sleep(self.poll_interval)
+
+    def run(self, shard_copies):
+        import gevent
+        import gevent.lock
+        semaphores = {}
+        for shard_copy in shard_copies:
+            if shard_copy.node not in semaphores:
+                semaphores[shard_copy.node] = gevent.lock.BoundedSemaphore(self.per_node_concurrency)
+
+        def _compact(shard_copy):
+            with semaphores[shard_copy.node]:
+                self.compact(shard_copy)
+
+        gevent.joinall([gevent.spawn(_compact, shard_copy) for shard_copy in shard_copies], raise_error=True)
+
+
+def print_shard_copy_sizes(config, all_sizes):
+    row = u"{: <30}\t{: <20}\t{: <15}\t{: >12}\t{: >12}\t{: >12}"
+    print(row.format(u"Database", u"Range", u"Node", u"File", u"Active", u"Reclaimable"))
+    for sizes in sorted(all_sizes, key=get_reclaimable, reverse=True):
+        shard_copy = sizes.shard_copy
+        print(row.format(
+            shard_copy.db_name, shard_copy.shard, config.format_node_name(shard_copy.node),
+            humansize(sizes.file), humansize(sizes.active), humansize(get_reclaimable(sizes)),
+        ))
+    print(u'Compaction could save copying {} of {}'.format(
+        humansize(sum(map(get_reclaimable, all_sizes))), humansize(sum(sizes.file for sizes in all_sizes))))
+
+
+def main():
+    parser = get_arg_parser(u'Compact the shards a plan will copy, before copying them')
+    parser.add_argument('--from-plan', dest='plan_file', required=True,
+                        help=u'Plan whose new replicas are about to be copied')
+    parser.add_argument('--execute', dest='execute', action='store_true',
+                        help=u'Compact every copy with anything to reclaim. '
+                             u'Without this, only report how much each could reclaim.')
+    parser.add_argument('--per-node-concurrency', dest='per_node_concurrency', type=int, default=1,
+                        help=u'How many copies to compact at once on each node. Default: 1')
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=10,
+                        help=u'Seconds between checks on whether a compaction is done. Default: 10')
+    args = parser.parse_args()
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    plan = read_plan_file(args.plan_file)
+    all_sizes = get_all_shard_copy_sizes(config, get_copies_to_compact(config, plan))
+    print_shard_copy_sizes(config, all_sizes)
+
+    if args.execute:
+        shard_copies = [sizes.shard_copy for sizes in sorted(all_sizes, key=get_reclaimable, reverse=True)
+                        if get_reclaimable(sizes)]
+        CompactionOrchestrator(
+            config, per_node_concurrency=args.per_node_concurrency, poll_interval=args.poll_interval,
+        ).run(shard_copies)
+        before = sum(sizes.file for sizes in all_sizes if get_reclaimable(sizes))
+        after = sum(sizes.file for sizes in get_all_shard_copy_sizes(config, shard_copies))
+        print(u'Done. Reclaimed {}'.format(humansize(before - after)))
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
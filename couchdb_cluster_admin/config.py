@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+from jsonobject import JsonObject, StringProperty, IntegerProperty, DictProperty, ListProperty
+
+from .utils import NodeDetails
+
+
+class Config(JsonObject):
+    control_node_ip = StringProperty()
+    control_node_port = IntegerProperty()
+    control_node_local_port = IntegerProperty()
+    couchdb_version = StringProperty()
+    username = StringProperty()
+    aliases = DictProperty(str)
+    # zone name -> list of node nicknames, for simulating zone failures
+    zones = DictProperty(ListProperty(str))
+    # node nickname -> how much it can hold relative to the others, e.g. its disk size in GB
+    capacities = DictProperty(float)
+
+    def set_password(self, password):
+        self._password = password
+
+    def get_control_node(self):
+        return NodeDetails(
+            self.control_node_ip, self.control_node_port, self.control_node_local_port, self.couchdb_version,
+            self.username, self._password, None
+        )
+
+    def get_node_details(self, node):
+        """
+        Get NodeDetails for talking to a specific cluster node (e.g. couchdb@1.2.3.4) directly
+        """
+        return NodeDetails(
+            node.split('@')[-1], self.control_node_port, self.control_node_local_port, self.couchdb_version,
+            self.username, self._password, None
+        )
+
+    def format_node_name(self, node):
+        if node in self.aliases:
+            return self.aliases[node]
+        elif node.startswith('couchdb@'):
+            return node[len('couchdb@'):]
+        else:
+            return node
+
+    def get_capacities(self, nodes):
+        """
+        :return: list of the capacity of each node, or None if no capacities are configured
+        """
+        if not self.capacities:
+            return None
+        missing = [self.format_node_name(node) for node in nodes
+                   if self.format_node_name(node) not in self.capacities]
+        if missing:
+            raise Exception('No capacity is configured for {}'.format(', '.join(missing)))
+        return [self.capacities[self.format_node_name(node)] for node in nodes]
+
+    def get_formal_node_name(self, node_nickname):
+        if not hasattr(self, '_formal_name_lookup'):
+            self._formal_name_lookup = {
+                nickname: formal_name
+                for formal_name, nickname in self.aliases.items()
+            }
+        return self._formal_name_lookup[node_nickname]
@@ -2,30 +2,24 @@ from __future__ import absolute_import
 from __future__ import print_function
 import argparse
 import getpass
+import itertools
 import sys
 
-from requests.exceptions import HTTPError
-
+from .instrumentation import add_profile_arguments, set_up_profiling
+from .journal import add_journal_arguments, open_journal, undo_journal
+from .retry import add_retry_arguments, set_up_retries
 from .utils import (
+    bulk_put_db_docs,
     check_connection,
     confirm,
-    do_node_local_request,
-    get_db_list,
+    get_db_docs,
+    get_existing_db_names,
+    iter_db_list,
     NodeDetails,
 )
 
 
-def _copy_db_doc(from_details, to_details, db_name):
-    try:
-        do_node_local_request(to_details[0], '_dbs/{}'.format(db_name))
-    except HTTPError as e:
-        if e.response.status_code != 404:
-            raise
-    else:
-        print("{} already exists in destination cluster".format(db_name))
-        return
-
-    from_db_doc = do_node_local_request(from_details, '_dbs/{}'.format(db_name))
+def _make_to_db_doc(from_details, to_details, from_db_doc):
     to_db_doc = {
         '_id': from_db_doc['_id'],
         'shard_suffix': from_db_doc['shard_suffix'],
@@ -41,8 +35,8 @@ def _copy_db_doc(from_details, to_details, db_name):
             break
 
     if not db_shards:
-        print('Unable to find shards for db {}'.format(db_name))
-        return
+        print('Unable to find shards for db {}'.format(from_db_doc['_id']))
+        return None
 
     for detail in to_details:
         to_db_doc['by_node']['couchdb@{}'.format(detail.ip)] = db_shards
@@ -50,12 +44,61 @@ def _copy_db_doc(from_details, to_details, db_name):
     nodes = ['couchdb@{}'.format(detail.ip) for detail in to_details]
     for shard in db_shards:
         to_db_doc['by_range'][shard] = nodes
+    return to_db_doc
+
+
+def _copy_db_docs(from_details, to_details, db_names, batch_size=500, journal=None):
+    """
+    Copy the _dbs docs for db_names from one cluster to another
+
+    Each batch costs three requests no matter how many databases are in it:
+    an existence check against the destination, a bulk read from the source
+    and a bulk write to the destination.
+
+    If there's a journal, databases it has as done are skipped, and every database
+    that gets copied (or was already there) is recorded in it.
+    """
+    if journal:
+        done = journal.get_done()
+        db_names = (db_name for db_name in db_names if db_name not in done)
+    db_names = iter(db_names)
+    while True:
+        batch = list(itertools.islice(db_names, batch_size))
+        if not batch:
+            break
+        existing = get_existing_db_names(to_details[0], batch)
+        for db_name in batch:
+            if db_name in existing:
+                print("{} already exists in destination cluster".format(db_name))
+                if journal:
+                    journal.record_done(db_name, changed=False)
+
+        to_copy = [db_name for db_name in batch if db_name not in existing]
+        if not to_copy:
+            continue
 
-    print('  Updating db config for {}'.format(db_name))
-    do_node_local_request(to_details[0], '_dbs/{}'.format(db_name), method='put', json=to_db_doc)
-
-
-if __name__ == '__main__':
+        from_db_docs = get_db_docs(from_details, to_copy)
+        to_db_docs = []
+        for db_name in to_copy:
+            if db_name not in from_db_docs:
+                print('Database {} does not exist in source cluster'.format(db_name))
+                continue
+            to_db_doc = _make_to_db_doc(from_details, to_details, from_db_docs[db_name])
+            if to_db_doc:
+                print('  Updating db config for {}'.format(db_name))
+                to_db_docs.append(to_db_doc)
+
+        if to_db_docs:
+            for result in bulk_put_db_docs(to_details[0], to_db_docs):
+                if 'error' in result:
+                    print('  Failed to update db config for {}: {} ({})'.format(
+                        result['id'], result['error'], result.get('reason')))
+                elif journal:
+                    # it didn't exist before, so undoing it means deleting it
+                    journal.record_done(result['id'], before=None)
+
+
+def main():
     parser = argparse.ArgumentParser(description='Copy a database from one cluster to another')
     parser.add_argument('--from-cluster-ip', dest='from_ip', required=True,
                         help='IP of node in "from" cluster')
@@ -69,9 +112,16 @@ if __name__ == '__main__':
                         help='Database to copy or "ALL"')
     parser.add_argument('--socks', dest='socks',
                         help='Port of local socks proxy to use for communication with the "from" cluster')
-    parser.add_argument('--couchdb-version', dest='couchdb_version', default='2.3.1',
-                        help='Version of CouchDB. Default: 2.3.1')
+    parser.add_argument('--couchdb-version', dest='couchdb_version',
+                        help='Version of CouchDB you expect. The actual version is detected from the server '
+                             'and a warning is printed if they differ.')
+    add_journal_arguments(parser)
+    add_retry_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    set_up_profiling(args)
+    set_up_retries(args)
+    journal = open_journal(args, 'copy-db-to-new-cluster', {'from_ip': args.from_ip, 'to_nodes': args.to_nodes})
 
     if args.socks:
         try:
@@ -86,11 +136,16 @@ if __name__ == '__main__':
     to_username = args.to_username or args.from_username
     to_password = getpass.getpass('Password for "{}@{}"'.format(to_username, args.to_nodes[0]))
     to_details = [
-        NodeDetails(node_ip, 15984, 15986, couchdb_version, to_username, to_password, None)
+        NodeDetails(node_ip, 15984, 15986, args.couchdb_version, to_username, to_password, None)
         for node_ip in args.to_nodes
     ]
     for details in to_details:
-        check_connection(to_details[0])
+        check_connection(details)
+
+    if args.undo:
+        with journal:
+            undo_journal(to_details[0], journal)
+        return
 
     if not confirm("Have you copied the shard files from {} to {}?".format(args.from_ip, args.to_nodes)):
         line = "=" * 40
@@ -100,12 +155,20 @@ if __name__ == '__main__':
         sys.exit(1)
 
     if args.database == 'ALL':
-        dbs = get_db_list(from_details)
+        dbs = iter_db_list(from_details)
     else:
         dbs = [args.database]
-    print(dbs)
-    for db_name in dbs:
-        if db_name.startswith('_'):
-            print('Skipping {}'.format(db_name))
-            continue
-        _copy_db_doc(from_details, to_details, db_name)
+
+    def _dbs_to_copy():
+        for db_name in dbs:
+            if db_name.startswith('_'):
+                print('Skipping {}'.format(db_name))
+                continue
+            yield db_name
+
+    with journal:
+        _copy_db_docs(from_details, to_details, _dbs_to_copy(), journal=journal)
+
+
+if __name__ == '__main__':
+    main()
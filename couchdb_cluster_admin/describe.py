@@ -1,13 +1,18 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import time
+
+from .cluster_state import get_cluster_state
+from .retry import get_retry_policy
 from .utils import (
     check_connection,
+    do_node_local_request,
     get_arg_parser,
     get_config_from_args,
-    get_db_list,
     get_membership,
-    get_shard_allocation,
+    get_shard_allocations,
     indent,
+    iter_db_pages,
 )
 
 
@@ -21,19 +26,124 @@ def print_shard_table(shard_allocation_docs):
         last_header = this_header
 
 
-if __name__ == '__main__':
+class ShardMapWatcher(object):
+    """
+    Keep the shard map of every database up to date by following the control node's _dbs changes feed
+
+    load() reads every shard map once; each poll() then waits up to `timeout` seconds
+    for the feed to report changes and returns only the databases whose ranges actually moved.
+    """
+    def __init__(self, config, timeout=30):
+        self.config = config
+        self.node_details = config.get_control_node()
+        retry_timeout = get_retry_policy().timeout
+        # leave the request itself time to come back before it times out
+        self.timeout = min(timeout, retry_timeout / 2) if retry_timeout else timeout
+        self.since = None
+        self.shard_allocation_docs_by_db_name = {}
+
+    def load(self):
+        # read the seq first, so that changes made during the load are seen again rather than missed
+        self.since = do_node_local_request(self.node_details, '_dbs')['update_seq']
+        self.shard_allocation_docs_by_db_name = {
+            shard_allocation_doc.db_name: shard_allocation_doc
+            for page in iter_db_pages(self.node_details)
+            for shard_allocation_doc in get_shard_allocations(self.config, page)
+        }
+        return self.get_shard_allocation_docs()
+
+    def get_shard_allocation_docs(self):
+        return [self.shard_allocation_docs_by_db_name[db_name]
+                for db_name in sorted(self.shard_allocation_docs_by_db_name)]
+
+    def poll(self):
+        """
+        :return: tuple(changed, deleted): ShardAllocationDocs whose ranges changed or that are new,
+                 and the names of databases that were deleted, both sorted by db name
+        """
+        from .doc_models import ShardAllocationDoc
+        response = do_node_local_request(self.node_details, '_dbs/_changes', params={
+            'feed': 'longpoll',
+            'since': self.since,
+            'include_docs': 'true',
+            'timeout': int(self.timeout * 1000),
+        })
+        self.since = response['last_seq']
+        changed = []
+        deleted = []
+        for result in response['results']:
+            db_name = result['id']
+            if result.get('deleted'):
+                if self.shard_allocation_docs_by_db_name.pop(db_name, None) is not None:
+                    deleted.append(db_name)
+                continue
+            shard_allocation_doc = ShardAllocationDoc.wrap(result['doc'])
+            shard_allocation_doc.set_config(self.config)
+            previous = self.shard_allocation_docs_by_db_name.get(db_name)
+            self.shard_allocation_docs_by_db_name[db_name] = shard_allocation_doc
+            if previous is None or previous.by_range != shard_allocation_doc.by_range:
+                changed.append(shard_allocation_doc)
+        return sorted(changed, key=lambda shard_allocation_doc: shard_allocation_doc.db_name), sorted(deleted)
+
+
+def get_all_shard_allocation_docs(config):
+    """
+    :return: the shard maps of every database in the cluster, sorted by db name
+    """
+    cluster_state = get_cluster_state(config)
+    return sorted([
+        shard_allocation_doc
+        for page in iter_db_pages(config.get_control_node())
+        for shard_allocation_doc in cluster_state.get_shard_allocations(page)
+    ], key=lambda shard_allocation_doc: shard_allocation_doc.db_name)
+
+
+def watch(config, watcher, membership):
+    while True:
+        changed, deleted = watcher.poll()
+        new_membership = get_membership(config)
+        membership_changed = new_membership.to_json() != membership.to_json()
+        if not (changed or deleted or membership_changed):
+            continue
+        print(u'--- {}'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+        if membership_changed:
+            membership = new_membership
+            print(u'Membership')
+            print(indent(membership.get_printable()))
+        if changed:
+            print(u'Shards')
+            print_shard_table(changed)
+        for db_name in deleted:
+            print(u'Deleted\t{}'.format(db_name))
+
+
+def main():
     parser = get_arg_parser(u'Describe a couchdb cluster')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help=u'Keep running, and print the shard maps of databases as they change')
     args = parser.parse_args()
 
     config = get_config_from_args(args)
     node_details = config.get_control_node()
     check_connection(node_details)
 
+    cluster_state = get_cluster_state(config)
+    membership = cluster_state.get_membership()
     print(u'Membership')
-    print(indent(get_membership(config).get_printable()))
+    print(indent(membership.get_printable()))
 
     print(u'Shards')
-    print_shard_table([
-        get_shard_allocation(config, db_name)
-        for db_name in sorted(get_db_list(node_details))
-    ])
+    if not args.watch:
+        print_shard_table(get_all_shard_allocation_docs(config))
+        return
+
+    watcher = ShardMapWatcher(config)
+    print_shard_table(watcher.load())
+    try:
+        watch(config, watcher, membership)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
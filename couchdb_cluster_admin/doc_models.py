@@ -6,7 +6,7 @@ from jsonobject import JsonObject, ListProperty, DictProperty, StringProperty, I
 class ConfigInjectionMixin(object):
     @property
     def config(self):
-        from .utils import Config
+        from .config import Config
         try:
             return self._config
         except AttributeError:
@@ -0,0 +1,608 @@
+"""
+A stand-in for a CouchDB cluster, served over HTTP from this process, for tests and benchmarks
+
+    with FakeCluster(n_nodes=3, n_dbs=100000, latency=0.005) as cluster:
+        config = cluster.get_config()
+        get_db_info(config)
+        print(cluster.request_count, cluster.peak_in_flight)
+
+Each node is served on its own loopback address (127.0.0.1, 127.0.0.2, ...) on a shared port,
+so requests for a particular node (e.g. couchdb@127.0.0.2) reach the right one, like in a real cluster.
+This relies on the whole of 127.0.0.0/8 being local, as it is on Linux.
+
+Only the endpoints this project uses are implemented:
+/, _all_dbs, _membership, _active_tasks, _dbs_info, db info, _all_docs for design docs, _design/*/_info,
+_compact, _reshard and, node-locally (on the node-local port for 2.x, under _node/_local for 3.x),
+_dbs (including _all_docs, _bulk_docs and _changes), _nodes, and shard db info and compaction.
+
+Synthetic databases (db-0000000, db-0000001, ...) are generated on demand from their number,
+so a cluster with 100k databases costs no memory until their shard maps are written to.
+
+Run `python -m couchdb_cluster_admin.fake_cluster --dbs 100000` to try commands against one by hand.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from .instrumentation import classify_endpoint
+from .utils import parse_version
+
+SYNTHETIC_DB_NAME = 'db-{:07d}'
+
+
+def get_ranges(q):
+    step = 2 ** 32 // q
+    return ['{:08x}-{:08x}'.format(i * step, 2 ** 32 - 1 if i == q - 1 else (i + 1) * step - 1) for i in range(q)]
+
+
+def _hash(i, salt=0):
+    # cheap deterministic pseudo-random number, so synthetic databases don't need to be stored
+    return ((i + 1) * 2654435761 + salt * 40503) % 2 ** 32
+
+
+class _FakeHTTPError(Exception):
+    def __init__(self, status, error, reason=''):
+        self.status = status
+        self.body = {'error': error, 'reason': reason}
+
+
+class _Server(ThreadingHTTPServer):
+    """
+    Accepts connections with a blocking accept instead of serve_forever's select loop,
+    which under gevent's monkey patching only noticed new connections every poll interval
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+    stopped = False
+
+    def serve(self):
+        self.socket.settimeout(0.2)
+        while not self.stopped:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.timeout:
+                continue
+            request.settimeout(None)
+            self.process_request(request, client_address)
+
+
+class FakeCluster(object):
+    """
+    :param n_nodes: nodes in the cluster, named couchdb@127.0.0.<i>
+    :param n_dbs: number of synthetic databases
+    :param q: ranges per synthetic database
+    :param n: copies of each range
+    :param views_per_db: design docs per synthetic database
+    :param couchdb_version: what GET / reports; 3.x serves node-local endpoints under _node/_local,
+                            older versions on a separate node-local port
+    :param latency: seconds to wait before answering each request
+    :param error_rate: fraction of requests that fail with error_status instead
+    :param seed: seed for latency jitter and error injection
+    """
+    def __init__(self, n_nodes=3, n_dbs=0, q=8, n=3, views_per_db=1, couchdb_version='3.1.1',
+                 latency=0, error_rate=0, error_status=503, seed=0, port=0, node_local_port=0):
+        self.node_ips = ['127.0.0.{}'.format(i) for i in range(1, n_nodes + 1)]
+        self.nodes = ['couchdb@{}'.format(ip) for ip in self.node_ips]
+        # membership can change through _nodes; placement of synthetic databases shouldn't
+        self._placement_nodes = list(self.nodes)
+        self.n_dbs = n_dbs
+        self.q = q
+        self.n = min(n, n_nodes)
+        self.views_per_db = views_per_db
+        self.couchdb_version = couchdb_version
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.port = port
+        self.node_local_port = node_local_port
+        self._random = random.Random(seed)
+        self._ranges = get_ranges(q)
+        self._lock = threading.Lock()
+        # _dbs changes feed: synthetic databases all predate seq 0
+        self._dbs_changes = []
+        self._dbs_changed = threading.Condition(self._lock)
+        # real databases, and synthetic ones whose _dbs doc has been written to
+        self._dbs = {}
+        self._db_docs = {}
+        self._servers = []
+        self._threads = []
+        self.request_count = 0
+        self.requests_by_endpoint = Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.reshard_jobs = {}
+
+    # Databases
+
+    def add_db(self, db_name, size=1024 ** 2, doc_count=100, views=None, by_range=None, active_size=None):
+        """
+        Add a database; by default its ranges are placed like a synthetic database's
+
+        :param views: dict of design doc name->index size
+        :param by_range: dict of range->list of nodes
+        """
+        with self._lock:
+            self._dbs[db_name] = {
+                'size': size,
+                'active_size': size if active_size is None else active_size,
+                'doc_count': doc_count,
+                'views': dict(views or {}),
+            }
+            self._db_docs[db_name] = self._make_db_doc(db_name, len(self._dbs), by_range)
+            self._record_dbs_change(db_name)
+
+    def _get_synthetic_index(self, db_name):
+        if not db_name.startswith('db-'):
+            return None
+        try:
+            i = int(db_name[3:])
+        except ValueError:
+            return None
+        if 0 <= i < self.n_dbs and SYNTHETIC_DB_NAME.format(i) == db_name:
+            return i
+        return None
+
+    def _get_db(self, db_name):
+        if db_name in self._dbs:
+            return self._dbs[db_name]
+        i = self._get_synthetic_index(db_name)
+        if i is None:
+            return None
+        # most databases are small and a few are large
+        size = 4096 * (1 + _hash(i) % 256) * (1 + (_hash(i, 1) % 64 == 0) * 1000)
+        return {
+            'size': size,
+            'active_size': size * (50 + _hash(i, 2) % 50) // 100,
+            'doc_count': size // 2048,
+            'views': {'views{}'.format(j): size // (4 + j) for j in range(self.views_per_db)},
+        }
+
+    def _make_db_doc(self, db_name, i, by_range=None):
+        if by_range is None:
+            by_range = {
+                shard: [self._placement_nodes[(i + j + k) % len(self._placement_nodes)] for k in range(self.n)]
+                for j, shard in enumerate(self._ranges)
+            }
+        by_node = {}
+        for shard, nodes in sorted(by_range.items()):
+            for node in nodes:
+                by_node.setdefault(node, []).append(shard)
+        return {
+            '_id': db_name,
+            '_rev': '1-{:08x}'.format(_hash(i, 3)),
+            'shard_suffix': [ord(c) for c in '.{:010d}'.format(1500000000 + i)],
+            'changelog': [['add', shard, node] for shard, nodes in sorted(by_range.items()) for node in nodes],
+            'by_node': by_node,
+            'by_range': by_range,
+        }
+
+    def _get_db_doc(self, db_name):
+        if db_name in self._db_docs:
+            return self._db_docs[db_name]
+        i = self._get_synthetic_index(db_name)
+        if i is None:
+            return None
+        return self._make_db_doc(db_name, i)
+
+    def _get_db_names(self):
+        with self._lock:
+            real = sorted(db_name for db_name in self._dbs if self._get_synthetic_index(db_name) is None)
+        # synthetic names are generated in order, so they can be merged in without building the whole list
+        return real, _SyntheticNames(self.n_dbs)
+
+    def _put_db_doc(self, db_name, doc):
+        existing = self._get_db_doc(db_name)
+        if existing is not None and doc.get('_rev') != existing['_rev']:
+            raise _FakeHTTPError(409, 'conflict', 'Document update conflict.')
+        if existing is None and db_name not in self._dbs:
+            self._dbs[db_name] = {'size': 0, 'active_size': 0, 'doc_count': 0, 'views': {}}
+        generation = int(existing['_rev'].split('-')[0]) + 1 if existing else 1
+        doc = dict(doc, _id=db_name, _rev='{}-{:08x}'.format(generation, _hash(generation, len(db_name))))
+        self._db_docs[db_name] = doc
+        self._record_dbs_change(db_name)
+        return {'ok': True, 'id': db_name, 'rev': doc['_rev']}
+
+    def _delete_db_doc(self, db_name, rev):
+        existing = self._get_db_doc(db_name)
+        if existing is None:
+            raise _FakeHTTPError(404, 'not_found', 'missing')
+        if self._get_synthetic_index(db_name) is not None:
+            raise _FakeHTTPError(405, 'method_not_allowed', 'Synthetic databases cannot be deleted')
+        if rev != existing['_rev']:
+            raise _FakeHTTPError(409, 'conflict', 'Document update conflict.')
+        del self._db_docs[db_name]
+        self._dbs.pop(db_name, None)
+        self._record_dbs_change(db_name)
+        return {'ok': True, 'id': db_name, 'rev': rev}
+
+    def _record_dbs_change(self, db_name):
+        # called with self._lock held
+        self._dbs_changes.append(db_name)
+        self._dbs_changed.notify_all()
+
+    def _dbs_changes_feed(self, query):
+        since = int(query.get('since', 0))
+        if query.get('feed') == 'longpoll' and since >= len(self._dbs_changes):
+            self._dbs_changed.wait(int(query.get('timeout', 60000)) / 1000.)
+        latest_seq_by_db_name = {}
+        for seq, db_name in enumerate(self._dbs_changes[since:], since + 1):
+            latest_seq_by_db_name[db_name] = seq
+        results = []
+        for db_name, seq in sorted(latest_seq_by_db_name.items(), key=lambda item: item[1]):
+            doc = self._db_docs.get(db_name)
+            if doc is None:
+                results.append({'seq': seq, 'id': db_name, 'changes': [], 'deleted': True})
+                continue
+            result = {'seq': seq, 'id': db_name, 'changes': [{'rev': doc['_rev']}]}
+            if query.get('include_docs') == 'true':
+                result['doc'] = doc
+            results.append(result)
+        return {'results': results, 'last_seq': len(self._dbs_changes)}
+
+    # Serving
+
+    def start(self):
+        handler = _make_handler(self)
+        for ip in self.node_ips:
+            server = _Server((ip, self.port), handler)
+            server.is_node_local_port = False
+            self.port = server.server_address[1]
+            self._servers.append(server)
+        if parse_version(self.couchdb_version) < (3, 0, 0):
+            for ip in self.node_ips:
+                server = _Server((ip, self.node_local_port), handler)
+                server.is_node_local_port = True
+                self.node_local_port = server.server_address[1]
+                self._servers.append(server)
+        else:
+            self.node_local_port = self.port
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.stopped = True
+        for thread in self._threads:
+            thread.join()
+        for server in self._servers:
+            server.server_close()
+        self._servers = []
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def get_config(self):
+        from .config import Config
+        config = Config(
+            control_node_ip=self.node_ips[0],
+            control_node_port=self.port,
+            control_node_local_port=self.node_local_port,
+            aliases={node: 'node{}'.format(i) for i, node in enumerate(self.nodes, 1)},
+        )
+        config.set_password(None)
+        return config
+
+    def reset_stats(self):
+        with self._lock:
+            self.request_count = 0
+            self.requests_by_endpoint = Counter()
+            self.peak_in_flight = self.in_flight
+
+    def _begin_request(self, path):
+        with self._lock:
+            self.request_count += 1
+            self.requests_by_endpoint[classify_endpoint(path)] += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            fail = self.error_rate and self._random.random() < self.error_rate
+            delay = self.latency * (0.5 + self._random.random()) if self.latency else 0
+        return fail, delay
+
+    def _end_request(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def handle(self, node_ip, is_node_local_port, method, path, query, body):
+        """
+        :return: tuple(status, json response)
+        """
+        parts = [unquote(part) for part in path.strip('/').split('/')] if path.strip('/') else []
+        if is_node_local_port:
+            return self._handle_node_local(node_ip, method, parts, query, body)
+        if parts[:2] == ['_node', '_local'] and parse_version(self.couchdb_version) >= (3, 0, 0):
+            return self._handle_node_local(node_ip, method, parts[2:], query, body)
+        return self._handle_clustered(method, parts, query, body)
+
+    def _handle_clustered(self, method, parts, query, body):
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': self.couchdb_version,
+                         'features': ['reshard'] if parse_version(self.couchdb_version) >= (3, 0, 0) else []}
+        first = parts[0]
+        if first == '_all_dbs':
+            return 200, self._all_dbs(query)
+        if first == '_membership':
+            return 200, {'all_nodes': self.nodes, 'cluster_nodes': self.nodes}
+        if first == '_active_tasks':
+            return 200, []
+        if first == '_dbs_info' and method == 'POST':
+            with self._lock:
+                return 200, [{'key': key, 'info': self._db_info(key)} if self._get_db(key) is not None
+                             else {'key': key, 'error': 'not_found'} for key in body['keys']]
+        if first == '_reshard':
+            return self._reshard(method, parts[1:], body)
+        with self._lock:
+            db = self._get_db(first)
+            if db is None:
+                raise _FakeHTTPError(404, 'not_found', 'Database does not exist.')
+            if len(parts) == 1 and method == 'GET':
+                return 200, self._db_info(first)
+            if parts[1:] == ['_all_docs']:
+                return 200, {'rows': [{'id': '_design/' + name, 'key': '_design/' + name, 'value': {'rev': '1-a'}}
+                                      for name in sorted(db['views'])]}
+            if parts[1:] == ['_compact'] and method == 'POST':
+                db['size'] = db['active_size']
+                self._dbs[first] = db
+                return 202, {'ok': True}
+            if len(parts) == 4 and parts[1] == '_design' and parts[3] == '_info':
+                if parts[2] not in db['views']:
+                    raise _FakeHTTPError(404, 'not_found', 'missing')
+                size = db['views'][parts[2]]
+                return 200, {'name': parts[2], 'view_index': {
+                    'signature': hashlib.md5('{}/{}'.format(first, parts[2]).encode('utf-8')).hexdigest(),
+                    'sizes': {'file': size, 'active': size // 2, 'external': size // 4},
+                }}
+        raise _FakeHTTPError(404, 'not_found', 'missing')
+
+    def _db_info(self, db_name):
+        db = self._get_db(db_name)
+        return {
+            'db_name': db_name,
+            'doc_count': db['doc_count'],
+            'doc_del_count': 0,
+            'update_seq': '{}-g1AAAA'.format(db['doc_count']),
+            'sizes': {'file': db['size'], 'active': db['active_size'], 'external': db['active_size'] // 2},
+            'compact_running': False,
+            'cluster': {'q': self.q, 'n': self.n},
+        }
+
+    def _all_dbs(self, query):
+        start_key = query.get('start_key', query.get('startkey'))
+        start_key = json.loads(start_key) if start_key is not None else None
+        limit = int(query['limit']) if 'limit' in query else None
+        skip = int(query.get('skip', 0))
+        real, synthetic = self._get_db_names()
+        page = []
+        real_i = bisect.bisect_left(real, start_key) if start_key is not None else 0
+        synthetic_i = synthetic.bisect_left(start_key) if start_key is not None else 0
+        while limit is None or len(page) < limit + skip:
+            next_real = real[real_i] if real_i < len(real) else None
+            next_synthetic = synthetic[synthetic_i] if synthetic_i < len(synthetic) else None
+            if next_real is None and next_synthetic is None:
+                break
+            if next_synthetic is None or (next_real is not None and next_real < next_synthetic):
+                page.append(next_real)
+                real_i += 1
+            else:
+                page.append(next_synthetic)
+                synthetic_i += 1
+        return page[skip:]
+
+    def _reshard(self, method, parts, body):
+        with self._lock:
+            if parts == ['jobs'] and method == 'POST':
+                doc = self._get_db_doc(body['db'])
+                if doc is None or body['range'] not in doc['by_range']:
+                    raise _FakeHTTPError(404, 'not_found', 'No such shard')
+                jobs = []
+                for node in doc['by_range'][body['range']]:
+                    job_id = '{:03d}-{}'.format(len(self.reshard_jobs), body['range'])
+                    self.reshard_jobs[job_id] = dict(body, node=node, job_state='completed')
+                    jobs.append({'ok': True, 'id': job_id, 'node': node, 'shard': body['range']})
+                self._split_range(body['db'], body['range'])
+                return 201, jobs
+            if len(parts) == 2 and parts[0] == 'jobs' and parts[1] in self.reshard_jobs:
+                return 200, self.reshard_jobs[parts[1]]
+        raise _FakeHTTPError(404, 'not_found', 'missing')
+
+    def _split_range(self, db_name, shard):
+        from .reshard import split_shard
+        doc = self._get_db_doc(db_name)
+        by_range = dict(doc['by_range'])
+        nodes = by_range.pop(shard)
+        for new_shard in split_shard(shard):
+            by_range[new_shard] = nodes
+        new_doc = self._make_db_doc(db_name, 0, by_range)
+        new_doc['_rev'] = doc['_rev']
+        new_doc['shard_suffix'] = doc['shard_suffix']
+        self._db_docs[db_name] = new_doc
+        if db_name not in self._dbs:
+            self._dbs[db_name] = self._get_db(db_name)
+
+    def _handle_node_local(self, node_ip, method, parts, query, body):
+        node = 'couchdb@{}'.format(node_ip)
+        with self._lock:
+            if parts == ['_dbs']:
+                return 200, {'db_name': '_dbs', 'doc_count': len(self._dbs) + self.n_dbs,
+                             'update_seq': len(self._dbs_changes)}
+            if parts == ['_dbs', '_changes']:
+                return 200, self._dbs_changes_feed(query)
+            if parts[:1] == ['_dbs'] and len(parts) == 2:
+                if parts[1] == '_all_docs' and method == 'POST':
+                    return 200, {'rows': [self._all_docs_row(key, 'include_docs' in query) for key in body['keys']]}
+                if parts[1] == '_bulk_docs':
+                    if method != 'POST':
+                        raise _FakeHTTPError(405, 'method_not_allowed', 'Only POST allowed')
+                    results = []
+                    for doc in body['docs']:
+                        try:
+                            results.append(self._put_db_doc(doc['_id'], doc))
+                        except _FakeHTTPError as e:
+                            results.append(dict(e.body, id=doc['_id']))
+                    return 201, results
+                db_name = parts[1]
+                if method == 'GET':
+                    doc = self._get_db_doc(db_name)
+                    if doc is None:
+                        raise _FakeHTTPError(404, 'not_found', 'missing')
+                    return 200, doc
+                if method == 'PUT':
+                    return 201, self._put_db_doc(db_name, body)
+                if method == 'DELETE':
+                    return 200, self._delete_db_doc(db_name, query.get('rev'))
+            if parts[:1] == ['_nodes'] and len(parts) == 2:
+                if method == 'PUT':
+                    if parts[1] not in self.nodes:
+                        self.nodes.append(parts[1])
+                    return 201, {'ok': True, 'id': parts[1], 'rev': '1-a'}
+                if parts[1] not in self.nodes:
+                    raise _FakeHTTPError(404, 'not_found', 'missing')
+                if method == 'GET':
+                    return 200, {'_id': parts[1], '_rev': '1-a'}
+                if method == 'DELETE':
+                    self.nodes.remove(parts[1])
+                    return 200, {'ok': True, 'id': parts[1], 'rev': '2-a'}
+            if len(parts) == 1 and parts[0].startswith('shards/'):
+                return 200, self._shard_info(node, parts[0])
+            if len(parts) in (2, 3) and parts[0].startswith('shards/') and parts[1] == '_compact' \
+                    and method == 'POST':
+                self._shard_info(node, parts[0])
+                if len(parts) == 2:
+                    # compacting any copy compacts them all, which is close enough here
+                    db_name = self._get_shard_db_name(parts[0])
+                    db = self._get_db(db_name)
+                    db['size'] = db['active_size']
+                    self._dbs[db_name] = db
+                return 202, {'ok': True}
+        raise _FakeHTTPError(404, 'not_found', 'missing')
+
+    def _all_docs_row(self, db_name, include_docs):
+        doc = self._get_db_doc(db_name)
+        if doc is None:
+            return {'key': db_name, 'error': 'not_found'}
+        row = {'id': db_name, 'key': db_name, 'value': {'rev': doc['_rev']}}
+        if include_docs:
+            row['doc'] = doc
+        return row
+
+    def _get_shard_db_name(self, shard_file):
+        _, shard, db_name_and_suffix = shard_file.split('/', 2)
+        return db_name_and_suffix.rsplit('.', 1)[0]
+
+    def _shard_info(self, node, shard_file):
+        shard = shard_file.split('/')[1]
+        db_name = self._get_shard_db_name(shard_file)
+        doc = self._get_db_doc(db_name)
+        if doc is None or node not in doc['by_range'].get(shard, []):
+            raise _FakeHTTPError(404, 'not_found', 'missing')
+        info = self._db_info(db_name)
+        q = len(doc['by_range'])
+        doc_count = info['doc_count'] // q
+        sizes = {key: size // q for key, size in info['sizes'].items()}
+        return dict(info, db_name=shard_file, doc_count=doc_count, update_seq=doc_count, sizes=sizes)
+
+
+class _SyntheticNames(object):
+    """
+    The sorted names of the synthetic databases, as a lazy sequence
+    """
+    def __init__(self, n_dbs):
+        self.n_dbs = n_dbs
+
+    def __len__(self):
+        return self.n_dbs
+
+    def __getitem__(self, i):
+        return SYNTHETIC_DB_NAME.format(i)
+
+    def bisect_left(self, key):
+        return bisect.bisect_left(self, key, 0, self.n_dbs)
+
+
+def _make_handler(cluster):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately; don't let Nagle's algorithm hold the body back
+        disable_nagle_algorithm = True
+
+        def _handle(self):
+            url = urlsplit(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            fail, delay = cluster._begin_request(url.path)
+            try:
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    status, response = cluster.error_status, {'error': 'injected', 'reason': 'Injected error'}
+                else:
+                    try:
+                        status, response = cluster.handle(
+                            self.server.server_address[0], self.server.is_node_local_port,
+                            self.command, url.path, query, body)
+                    except _FakeHTTPError as e:
+                        status, response = e.status, e.body
+            finally:
+                cluster._end_request()
+            data = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Serve a fake CouchDB cluster on 127.0.0.1-127.0.0.<nodes>')
+    parser.add_argument('--nodes', dest='n_nodes', type=int, default=3)
+    parser.add_argument('--dbs', dest='n_dbs', type=int, default=1000)
+    parser.add_argument('--q', dest='q', type=int, default=8)
+    parser.add_argument('--n', dest='n', type=int, default=3)
+    parser.add_argument('--couchdb-version', dest='couchdb_version', default='3.1.1')
+    parser.add_argument('--port', dest='port', type=int, default=15984)
+    parser.add_argument('--node-local-port', dest='node_local_port', type=int, default=15986)
+    parser.add_argument('--latency', dest='latency', type=float, default=0,
+                        help=u'Average seconds to wait before answering each request')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                        help=u'Fraction of requests to fail with a 503')
+    args = parser.parse_args()
+
+    cluster = FakeCluster(
+        n_nodes=args.n_nodes, n_dbs=args.n_dbs, q=args.q, n=args.n, couchdb_version=args.couchdb_version,
+        latency=args.latency, error_rate=args.error_rate, port=args.port, node_local_port=args.node_local_port,
+    ).start()
+    print(u'Serving {} databases on {} nodes at {}:{} (node-local port {}). Ctrl-C to stop.'.format(
+        args.n_dbs, args.n_nodes, u','.join(cluster.node_ips), cluster.port, cluster.node_local_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cluster.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,27 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import argparse
+import hashlib
 import itertools
+import mmap
+import os
+import sys
 from collections import defaultdict, namedtuple
 import json
 
-from .utils import get_config_from_args, get_shard_allocation, set_up_parser
+from .cluster_state import get_cluster_state
+from .utils import get_config_from_args, set_up_parser
 from .describe import print_shard_table
-from .doc_models import ShardAllocationDoc
 
 
 Nodefile = namedtuple('Nodefile', 'db_name, node, shard, filename')
+FileMismatch = namedtuple('FileMismatch', 'filename, problem')
+
+HASH_CHUNK_SIZE = 16 * 1024 ** 2
 
 
 def read_plan_file(filename):
+    from .doc_models import ShardAllocationDoc
     with open(filename) as f:
         plan = json.load(f)
 
@@ -76,7 +84,7 @@ def figure_out_what_you_can_and_cannot_delete(plan, shard_suffix_by_db_name=None
 
 
 def assemble_shard_allocations_from_plan(config, plan):
-    shard_allocation_docs = [get_shard_allocation(config, db_name) for db_name in plan]
+    shard_allocation_docs = get_cluster_state(config).get_shard_allocations(plan)
     update_shard_allocation_docs_from_plan(shard_allocation_docs, plan)
     return shard_allocation_docs
 
@@ -90,9 +98,9 @@ def show_plan(config, plan):
 
 def _get_shard_suffixes(config, plan):
     shard_suffix_by_db_name = {}
-    for db_name, plan_allocation_doc in plan.items():
-        cluster_allocation_doc = get_shard_allocation(config, db_name)
-
+    for cluster_allocation_doc in get_cluster_state(config).get_shard_allocations(sorted(plan)):
+        db_name = cluster_allocation_doc.db_name
+        plan_allocation_doc = plan[db_name]
         if plan_allocation_doc.shard_suffix:
             assert cluster_allocation_doc.shard_suffix == plan_allocation_doc.shard_suffix
 
@@ -101,8 +109,9 @@ def _get_shard_suffixes(config, plan):
     return shard_suffix_by_db_name
 
 
-def get_missing_files_by_node_and_source(config, plan):
+def get_missing_files_by_node_and_source(config, plan, important_files_by_node=None):
     """
+    :param important_files_by_node: as from get_node_files, if it's already been called
     :return: Lists of ``Nodefile`` tuples representing files that are missing from the node
              grouped by target node and source node:
              {
@@ -112,22 +121,27 @@ def get_missing_files_by_node_and_source(config, plan):
              }
     """
     missing_files = defaultdict(lambda: defaultdict(list))
-    important_files_by_node, _ = get_node_files(config, plan)
-    important_files = itertools.chain(*list(important_files_by_node.values()))
-    for db_name, db_files in itertools.groupby(important_files, key=lambda f: f.db_name):
-        cluster_allocation_doc = get_shard_allocation(config, db_name)
-        for file in db_files:
-            if file.shard not in cluster_allocation_doc.by_node.get(file.node, {}):
-                source = cluster_allocation_doc.by_range[file.shard][0]
-                missing_files[file.node][source].append(file)
+    if important_files_by_node is None:
+        important_files_by_node, _ = get_node_files(config, plan)
+    important_files = sorted(itertools.chain(*list(important_files_by_node.values())))
+    cluster_allocation_docs = {
+        cluster_allocation_doc.db_name: cluster_allocation_doc
+        for cluster_allocation_doc in get_cluster_state(config).get_shard_allocations(
+            sorted({file.db_name for file in important_files}))
+    }
+    for file in important_files:
+        cluster_allocation_doc = cluster_allocation_docs[file.db_name]
+        if file.shard not in cluster_allocation_doc.by_node.get(file.node, {}):
+            source = cluster_allocation_doc.by_range[file.shard][0]
+            missing_files[file.node][source].append(file)
 
     return missing_files
 
 
 def run_plan_prune(config, plan, node):
     _, deletable_files_by_node = get_node_files(config, plan)
-    for file in sorted(deletable_files_by_node[node], key=lambda f: f.filename):
-        print(file.filename)
+    for filename in sorted(deletable_files_by_node[node]):
+        print(filename)
 
 
 def run_important_plan(config, plan, node):
@@ -140,22 +154,258 @@ def get_node_files(config, plan):
     return figure_out_what_you_can_and_cannot_delete(plan, _get_shard_suffixes(config, plan))
 
 
+def write_node_manifests(config, plan, output_dir, workers=4):
+    """
+    Write the important, prune and missing lists of every node from one pass over the plan,
+    `workers` files at a time
+
+    For each node, the output directory gets `important.<node>.txt` and `prune.<node>.txt`,
+    the lists `important` and `prune` give for it, and `missing.<node>.txt`,
+    the files it doesn't have yet, each after the node to copy it from and a tab.
+    A node that holds copies now but none in the plan gets a prune list of every file.
+
+    :return: list of the files written
+    """
+    from gevent.threadpool import ThreadPool
+    important_files_by_node, deletable_files_by_node = get_node_files(config, plan)
+    missing_files_by_node_and_source = get_missing_files_by_node_and_source(config, plan, important_files_by_node)
+    all_filenames = {file.filename for files in important_files_by_node.values() for file in files}
+    for shard_allocation_doc in get_cluster_state(config).get_shard_allocations(sorted(plan)):
+        for node in shard_allocation_doc.by_node:
+            deletable_files_by_node.setdefault(node, all_filenames)
+
+    def _get_lines(kind, node):
+        if kind == 'important':
+            return {file.filename for file in important_files_by_node.get(node, ())}
+        if kind == 'prune':
+            return deletable_files_by_node.get(node, ())
+        return {u'{}\t{}'.format(config.format_node_name(source), file.filename)
+                for source, files in missing_files_by_node_and_source.get(node, {}).items() for file in files}
+
+    def _write(manifest):
+        kind, node = manifest
+        manifest_file = os.path.join(output_dir, u'{}.{}.txt'.format(kind, config.format_node_name(node)))
+        with open(manifest_file, 'w') as f:
+            for line in sorted(_get_lines(kind, node)):
+                f.write(u'{}\n'.format(line))
+        return manifest_file
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifests = [(kind, node) for node in sorted(set(important_files_by_node) | set(deletable_files_by_node))
+                 for kind in ('important', 'prune', 'missing')]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(_write, manifests)
+    finally:
+        pool.kill()
+
+
+def get_plan_digest(plan):
+    """
+    Fingerprint of the allocation a plan asks for, to tie a verification report to the plan it checked
+    """
+    by_range_by_db_name = {db_name: {shard: sorted(nodes) for shard, nodes in doc.by_range.items()}
+                           for db_name, doc in plan.items()}
+    return hashlib.sha1(json.dumps(by_range_by_db_name, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hash_file(path, length=None, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Hash the first `length` bytes of a file (all of it by default), reading it memory-mapped in chunks
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        length = size if length is None else min(length, size)
+        if length:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                for start in range(0, length, chunk_size):
+                    digest.update(view[start:min(start + chunk_size, length)])
+            finally:
+                view.release()
+                mapped.close()
+    return digest.hexdigest()
+
+
+def _list_files(root, filename):
+    """
+    :return: paths relative to root of filename if it's a file, or every file under it if it's a directory
+    """
+    path = os.path.join(root, filename)
+    if not os.path.isdir(path):
+        return [filename]
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, name), root)
+        for dirpath, _, names in os.walk(path) for name in names
+    )
+
+
+def verify_file(data_dir, source_dir, filename, allow_partial=False):
+    """
+    Check that the copy of a file under data_dir matches the one under source_dir
+
+    The copy has to be the same size as the source, so that an empty or cut-off copy
+    doesn't pass. With allow_partial, a copy smaller than the source (but not empty) is good
+    as long as it matches the start of the source: CouchDB only ever appends to database
+    and view files, so this is a copy taken while the source was still being written to,
+    and internal replication brings it up to date.
+
+    :return: a problem description, or None if the copy is good
+    """
+    target_path = os.path.join(data_dir, filename)
+    source_path = os.path.join(source_dir, filename)
+    if not os.path.exists(source_path):
+        return u'missing from source'
+    if not os.path.exists(target_path):
+        return u'missing'
+    target_size = os.path.getsize(target_path)
+    source_size = os.path.getsize(source_path)
+    if target_size > source_size:
+        return u'{} bytes, larger than the source ({} bytes)'.format(target_size, source_size)
+    if target_size < source_size and not (allow_partial and target_size):
+        return u'{} bytes, smaller than the source ({} bytes)'.format(target_size, source_size)
+    if hash_file(target_path) != hash_file(source_path, length=target_size):
+        return u'contents differ from the source'
+    return None
+
+
+def verify_node_files(files, data_dir, source_dir_by_file, workers=4, allow_partial=False):
+    """
+    Compare every file (or every file in every directory) in `files` with its source, in parallel
+
+    Hashing runs in real threads (hashlib releases the GIL), even when gevent has patched threading.
+
+    :param files: list of Nodefile
+    :param source_dir_by_file: dict of Nodefile->the source node's data directory
+    :return: list of FileMismatch
+    """
+    from gevent.threadpool import ThreadPool
+    checks = []
+    for file in files:
+        source_dir = source_dir_by_file[file]
+        filenames = set(_list_files(data_dir, file.filename)) | set(_list_files(source_dir, file.filename))
+        checks.extend((source_dir, filename) for filename in sorted(filenames))
+
+    pool = ThreadPool(workers)
+    try:
+        problems = pool.map(lambda check: verify_file(data_dir, check[0], check[1], allow_partial), checks)
+    finally:
+        pool.kill()
+    return [FileMismatch(filename, problem)
+            for (_, filename), problem in zip(checks, problems) if problem is not None]
+
+
+def run_verify(config, plan, node, data_dir, source_dir, workers=4, report_file=None, allow_partial=False):
+    """
+    Verify the files node is missing in the current allocation against their sources
+
+    :param source_dir: data directory of the source node, with "{source}" standing in for its name
+                       if the files come from more than one node
+    :return: True if every file matches
+    """
+    files_by_source = get_missing_files_by_node_and_source(config, plan).get(node, {})
+    source_dir_by_file = {
+        file: source_dir.format(source=config.format_node_name(source))
+        for source, files in files_by_source.items() for file in files
+    }
+    mismatches = verify_node_files(sorted(source_dir_by_file), data_dir, source_dir_by_file, workers, allow_partial)
+    for mismatch in mismatches:
+        print(u'{}\t{}'.format(mismatch.filename, mismatch.problem))
+    print(u'{}: {} files to check, {} mismatched'.format(
+        config.format_node_name(node), len(source_dir_by_file), len(mismatches)))
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump({
+                'node': node,
+                'plan_digest': get_plan_digest(plan),
+                'ok': not mismatches,
+                'mismatches': [mismatch._asdict() for mismatch in mismatches],
+            }, f, indent=2)
+    return not mismatches
+
+
+def check_verification_reports(plan, report_files):
+    """
+    Make sure every verification report passed, for this plan
+
+    :return: list of the nodes the reports cover
+    """
+    plan_digest = get_plan_digest(plan)
+    nodes = []
+    for report_file in report_files:
+        with open(report_file) as f:
+            report = json.load(f)
+        if report['plan_digest'] != plan_digest:
+            raise Exception('{} verified a different plan'.format(report_file))
+        if not report['ok']:
+            raise Exception('{} found {} mismatched files on {}'.format(
+                report_file, len(report['mismatches']), report['node']))
+        nodes.append(report['node'])
+    return nodes
+
+
 def main():
     parser = argparse.ArgumentParser(description=u'Helper for various manual database file operations')
     subparsers = parser.add_subparsers(dest='command')
-    subparser_list = [subparsers.add_parser(
+    manifest_parsers = [subparsers.add_parser(
         'prune',
         help=u"List files that can be safely removed. "
              u"(May list files that do not exist on the machine.)"
-    ), subparsers.add_parser(
-        'show-plan',
-        help=u"Just print the shard allocation table"
     ), subparsers.add_parser(
         'important',
         help=u"List files that must be present and up to date on a node "
              u"before it is safe to commit the plan. "
              u"(May list files that already exist on the node.)"
     )]
+    for manifest_parser in manifest_parsers:
+        set_up_parser(manifest_parser)
+        node_group = manifest_parser.add_mutually_exclusive_group(required=True)
+        node_group.add_argument(
+            '--node', dest='node',
+            help=u'Which node to make suggestions for.')
+        node_group.add_argument(
+            '--all-nodes', dest='all_nodes', action='store_true',
+            help=u'Write the important, prune and missing lists of every node to --output-dir instead')
+        manifest_parser.add_argument(
+            '--output-dir', dest='output_dir', default='.',
+            help=u'Where --all-nodes writes its lists. Default: the current directory')
+        manifest_parser.add_argument(
+            '--workers', dest='workers', type=int, default=4,
+            help=u"How many lists --all-nodes writes at once. Default: 4")
+        manifest_parser.add_argument(
+            '--from-plan', dest='plan_file', required=True,
+            help=u'Get target shard allocation from plan file.')
+    subparser_list = [subparsers.add_parser(
+        'show-plan',
+        help=u"Just print the shard allocation table"
+    )]
+    verify_parser = subparsers.add_parser(
+        'verify',
+        help=u"Check that the files copied to a node for the plan match their sources. "
+             u"Exits with an error if any don't."
+    )
+    verify_parser.add_argument(
+        '--data-dir', dest='data_dir', required=True,
+        help=u"This node's CouchDB data directory")
+    verify_parser.add_argument(
+        '--source-dir', dest='source_dir', required=True,
+        help=u"The source node's data directory (e.g. mounted over the network), "
+             u"with {source} in place of the source node's name if there is more than one, "
+             u"like /mnt/{source}/data")
+    verify_parser.add_argument(
+        '--workers', dest='workers', type=int, default=4,
+        help=u"How many files to hash at once. Default: 4")
+    verify_parser.add_argument(
+        '--report', dest='report_file',
+        help=u"Save the result to this file, for suggest-shard-allocation --require-verified")
+    verify_parser.add_argument(
+        '--allow-partial', dest='allow_partial', action='store_true',
+        help=u"Pass copies that are smaller than their source but match its start, "
+             u"e.g. when the source is still being written to")
+    subparser_list.append(verify_parser)
     for subparser in subparser_list:
         set_up_parser(subparser)
         subparser.add_argument(
@@ -172,12 +422,22 @@ def main():
     if args.command == 'show-plan':
         show_plan(config, plan)
 
-    if args.command == 'prune':
+    if args.command in ('prune', 'important') and args.all_nodes:
+        manifest_files = write_node_manifests(config, plan, args.output_dir, args.workers)
+        print(u'Wrote {} lists to {}'.format(len(manifest_files), args.output_dir))
+
+    elif args.command == 'prune':
         run_plan_prune(config, plan, config.get_formal_node_name(args.node))
 
-    if args.command == 'important':
+    elif args.command == 'important':
         run_important_plan(config, plan, config.get_formal_node_name(args.node))
 
+    if args.command == 'verify':
+        ok = run_verify(config, plan, config.get_formal_node_name(args.node), args.data_dir, args.source_dir,
+                        args.workers, args.report_file, args.allow_partial)
+        if not ok:
+            sys.exit(1)
+
 
 if __name__ == '__main__':
     from gevent import monkey; monkey.patch_all()
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+from .balancer import add_balancer_arguments, set_up_read_balancer
+from .cluster_state import get_cluster_state
+from .instrumentation import add_profile_arguments, set_up_profiling
+from .retry import add_retry_arguments, set_up_retries
+from .utils import (
+    get_password,
+    humansize,
+    indent,
+    iter_db_pages,
+    read_config_file,
+)
+
+ClusterSummary = namedtuple('ClusterSummary', 'name config n_dbs size size_by_node error')
+
+
+def get_imbalance(size_by_node, capacity_by_node=None):
+    """
+    How much fuller the fullest node is than the cluster as a whole: 0 is perfectly even, 1 is twice as full
+
+    :param capacity_by_node: how much each node can hold, as in the config's capacities;
+                             by default all nodes are equal
+    """
+    nodes = list(size_by_node)
+    if capacity_by_node is None:
+        capacity_by_node = {node: 1 for node in nodes}
+    total_size = sum(size_by_node.values())
+    if not nodes or not total_size:
+        return 0
+    fill = total_size / sum(capacity_by_node[node] for node in nodes)
+    return max(size_by_node[node] / capacity_by_node[node] for node in nodes) / fill - 1
+
+
+def get_capacity_by_node(config, nodes):
+    """
+    :return: dict of node->capacity from the config, or None if it has none
+    """
+    capacities = config.get_capacities(nodes)
+    return dict(zip(nodes, capacities)) if capacities else None
+
+
+def crawl_cluster(name, config, concurrency=4, size_metric='file'):
+    """
+    Count the databases of a cluster and how much data each node holds,
+    with at most `concurrency` pages of databases being fetched at once
+
+    Each page takes two bulk requests (shard maps and sizes). View indexes aren't included,
+    since getting their sizes takes requests per database.
+
+    :return: ClusterSummary
+    """
+    import gevent.pool
+    node_details = config.get_control_node()
+    cluster_state = get_cluster_state(config)
+    size_by_node = {node: 0 for node in cluster_state.get_membership().cluster_nodes}
+    totals = {'n_dbs': 0, 'size': 0}
+
+    def _crawl_page(page):
+        metadata_by_db_name = cluster_state.get_dbs_metadata(page)
+        for shard_allocation_doc in cluster_state.get_shard_allocations(page):
+            if shard_allocation_doc.db_name not in metadata_by_db_name:
+                # deleted since it was listed
+                continue
+            size = metadata_by_db_name[shard_allocation_doc.db_name]['sizes'][size_metric]
+            totals['size'] += size
+            shard_size = 1.0 * size / len(shard_allocation_doc.by_range)
+            for shard, nodes in shard_allocation_doc.by_range.items():
+                for node in nodes:
+                    size_by_node[node] = size_by_node.get(node, 0) + shard_size
+
+    pool = gevent.pool.Pool(concurrency)
+    for page in iter_db_pages(node_details):
+        totals['n_dbs'] += len(page)
+        pool.spawn(_crawl_page, page)
+    pool.join(raise_error=True)
+    return ClusterSummary(name, config, totals['n_dbs'], totals['size'], size_by_node, None)
+
+
+def crawl_fleet(configs_by_name, concurrency=4, size_metric='file'):
+    """
+    Crawl every cluster at once; a cluster that fails is reported with its error instead of stopping the rest
+
+    :return: list of ClusterSummary, in the order of configs_by_name
+    """
+    import gevent
+
+    def _crawl(name, config):
+        try:
+            return crawl_cluster(name, config, concurrency, size_metric)
+        except Exception as e:
+            return ClusterSummary(name, config, None, None, {}, e)
+
+    jobs = [gevent.spawn(_crawl, name, config) for name, config in configs_by_name]
+    gevent.joinall(jobs)
+    return [job.value for job in jobs]
+
+
+def print_fleet(summaries, show_nodes=False):
+    row = u"{: <20}\t{: >6}\t{: >10}\t{: >12}\t{: >12}\t{: >12}\t{: >10}"
+    print(row.format(u"Cluster", u"Nodes", u"Databases", u"Data", u"Fullest", u"Emptiest", u"Imbalance"))
+    for summary in summaries:
+        if summary.error:
+            print(u'{: <20}\tfailed: {!r}'.format(summary.name, summary.error))
+            continue
+        sizes = sorted(summary.size_by_node.values()) or [0]
+        print(row.format(
+            summary.name, len(summary.size_by_node), summary.n_dbs, humansize(summary.size),
+            humansize(sizes[-1]), humansize(sizes[0]),
+            u'{:.0%}'.format(get_imbalance(
+                summary.size_by_node, get_capacity_by_node(summary.config, list(summary.size_by_node)))),
+        ))
+        if show_nodes:
+            for node, size in sorted(summary.size_by_node.items()):
+                print(indent(u'{: <20}\t{: >12}'.format(summary.config.format_node_name(node), humansize(size))))
+
+
+def main():
+    from .suggest_shard_allocation import add_size_metric_argument
+    parser = argparse.ArgumentParser(description=u'Describe several clusters at once')
+    parser.add_argument('--conf', dest='conf', nargs='+', required=True,
+                        help=u'Config file of each cluster; clusters are named after their file')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=4,
+                        help=u'How many pages of databases to fetch at once from each cluster. Default: 4')
+    parser.add_argument('--nodes', dest='show_nodes', action='store_true',
+                        help=u'Also show how much data each node holds')
+    add_size_metric_argument(parser)
+    add_retry_arguments(parser)
+    add_balancer_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    set_up_profiling(args)
+    set_up_retries(args)
+    configs_by_name = []
+    for conf in args.conf:
+        config = read_config_file(conf)
+        config.set_password(get_password(config))
+        # each cluster's reads are spread over its own nodes
+        set_up_read_balancer(args, config)
+        configs_by_name.append((os.path.splitext(os.path.basename(conf))[0], config))
+
+    summaries = crawl_fleet(configs_by_name, args.concurrency, args.size_metric)
+    print_fleet(summaries, args.show_nodes)
+    if any(summary.error for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
@@ -0,0 +1,252 @@
+from __future__ import absolute_import
+import atexit
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_instruments = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def add_instrument(instrument):
+    """
+    Register an Instrument to receive every request made through utils._do_request and every timed phase
+
+    While no instrument is registered, recording is a no-op.
+    """
+    _instruments.append(instrument)
+
+
+def remove_instrument(instrument):
+    _instruments.remove(instrument)
+
+
+def classify_endpoint(path):
+    """
+    Group request paths into endpoint classes, e.g. all /<db>/_design/<ddoc>/_info requests together
+    """
+    path = path.lstrip('/')
+    if path.startswith('_node/_local/'):
+        path = path[len('_node/_local/'):]
+    path = path.split('?')[0]
+    parts = path.split('/')
+    first = parts[0]
+    if not first:
+        return 'root'
+    if first.startswith('_'):
+        return first
+    if first.startswith('shards%2F'):
+        return 'shard info' if len(parts) == 1 else 'shard other'
+    if len(parts) == 1:
+        return 'db info'
+    if parts[1] == '_design' and parts[-1] == '_info':
+        return '_design/*/_info'
+    return 'db {}'.format(parts[1])
+
+
+def record_request(method, path, seconds, bytes_sent=0, bytes_received=0, retries=0, error=None):
+    if not _instruments:
+        return
+    endpoint = classify_endpoint(path)
+    for instrument in _instruments:
+        instrument.on_request(endpoint, method.lower(), seconds, bytes_sent, bytes_received, retries, error)
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block of code and report it to the registered instruments as a named phase
+    """
+    if not _instruments:
+        yield
+        return
+    for instrument in _instruments:
+        instrument.on_phase_start(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for instrument in _instruments:
+            instrument.on_phase_end(name, seconds)
+
+
+class Instrument(object):
+    """
+    Base class for instruments; override the hooks you are interested in
+    """
+    def on_request(self, endpoint, method, seconds, bytes_sent, bytes_received, retries, error):
+        pass
+
+    def on_phase_start(self, name):
+        pass
+
+    def on_phase_end(self, name, seconds):
+        pass
+
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'seconds': self.seconds,
+            'latency_histogram': dict(zip(
+                [str(le) for le in LATENCY_BUCKETS] + ['+Inf'], self.bucket_counts)),
+        }
+
+
+class _PhaseStats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.memory_peak = None
+
+    def to_json(self):
+        return {'count': self.count, 'seconds': self.seconds, 'memory_peak': self.memory_peak}
+
+
+class Profiler(Instrument):
+    """
+    Record latency histograms, bytes, retries and errors per endpoint class, and timings per phase
+
+    With trace_memory=True, tracemalloc is started and each phase also records its peak traced memory.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.endpoints = defaultdict(_EndpointStats)
+        self.phases = defaultdict(_PhaseStats)
+        self._lock = threading.Lock()
+        # name -> [peak memory seen so far, how many phases of that name are open];
+        # keyed by name rather than kept as a stack since phases can overlap in different greenlets
+        self._open_phase_peaks = {}
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def on_request(self, endpoint, method, seconds, bytes_sent, bytes_received, retries, error):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.count += 1
+            stats.seconds += seconds
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.retries += retries
+            if error is not None:
+                stats.errors += 1
+            stats.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def _fold_memory_peak(self):
+        import tracemalloc
+        _, peak = tracemalloc.get_traced_memory()
+        for open_phase in self._open_phase_peaks.values():
+            open_phase[0] = max(open_phase[0], peak)
+        tracemalloc.reset_peak()
+
+    def on_phase_start(self, name):
+        if self.trace_memory:
+            with self._lock:
+                self._fold_memory_peak()
+                self._open_phase_peaks.setdefault(name, [0, 0])[1] += 1
+
+    def on_phase_end(self, name, seconds):
+        with self._lock:
+            stats = self.phases[name]
+            stats.count += 1
+            stats.seconds += seconds
+            if self.trace_memory:
+                self._fold_memory_peak()
+                open_phase = self._open_phase_peaks[name]
+                stats.memory_peak = max(stats.memory_peak or 0, open_phase[0])
+                open_phase[1] -= 1
+                if not open_phase[1]:
+                    del self._open_phase_peaks[name]
+
+    def to_json(self):
+        return {
+            'endpoints': {endpoint: stats.to_json() for endpoint, stats in sorted(self.endpoints.items())},
+            'phases': {name: stats.to_json() for name, stats in sorted(self.phases.items())},
+        }
+
+    def to_prometheus(self, prefix='couchdb_cluster_admin'):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+                lines.append('{}_{}{}{{{}}} {}'.format(prefix, name, suffix, label_text, value))
+
+        endpoints = sorted(self.endpoints.items())
+        histogram_samples = []
+        for endpoint, stats in endpoints:
+            cumulative = 0
+            for le, bucket_count in zip([str(le) for le in LATENCY_BUCKETS] + ['+Inf'], stats.bucket_counts):
+                cumulative += bucket_count
+                histogram_samples.append(('_bucket', [('endpoint', endpoint), ('le', le)], cumulative))
+            histogram_samples.append(('_sum', [('endpoint', endpoint)], stats.seconds))
+            histogram_samples.append(('_count', [('endpoint', endpoint)], stats.count))
+        metric('request_duration_seconds', 'histogram', 'Request latency by endpoint class.', histogram_samples)
+        for attr, help_text in [('bytes_sent', 'Request body bytes sent.'),
+                                ('bytes_received', 'Response body bytes received.'),
+                                ('retries', 'Requests retried.'),
+                                ('errors', 'Requests that failed.')]:
+            metric('request_{}_total'.format(attr), 'counter', help_text,
+                   [('', [('endpoint', endpoint)], getattr(stats, attr)) for endpoint, stats in endpoints])
+
+        phases = sorted(self.phases.items())
+        metric('phase_duration_seconds_total', 'counter', 'Time spent in each phase.',
+               [('', [('phase', name)], stats.seconds) for name, stats in phases])
+        metric('phase_calls_total', 'counter', 'Number of times each phase ran.',
+               [('', [('phase', name)], stats.count) for name, stats in phases])
+        if self.trace_memory:
+            metric('phase_memory_peak_bytes', 'gauge', 'Peak traced memory during each phase.',
+                   [('', [('phase', name)], stats.memory_peak) for name, stats in phases])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Write the profile to filename, in Prometheus textfile format if it ends in .prom, otherwise as JSON
+        """
+        with open(filename, 'w') as f:
+            if filename.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', dest='profile',
+                        help='Write request and phase timings to this file when the command exits '
+                             '(Prometheus textfile format if it ends in .prom, otherwise JSON)')
+    parser.add_argument('--profile-memory', dest='profile_memory', action='store_true',
+                        help='Also record peak memory per phase with tracemalloc (slow)')
+
+
+def set_up_profiling(args):
+    """
+    Start a Profiler if --profile was given, and write it out when the process exits
+    """
+    if not getattr(args, 'profile', None):
+        return None
+    profiler = Profiler(trace_memory=args.profile_memory)
+    add_instrument(profiler)
+    atexit.register(profiler.write, args.profile)
+    return profiler
@@ -0,0 +1,180 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import copy
+import json
+import os
+import time
+
+from .utils import do_node_local_request, get_db_docs
+
+
+class Journal(object):
+    """
+    Append-only record, one JSON object per line, of the databases a long-running command has finished
+
+    The first line says which command (and with which parameters) the journal belongs to;
+    every other line is a database that was done, with its _dbs doc from before the change
+    so that the change can be undone, or a database whose change was undone.
+
+    Every line is flushed as soon as it's written, so nothing is lost if the command dies.
+    fsync is only called every `sync_every` lines or `sync_interval` seconds, so a crash
+    of the whole machine can lose the last few lines; since every command checks a database
+    before changing it, resuming just finds those databases already done and records them again
+    (though without a doc to undo them to).
+
+    With no filename, the journal is only kept in memory.
+    """
+    def __init__(self, filename, command, params=None, sync_every=100, sync_interval=1.0):
+        self.filename = filename
+        self.header = {'command': command, 'params': params or {}}
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.entries = []
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+        if filename is None:
+            return
+        if os.path.exists(filename):
+            header, self.entries = read_journal_file(filename)
+            if header != self.header:
+                raise Exception('{} is the journal of a different run: {}'.format(filename, json.dumps(header)))
+        self._file = open(filename, 'a')
+        if not os.path.getsize(filename):
+            self._write(self.header)
+            self.sync()
+
+    def _write(self, obj):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(obj) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _append(self, entry):
+        self.entries.append(entry)
+        self._write(entry)
+
+    def record_done(self, db_name, changed=True, before=None):
+        """
+        :param changed: whether anything was changed; databases that needed nothing are recorded
+                        so that resuming skips them too, but there's nothing to undo
+        :param before: the database's _dbs doc before the change, or None if the change created it
+        """
+        self._append({'db_name': db_name, 'action': 'done', 'changed': changed, 'before': before})
+
+    def record_undone(self, db_name):
+        self._append({'db_name': db_name, 'action': 'undone'})
+
+    def get_done(self):
+        """
+        :return: set of db names that are done, and not undone since
+        """
+        done = set()
+        for entry in self.entries:
+            if entry['action'] == 'done':
+                done.add(entry['db_name'])
+            else:
+                done.discard(entry['db_name'])
+        return done
+
+    def get_changes_to_undo(self):
+        """
+        :return: for each database changed and not undone since, the entry of its first change
+                 (whose doc is the one from before the run), most recent first
+        """
+        first_change_by_db_name = {}
+        for i, entry in enumerate(self.entries):
+            if entry['action'] == 'undone':
+                first_change_by_db_name.pop(entry['db_name'], None)
+            elif entry['changed']:
+                first_change_by_db_name.setdefault(entry['db_name'], (i, entry))
+        return [entry for _, entry in sorted(first_change_by_db_name.values(), key=lambda item: item[0], reverse=True)]
+
+
+def read_journal_file(filename):
+    """
+    :return: tuple(header, entries)
+
+    A last line without a newline was cut off mid-write, and is dropped (and truncated from the file,
+    so that new lines don't get appended to it).
+    """
+    with open(filename, 'rb+') as f:
+        content = f.read()
+        complete = content[:content.rfind(b'\n') + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+    lines = [json.loads(line) for line in complete.decode('utf-8').splitlines() if line.strip()]
+    if not lines:
+        raise Exception('{} is empty; remove it to start again'.format(filename))
+    return lines[0], lines[1:]
+
+
+def undo_journal(node_details, journal):
+    """
+    Put back the _dbs doc of every database the journal changed, most recent change first,
+    and record each one as undone
+
+    Databases the change created are deleted from _dbs again (their shard files are left on disk).
+    """
+    for entry in journal.get_changes_to_undo():
+        db_name = entry['db_name']
+        current = get_db_docs(node_details, [db_name]).get(db_name)
+        path = '_dbs/{}'.format(db_name)
+        if entry['before'] is None:
+            if current is not None:
+                print('  Removing {}'.format(db_name))
+                do_node_local_request(node_details, path, method='delete', params={'rev': current['_rev']})
+        else:
+            print('  Restoring db config for {}'.format(db_name))
+            restored = copy.deepcopy(entry['before'])
+            restored.pop('_rev', None)
+            if current is not None:
+                restored['_rev'] = current['_rev']
+            do_node_local_request(node_details, path, method='put', json=restored)
+        journal.record_undone(db_name)
+
+
+def add_journal_arguments(parser):
+    parser.add_argument('--journal', dest='journal',
+                        help=u'Record each database in this file as soon as it is done, '
+                             u'along with what it was before, so that the run can be resumed or undone')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help=u'Carry on from where the run recorded in --journal stopped, '
+                             u'skipping the databases it finished')
+    parser.add_argument('--undo', dest='undo', action='store_true',
+                        help=u'Put back every database the run recorded in --journal changed, then exit')
+
+
+def open_journal(args, command, params=None):
+    """
+    Open the journal named by --journal, checking it fits --resume/--undo
+    """
+    if (args.resume or args.undo) and not args.journal:
+        raise Exception('--resume and --undo need --journal')
+    journal = Journal(args.journal, command, params)
+    if journal.entries and not (args.resume or args.undo):
+        journal.close()
+        raise Exception('{} already records {} databases; pass --resume to carry on '
+                        'or --undo to roll them back'.format(args.journal, len(journal.get_done())))
+    return journal
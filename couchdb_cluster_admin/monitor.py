@@ -0,0 +1,214 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+from collections import defaultdict, namedtuple
+from urllib.parse import quote
+
+from .utils import (
+    check_connection,
+    do_couch_request,
+    do_node_local_request,
+    get_arg_parser,
+    get_config_from_args,
+    get_db_docs,
+    indent,
+)
+from .file_plan import read_plan_file
+
+
+ReplicaStatus = namedtuple('ReplicaStatus', 'db_name, shard, node, doc_total, update_seq')
+
+
+def get_shard_file_path(db_name, shard, shard_suffix):
+    """
+    URL path of one shard replica's own database, shards/<range>/<db_name><suffix>
+
+    The whole name is a single path segment, so slashes in it (including any in db_name,
+    which CouchDB keeps in subdirectories on disk) are escaped.
+    """
+    return quote('shards/{shard}/{db_name}{shard_suffix}'.format(
+        shard=shard, db_name=db_name, shard_suffix=shard_suffix), safe='')
+
+
+def get_replica_status(config, db_name, shard, shard_suffix, node):
+    """
+    Get the doc count and update_seq of one shard replica straight from the node holding it
+
+    A replica that has not been created yet is reported as having no docs.
+    """
+    from requests import HTTPError
+    try:
+        info = do_node_local_request(
+            config.get_node_details(node), get_shard_file_path(db_name, shard, shard_suffix))
+    except HTTPError as e:
+        if e.response.status_code != 404:
+            raise
+        return ReplicaStatus(db_name, shard, node, 0, None)
+    return ReplicaStatus(db_name, shard, node, info['doc_count'] + info['doc_del_count'], info['update_seq'])
+
+
+def get_replicas_to_monitor(config, plan):
+    """
+    :return: list of (db_name, shard, shard_suffix, node) for every replica in the plan
+
+    Shard suffixes come from the plan; any the plan doesn't have are fetched in bulk.
+    """
+    missing_suffixes = [db_name for db_name, plan_allocation_doc in plan.items()
+                        if not plan_allocation_doc.shard_suffix]
+    db_docs = get_db_docs(config.get_control_node(), missing_suffixes) if missing_suffixes else {}
+    replicas = []
+    for db_name, plan_allocation_doc in sorted(plan.items()):
+        if plan_allocation_doc.shard_suffix:
+            shard_suffix = plan_allocation_doc.usable_shard_suffix
+        else:
+            shard_suffix = ''.join(map(chr, db_docs[db_name]['shard_suffix']))
+        for shard, nodes in sorted(plan_allocation_doc.by_range.items()):
+            for node in nodes:
+                replicas.append((db_name, shard, shard_suffix, node))
+    return replicas
+
+
+def poll_replicas(config, replicas, concurrency=20):
+    import gevent.pool
+    pool = gevent.pool.Pool(concurrency)
+    jobs = [pool.spawn(get_replica_status, config, *replica) for replica in replicas]
+    gevent.joinall(jobs, raise_error=True)
+    return [job.value for job in jobs]
+
+
+def get_active_tasks_by_node(node_details):
+    tasks_by_node = defaultdict(int)
+    for task in do_couch_request(node_details, '_active_tasks'):
+        tasks_by_node[task.get('node')] += 1
+    return tasks_by_node
+
+
+def get_backlog(statuses):
+    """
+    Compare the replicas of each range
+
+    A replica's backlog is how many docs it is behind the most up to date replica of the same range.
+    A range has converged once all its replicas exist and have the same number of docs
+    (doc_count + doc_del_count). update_seq is only used to tell whether a replica exists yet:
+    each replica numbers its own sequence, so sequences can't be compared across replicas.
+
+    :return: tuple(backlog_by_node, unconverged_ranges)
+                backlog_by_node is a dict of node->docs
+                unconverged_ranges is a set of (db_name, shard)
+    """
+    statuses_by_range = defaultdict(list)
+    for status in statuses:
+        statuses_by_range[(status.db_name, status.shard)].append(status)
+
+    backlog_by_node = defaultdict(int)
+    unconverged_ranges = set()
+    for db_range, range_statuses in statuses_by_range.items():
+        most_docs = max(status.doc_total for status in range_statuses)
+        for status in range_statuses:
+            backlog = most_docs - status.doc_total
+            backlog_by_node[status.node] += backlog
+            if backlog or status.update_seq is None:
+                unconverged_ranges.add(db_range)
+    return dict(backlog_by_node), unconverged_ranges
+
+
+class ConvergenceMonitor(object):
+    """
+    Poll every replica in a plan until they all agree
+
+    The poll interval shrinks while replicas are making progress
+    and backs off while nothing is changing.
+    """
+    def __init__(self, config, plan, min_interval=5, max_interval=120, concurrency=20):
+        self.config = config
+        self.replicas = get_replicas_to_monitor(config, plan)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        self.interval = min_interval
+        self._last_poll_time = None
+        self._last_backlog_by_node = None
+        self._throughput_by_node = {}
+
+    def poll(self):
+        statuses = poll_replicas(self.config, self.replicas, self.concurrency)
+        poll_time = time.time()
+        backlog_by_node, unconverged_ranges = get_backlog(statuses)
+
+        if self._last_backlog_by_node is not None:
+            elapsed = poll_time - self._last_poll_time
+            for node, backlog in backlog_by_node.items():
+                progress = self._last_backlog_by_node.get(node, backlog) - backlog
+                self._throughput_by_node[node] = max(progress, 0) / elapsed
+            if backlog_by_node != self._last_backlog_by_node:
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 2)
+
+        self._last_poll_time = poll_time
+        self._last_backlog_by_node = backlog_by_node
+        return backlog_by_node, unconverged_ranges
+
+    def get_eta(self, node):
+        backlog = self._last_backlog_by_node.get(node, 0)
+        throughput = self._throughput_by_node.get(node)
+        if not backlog:
+            return 0
+        if not throughput:
+            return None
+        return backlog / throughput
+
+    def get_printable(self, backlog_by_node, unconverged_ranges, tasks_by_node):
+        row = u"{: <20}\t{: >12}\t{: >12}\t{: >10}\t{: >12}"
+        lines = [row.format(u"Node", u"Backlog", u"Docs/s", u"ETA", u"Active tasks")]
+        for node, backlog in sorted(backlog_by_node.items()):
+            eta = self.get_eta(node)
+            throughput = self._throughput_by_node.get(node)
+            lines.append(row.format(
+                self.config.format_node_name(node),
+                backlog,
+                u'-' if throughput is None else u'{:.1f}'.format(throughput),
+                u'-' if eta is None else u'{:.0f}s'.format(eta),
+                tasks_by_node.get(node, 0),
+            ))
+        lines.append(u'{} of {} ranges still converging'.format(
+            len(unconverged_ranges), len({(db_name, shard) for db_name, shard, _, _ in self.replicas})))
+        return u'\n'.join(lines)
+
+    def run(self):
+        node_details = self.config.get_control_node()
+        while True:
+            backlog_by_node, unconverged_ranges = self.poll()
+            tasks_by_node = get_active_tasks_by_node(node_details)
+            print(time.strftime('%Y-%m-%d %H:%M:%S'))
+            print(indent(self.get_printable(backlog_by_node, unconverged_ranges, tasks_by_node)))
+            if not unconverged_ranges:
+                print(u'All ranges in the plan have converged')
+                return
+            time.sleep(self.interval)
+
+
+def main():
+    parser = get_arg_parser(u'Monitor internal replication after a plan has been committed')
+    parser.add_argument('--from-plan', dest='plan_file', required=True,
+                        help=u'Plan file that was committed.')
+    parser.add_argument('--min-interval', dest='min_interval', default=5, type=float,
+                        help=u'Shortest time to wait between polls in seconds. Default: 5')
+    parser.add_argument('--max-interval', dest='max_interval', default=120, type=float,
+                        help=u'Longest time to wait between polls in seconds. Default: 120')
+    parser.add_argument('--concurrency', dest='concurrency', default=20, type=int,
+                        help=u'How many replicas to query at once. Default: 20')
+    args = parser.parse_args()
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    plan = read_plan_file(args.plan_file)
+    ConvergenceMonitor(
+        config, plan, min_interval=args.min_interval, max_interval=args.max_interval,
+        concurrency=args.concurrency,
+    ).run()
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
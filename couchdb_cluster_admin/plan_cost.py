@@ -0,0 +1,161 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from collections import defaultdict, namedtuple
+
+from .utils import (
+    check_connection,
+    get_arg_parser,
+    get_config_from_args,
+    humansize,
+    indent,
+)
+
+PlanCost = namedtuple(
+    'PlanCost', 'added_by_node removed_by_node sent_by_node added_by_db removed_by_db peak_by_node final_by_node')
+
+
+def get_allocation_changes(current_by_range, target_by_range):
+    """
+    :return: tuple(added, removed), sets of (node, shard) the target adds to and removes from the current allocation
+    """
+    current = {(node, shard) for shard, nodes in current_by_range.items() for node in nodes}
+    target = {(node, shard) for shard, nodes in target_by_range.items() for node in nodes}
+    return target - current, current - target
+
+
+class AllocationIndex(object):
+    """
+    The current allocation and the size of every range, indexed so that plans can be costed without the cluster
+
+    Crawl the cluster once, then cost as many candidate plans as needed.
+    """
+    def __init__(self, db_info):
+        """
+        :param db_info: as returned by suggest_shard_allocation.get_db_info;
+                        db and view sizes are split evenly between shards as in get_shard_sizes
+        """
+        self.shard_size_by_db_name = {}
+        self.by_range_by_db_name = {}
+        self.size_by_node = defaultdict(int)
+        for db_name, size, view_sizes, shards, shard_allocation_doc in db_info:
+            shard_size = 1.0 * sum([size] + list(view_sizes.values())) / len(shards)
+            self.shard_size_by_db_name[db_name] = shard_size
+            self.by_range_by_db_name[db_name] = shard_allocation_doc.by_range
+            for shard, nodes in shard_allocation_doc.by_range.items():
+                for node in nodes:
+                    self.size_by_node[node] += shard_size
+
+    def get_cost(self, plan):
+        """
+        :param plan: dict of db_name->ShardAllocationDoc, as returned by read_plan_file
+        :return: PlanCost, each field a dict of node or db_name->bytes.
+                 Copies are sent from the first node currently holding the range, as in file_plan.
+                 New copies are all in place before old ones are removed, so peak_by_node is
+                 what a node holds now plus everything it is given.
+        """
+        added_by_node = defaultdict(int)
+        removed_by_node = defaultdict(int)
+        sent_by_node = defaultdict(int)
+        added_by_db = defaultdict(int)
+        removed_by_db = defaultdict(int)
+        for db_name, plan_allocation_doc in plan.items():
+            # a database the plan creates has nothing to copy
+            shard_size = self.shard_size_by_db_name.get(db_name, 0)
+            current_by_range = self.by_range_by_db_name.get(db_name, {})
+            added, removed = get_allocation_changes(current_by_range, plan_allocation_doc.by_range)
+            for node, shard in added:
+                added_by_node[node] += shard_size
+                added_by_db[db_name] += shard_size
+                if current_by_range.get(shard):
+                    sent_by_node[current_by_range[shard][0]] += shard_size
+            for node, shard in removed:
+                removed_by_node[node] += shard_size
+                removed_by_db[db_name] += shard_size
+
+        nodes = set(self.size_by_node) | set(added_by_node)
+        return PlanCost(
+            dict(added_by_node), dict(removed_by_node), dict(sent_by_node), dict(added_by_db), dict(removed_by_db),
+            {node: self.size_by_node[node] + added_by_node[node] for node in nodes},
+            {node: self.size_by_node[node] + added_by_node[node] - removed_by_node[node] for node in nodes},
+        )
+
+
+def get_transfer_seconds(plan_cost, bytes_per_second):
+    """
+    Estimate how long copying takes if every node can send or receive at bytes_per_second,
+    with copies to and from different nodes running in parallel
+    """
+    busiest = max([0] + list(plan_cost.added_by_node.values()) + list(plan_cost.sent_by_node.values()))
+    return busiest / bytes_per_second
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return u'{}h{:02d}m{:02d}s'.format(hours, rest // 60, rest % 60)
+
+
+def print_plan_cost(config, plan_cost, top_dbs=10):
+    row = u"{: <15}\t{: >12}\t{: >12}\t{: >12}\t{: >12}\t{: >12}"
+    print(row.format(u"Node", u"Added", u"Removed", u"Sent", u"Peak", u"After"))
+    for node in sorted(plan_cost.peak_by_node):
+        print(row.format(
+            config.format_node_name(node),
+            humansize(plan_cost.added_by_node.get(node, 0)),
+            humansize(plan_cost.removed_by_node.get(node, 0)),
+            humansize(plan_cost.sent_by_node.get(node, 0)),
+            humansize(plan_cost.peak_by_node[node]),
+            humansize(plan_cost.final_by_node[node]),
+        ))
+    db_names = sorted(set(plan_cost.added_by_db) | set(plan_cost.removed_by_db),
+                      key=lambda db_name: plan_cost.added_by_db.get(db_name, 0), reverse=True)
+    if db_names:
+        print(u'Databases copying the most:')
+        for db_name in db_names[:top_dbs]:
+            print(indent(u'{}\t{} added, {} removed'.format(
+                db_name, humansize(plan_cost.added_by_db.get(db_name, 0)),
+                humansize(plan_cost.removed_by_db.get(db_name, 0)))))
+
+
+def main():
+    parser = get_arg_parser(u'Estimate how much data plans move and how long copying it takes')
+    parser.add_argument('--from-plan', dest='plan_files', nargs='+', required=True,
+                        help=u'One or more plan files to cost and compare')
+    parser.add_argument('--bandwidth-mb', dest='bandwidth_mb', type=float, default=100,
+                        help=u'MB per second each node can send or receive. Default: 100')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help=u'How many databases to list for each plan. Default: 10')
+    from .suggest_shard_allocation import add_size_metric_argument
+    add_size_metric_argument(parser)
+    args = parser.parse_args()
+
+    from .file_plan import read_plan_file
+    from .suggest_shard_allocation import get_db_info
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    index = AllocationIndex(get_db_info(config, args.size_metric))
+    bytes_per_second = args.bandwidth_mb * 1024 ** 2
+
+    summaries = []
+    for plan_file in args.plan_files:
+        plan_cost = index.get_cost(read_plan_file(plan_file))
+        print(u'{}:'.format(plan_file))
+        print_plan_cost(config, plan_cost, args.top)
+        print()
+        summaries.append((plan_file, plan_cost))
+
+    row = u"{: <40}\t{: >12}\t{: >12}\t{: >14}\t{: >12}"
+    print(row.format(u"Plan", u"Added", u"Removed", u"Largest peak", u"Copy time"))
+    for plan_file, plan_cost in sorted(summaries, key=lambda summary: get_transfer_seconds(summary[1], 1)):
+        print(row.format(
+            plan_file,
+            humansize(sum(plan_cost.added_by_node.values())),
+            humansize(sum(plan_cost.removed_by_node.values())),
+            humansize(max([0] + list(plan_cost.peak_by_node.values()))),
+            format_duration(get_transfer_seconds(plan_cost, bytes_per_second)),
+        ))
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
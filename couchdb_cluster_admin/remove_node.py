@@ -1,25 +1,30 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import copy
 import sys
 
+from .journal import add_journal_arguments, open_journal, undo_journal
 from .utils import (
     check_connection,
     confirm,
     do_node_local_request,
     get_arg_parser,
-    get_db_list,
     get_membership,
     is_node_in_cluster,
+    iter_db_list,
     node_details_from_args,
     remove_node_from_cluster,
 )
 
 
-def _remove_shards_from_node(node_details, db_name, node_to_remove):
+def _remove_shards_from_node(node_details, db_name, node_to_remove, journal=None):
     db_doc = do_node_local_request(node_details, '_dbs/{}'.format(db_name))
+    before = copy.deepcopy(db_doc)
     by_node = db_doc['by_node']
     if node_to_remove not in by_node:
         print('  Node "{}" has no shards for db "{}"'.format(node_to_remove, db_name))
+        if journal:
+            journal.record_done(db_name, changed=False)
         return True
 
     if not confirm('Remove shards from db "{}" for "{}"?'.format(db_name, node_to_remove)):
@@ -47,6 +52,8 @@ def _remove_shards_from_node(node_details, db_name, node_to_remove):
 
     print('  Updating db config for {}'.format(db_name))
     do_node_local_request(node_details, '_dbs/{}'.format(db_name), method='put', json=db_doc)
+    if journal:
+        journal.record_done(db_name, before=before)
     return True
 
 
@@ -57,29 +64,42 @@ def _remove_node(node_details, new_node):
         print('Node not part of the cluster according to {}'.format(node_details.ip))
 
 
-if __name__ == '__main__':
+def main():
     parser = get_arg_parser('Remove a node from the cluster')
     parser.add_argument('--node-to-remove', dest='node_to_remove', required=True,
                         help='Node to remove from the cluster e.g. couchdb@node-ip')
+    add_journal_arguments(parser)
     args = parser.parse_args()
 
     node_details = node_details_from_args(args)
     check_connection(node_details)
 
     node_to_remove = args.node_to_remove
+    journal = open_journal(args, 'remove-node', {'node_to_remove': node_to_remove})
+    if args.undo:
+        with journal:
+            undo_journal(node_details, journal)
+        if not is_node_in_cluster(node_details, node_to_remove):
+            print('{} is no longer part of the cluster; add it back with add-replica-node'.format(node_to_remove))
+        return
 
     if not is_node_in_cluster(node_details, node_to_remove):
         print('Node already removed from cluster')
         sys.exit(0)
 
     remove_from_cluster = True
-    for db_name in get_db_list(node_details):
-        if db_name.startswith('_'):
-            # TODO: remove this once there's a workaround for https://github.com/apache/couchdb/issues/858
-            print("Skipping db {}".format(db_name))
-            continue
-        shards_removed = _remove_shards_from_node(node_details, db_name, node_to_remove)
-        remove_from_cluster &= shards_removed
+    done = journal.get_done()
+    with journal:
+        for db_name in iter_db_list(node_details):
+            if db_name.startswith('_'):
+                # TODO: remove this once there's a workaround for https://github.com/apache/couchdb/issues/858
+                print("Skipping db {}".format(db_name))
+                continue
+            if db_name in done:
+                print('Already done {}'.format(db_name))
+                continue
+            shards_removed = _remove_shards_from_node(node_details, db_name, node_to_remove, journal)
+            remove_from_cluster &= shards_removed
 
     if remove_from_cluster:
         if confirm("Remove node {} completely from cluster?".format(node_to_remove)):
@@ -87,3 +107,7 @@ if __name__ == '__main__':
             print('Cluster membership:\n{}'.format(get_membership(node_details).get_printable()))
     else:
         print("Node could not be removed from cluster as it may still have shards")
+
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,7 @@ def _update_db_doc_with_new_node(node_details, db_name, new_node):
 
     shards_for_new_node = None
     for node_name, shards in by_node.items():
-        if args.control_node_ip in node_name:
+        if node_details.ip in node_name:
             shards_for_new_node = shards
             break
 
@@ -53,7 +53,7 @@ def _add_node(node_details, new_node):
             add_node_to_cluster(node_details, new_node)
 
 
-if __name__ == '__main__':
+def main():
     parser = get_arg_parser('Replicate DB shards to a new node')
     parser.add_argument('--new-node', dest='new_node', required=True,
                         help='New node e.g. couchdb@node-ip')
@@ -77,3 +77,7 @@ if __name__ == '__main__':
 
     if confirm('Add shards from db "{}" to new node?'.format(database)):
         _update_db_doc_with_new_node(node_details, database, new_node)
+
+
+if __name__ == '__main__':
+    main()
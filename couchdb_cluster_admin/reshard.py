@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+from collections import namedtuple
+
+from .utils import (
+    check_connection,
+    do_couch_request,
+    get_arg_parser,
+    get_capabilities,
+    get_config_from_args,
+    humansize,
+    indent,
+    parse_version,
+)
+
+SplitRecommendation = namedtuple('SplitRecommendation', 'db_name shard size depth new_shards')
+
+
+def split_shard(shard):
+    """
+    Split a range like '00000000-7fffffff' in two halves the way CouchDB's _reshard does
+
+    :return: list of the two new ranges
+    """
+    start, end = [int(part, 16) for part in shard.split('-')]
+    if start == end:
+        raise ValueError('Range {} is too small to split'.format(shard))
+    middle = start + (end - start) // 2
+    return ['{:08x}-{:08x}'.format(start, middle), '{:08x}-{:08x}'.format(middle + 1, end)]
+
+
+def split_shard_to_depth(shard, depth):
+    shards = [shard]
+    for _ in range(depth):
+        shards = [new_shard for shard in shards for new_shard in split_shard(shard)]
+    return shards
+
+
+def get_average_node_size(db_info):
+    """
+    How much data each node would hold if the current copies were spread perfectly evenly
+    """
+    total = 0
+    nodes = set()
+    for db_name, size, view_sizes, shards, shard_allocation_doc in db_info:
+        shard_size = 1.0 * sum([size] + list(view_sizes.values())) / len(shards)
+        for shard, shard_nodes in shard_allocation_doc.by_range.items():
+            total += shard_size * len(shard_nodes)
+            nodes.update(shard_nodes)
+    return total / len(nodes) if nodes else 0
+
+
+def plan_splits(db_info, target_shard_size=None, max_node_fraction=0.25, max_depth=4):
+    """
+    Find ranges that are too big, and how many times each should be split
+
+    A range is too big if it is larger than target_shard_size, or if it is larger than
+    max_node_fraction of the average node's share of data, since no placement of an indivisible range
+    can even nodes out to better than its own size.
+    Each split halves a range (and, assuming docs are spread evenly over the range, its size).
+
+    :return: list of SplitRecommendation, largest ranges first
+    """
+    limit = max_node_fraction * get_average_node_size(db_info)
+    if target_shard_size:
+        limit = min(limit, target_shard_size) if limit else target_shard_size
+    if not limit:
+        return []
+    splits = []
+    for db_name, size, view_sizes, shards, _ in db_info:
+        shard_size = 1.0 * sum([size] + list(view_sizes.values())) / len(shards)
+        depth = 0
+        while shard_size / 2 ** depth > limit and depth < max_depth:
+            depth += 1
+        if depth:
+            for shard in shards:
+                splits.append(SplitRecommendation(
+                    db_name, shard, shard_size, depth, split_shard_to_depth(shard, depth)))
+    return sorted(splits, key=lambda split: (-split.size, split.db_name, split.shard))
+
+
+def get_split_shard_sizes(shard_sizes, splits):
+    """
+    Turn shard_sizes (as passed to suggest_shard_allocation) into what they will be after splits are done
+
+    Split ranges are replaced by their new ranges, each with an even part of the size.
+    """
+    new_shards_by_shard = {(split.shard, split.db_name): split.new_shards for split in splits}
+    split_shard_sizes = []
+    for size, (shard, db_name) in shard_sizes:
+        new_shards = new_shards_by_shard.get((shard, db_name))
+        if new_shards:
+            split_shard_sizes.extend((size / len(new_shards), (new_shard, db_name)) for new_shard in new_shards)
+        else:
+            split_shard_sizes.append((size, (shard, db_name)))
+    return split_shard_sizes
+
+
+class ReshardDriver(object):
+    """
+    Run the splits through CouchDB 3's _reshard API, at most `concurrency` ranges at a time
+
+    Each split of a range creates one job per copy of the range.
+    Once all of them are done, the two new ranges are split in turn until the recommended depth is reached.
+    """
+    def __init__(self, config, concurrency=2, poll_interval=10):
+        self.config = config
+        self.node_details = config.get_control_node()
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+    def check_supported(self):
+        version = get_capabilities(self.node_details).version
+        if parse_version(version) < (3, 0, 0):
+            raise Exception('Splitting shards needs CouchDB 3.0 or later; the cluster is running {}'.format(version))
+
+    def submit_split(self, db_name, shard):
+        response = do_couch_request(self.node_details, '_reshard/jobs', method='post', json={
+            'type': 'split',
+            'db': db_name,
+            'range': shard,
+        })
+        failed = [job for job in response if not job.get('ok')]
+        if failed:
+            raise Exception('Could not split {} {}: {}'.format(db_name, shard, failed))
+        return [job['id'] for job in response]
+
+    def wait_for_jobs(self, job_ids):
+        pending = list(job_ids)
+        while pending:
+            still_pending = []
+            for job_id in pending:
+                job = do_couch_request(self.node_details, '_reshard/jobs/{}'.format(job_id))
+                if job['job_state'] == 'failed':
+                    raise Exception('Reshard job {} failed: {}'.format(job_id, job.get('state_info')))
+                if job['job_state'] != 'completed':
+                    still_pending.append(job_id)
+            pending = still_pending
+            if pending:
+                time.sleep(self.poll_interval)
+
+    def split(self, db_name, shard, depth):
+        shards = [shard]
+        for _ in range(depth):
+            next_shards = []
+            for shard in shards:
+                print(u'Splitting {} {}'.format(db_name, shard))
+                self.wait_for_jobs(self.submit_split(db_name, shard))
+                next_shards.extend(split_shard(shard))
+            shards = next_shards
+        return shards
+
+    def run(self, splits):
+        import gevent.pool
+        self.check_supported()
+        pool = gevent.pool.Pool(self.concurrency)
+        jobs = [pool.spawn(self.split, split.db_name, split.shard, split.depth) for split in splits]
+        gevent.joinall(jobs, raise_error=True)
+
+
+def get_node_sizes(shard_sizes, n_nodes, n_copies):
+    from .suggest_shard_allocation import suggest_shard_allocation
+    return sorted(node.size for node in suggest_shard_allocation(shard_sizes, n_nodes, n_copies))
+
+
+def main():
+    parser = get_arg_parser(u'Split oversized shards (CouchDB 3 and later)')
+    parser.add_argument('--target-shard-size-gb', dest='target_shard_size_gb', type=float,
+                        help=u'Split any range larger than this')
+    parser.add_argument('--max-node-fraction', dest='max_node_fraction', type=float, default=0.25,
+                        help=u"Split any range larger than this fraction of the average node's data, "
+                             u"since it keeps nodes from being balanced. Default: 0.25")
+    parser.add_argument('--max-depth', dest='max_depth', type=int, default=4,
+                        help=u'Never split a range into more than 2^max-depth new ranges. Default: 4')
+    parser.add_argument('--nodes', dest='n_nodes', type=int,
+                        help=u'Show how evenly the ranges would fit on this many nodes before and after splitting')
+    parser.add_argument('--copies', dest='n_copies', type=int, default=3,
+                        help=u'Number of copies of each range to use with --nodes. Default: 3')
+    parser.add_argument('--execute', dest='execute', action='store_true',
+                        help=u'Run the splits with _reshard jobs')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=2,
+                        help=u'How many ranges to split at once with --execute. Default: 2')
+    args = parser.parse_args()
+
+    from .suggest_shard_allocation import get_db_info, get_shard_sizes
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    db_info = get_db_info(config)
+    target_shard_size = args.target_shard_size_gb * 1024 ** 3 if args.target_shard_size_gb else None
+    splits = plan_splits(db_info, target_shard_size, args.max_node_fraction, args.max_depth)
+
+    if not splits:
+        print(u'No ranges need splitting')
+        return
+    row = u"{: <30}\t{: <20}\t{: >12}\t{: >10}"
+    print(row.format(u"Database", u"Range", u"Size", u"New ranges"))
+    for split in splits:
+        print(row.format(split.db_name, split.shard, humansize(split.size), len(split.new_shards)))
+
+    if args.n_nodes:
+        shard_sizes = get_shard_sizes(db_info, {db_name for db_name, _, _, _, _ in db_info})
+        for label, sizes in [(u'Before', shard_sizes), (u'After', get_split_shard_sizes(shard_sizes, splits))]:
+            node_sizes = get_node_sizes(sizes, args.n_nodes, args.n_copies)
+            print(u'{} splitting, node sizes range from {} to {}'.format(
+                label, humansize(node_sizes[0]), humansize(node_sizes[-1])))
+            print(indent(u'  '.join(humansize(size) for size in node_sizes)))
+
+    if args.execute:
+        ReshardDriver(config, concurrency=args.concurrency).run(splits)
+        print(u'Done. Run suggest-shard-allocation to place the new ranges.')
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
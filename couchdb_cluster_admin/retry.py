@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+import random
+import threading
+import time
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# POSTs that only read, e.g. {"keys": [...]} queries
+READ_ONLY_POST_ENDPOINTS = ('_all_docs', '_dbs_info')
+
+
+class RetryPolicy(object):
+    """
+    How many times to retry a failed idempotent request, and how long to wait in between
+
+    Waits grow exponentially from `backoff` seconds up to `max_backoff`, with full jitter
+    so that many greenlets failing at once don't all come back at once.
+    """
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30, timeout=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def is_idempotent(method, path):
+    method = method.lower()
+    if method in ('get', 'head'):
+        return True
+    return method == 'post' and path.split('?')[0].rstrip('/').endswith(READ_ONLY_POST_ENDPOINTS)
+
+
+def is_retryable_error(error):
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker(object):
+    """
+    Slow down requests to a node that keeps failing instead of failing the whole operation
+
+    After `failure_threshold` consecutive failures the breaker opens and every request to the node
+    waits out a cooldown. Then a single probe request is let through: if it succeeds the breaker closes,
+    if it fails the breaker opens again with double the cooldown (up to `max_cooldown`).
+    """
+    def __init__(self, failure_threshold=5, cooldown=5, max_cooldown=120):
+        self.failure_threshold = failure_threshold
+        self.initial_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self._probe = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_closed(self):
+        return self.open_until is None
+
+    def before_request(self):
+        """
+        Wait until a request may be made
+
+        :return: a probe token if this request is the probe, otherwise None.
+                 Pass it to release_probe once the request is over.
+        """
+        while True:
+            wait, probe = self.check_request()
+            if wait is None:
+                return probe
+            time.sleep(wait)
+
+    def check_request(self):
+        """
+        Non-blocking version of before_request, for callers that need to do their own waiting
+
+        :return: tuple(wait, probe); wait is None if the request may go ahead,
+                 otherwise how long to wait before checking again
+        """
+        with self._lock:
+            if self.open_until is None:
+                return None, None
+            wait = self.open_until - time.time()
+            if wait <= 0 and self._probe is None:
+                self._probe = object()
+                return None, self._probe
+        return max(wait, 0.1), None
+
+    def release_probe(self, probe):
+        """
+        Let another request probe the node if `probe` ended without on_success or on_failure being called,
+        e.g. because it was interrupted by a timeout or KeyboardInterrupt
+        """
+        if probe is None:
+            return
+        with self._lock:
+            if self._probe is probe:
+                self._probe = None
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = None
+            self.cooldown = self.initial_cooldown
+            self._probe = None
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probe is not None:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._probe = None
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.time() + self.cooldown
+
+
+_retry_policy = RetryPolicy()
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_retry_policy():
+    return _retry_policy
+
+
+def set_retry_policy(retry_policy):
+    global _retry_policy
+    _retry_policy = retry_policy
+
+
+def get_circuit_breaker(ip, port):
+    key = (ip, port)
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker()
+        return _circuit_breakers[key]
+
+
+def add_retry_arguments(parser):
+    parser.add_argument('--retries', dest='retries', default=3, type=int,
+                        help='How many times to retry a failed read before giving up. Default: 3')
+    parser.add_argument('--retry-backoff', dest='retry_backoff', default=0.5, type=float,
+                        help='Base wait before retrying, in seconds. Doubles with each attempt. Default: 0.5')
+    parser.add_argument('--request-timeout', dest='request_timeout', default=None, type=float,
+                        help='Give up on (and retry) requests that take longer than this many seconds. '
+                             'Default: no timeout')
+
+
+def set_up_retries(args):
+    set_retry_policy(RetryPolicy(
+        max_retries=args.retries,
+        backoff=args.retry_backoff,
+        timeout=args.request_timeout,
+    ))
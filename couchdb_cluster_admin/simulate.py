@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import itertools
+from collections import defaultdict, namedtuple
+
+from .utils import (
+    check_connection,
+    get_arg_parser,
+    get_config_from_args,
+    humansize,
+    indent,
+)
+
+ScenarioResult = namedtuple(
+    'ScenarioResult', 'failed_nodes unavailable_ranges quorum_lost_ranges degraded_ranges rereplication_bytes')
+
+
+def get_quorum(n_copies):
+    # CouchDB's default read and write quorum
+    return n_copies // 2 + 1
+
+
+class _PlacementGroup(object):
+    """
+    All the ranges that live on exactly the same set of nodes
+    """
+    def __init__(self, mask):
+        self.mask = mask
+        self.n_copies = bin(mask).count('1')
+        self.ranges = []
+        self.size = 0
+
+    def add(self, db_range, size):
+        self.ranges.append(db_range)
+        self.size += size
+
+
+class FailureSimulator(object):
+    """
+    Work out what losing a set of nodes does to every range in the cluster
+
+    Ranges are grouped by the exact set of nodes holding them, with each set stored as a bitmask,
+    and each node is indexed to the groups it holds copies of.
+    A scenario then only looks at the groups touching a failed node,
+    so sweeping every single and two node failure of a large cluster stays fast.
+    """
+    def __init__(self, ranges):
+        """
+        :param ranges: iterable of (db_name, shard, nodes, size)
+        """
+        self.nodes = []
+        self._bit_by_node = {}
+        groups_by_mask = {}
+        for db_name, shard, nodes, size in ranges:
+            mask = 0
+            for node in nodes:
+                if node not in self._bit_by_node:
+                    self._bit_by_node[node] = 1 << len(self.nodes)
+                    self.nodes.append(node)
+                mask |= self._bit_by_node[node]
+            if mask not in groups_by_mask:
+                groups_by_mask[mask] = _PlacementGroup(mask)
+            groups_by_mask[mask].add((db_name, shard), size)
+
+        self.groups = list(groups_by_mask.values())
+        self._groups_by_node = defaultdict(list)
+        for group in self.groups:
+            for node, bit in self._bit_by_node.items():
+                if group.mask & bit:
+                    self._groups_by_node[node].append(group)
+
+    def get_mask(self, nodes):
+        mask = 0
+        for node in nodes:
+            mask |= self._bit_by_node.get(node, 0)
+        return mask
+
+    def _get_affected_groups(self, failed_nodes):
+        seen = set()
+        for node in failed_nodes:
+            for group in self._groups_by_node.get(node, ()):
+                if group.mask not in seen:
+                    seen.add(group.mask)
+                    yield group
+
+    def simulate(self, failed_nodes, include_ranges=False):
+        """
+        :return: ScenarioResult. The *_ranges fields are counts of ranges,
+                 or lists of (db_name, shard) if include_ranges is True.
+                 rereplication_bytes is the size of every copy lost, i.e. what has to be copied again
+                 to get back to full redundancy.
+        """
+        failed_nodes = tuple(failed_nodes)
+        failed_mask = self.get_mask(failed_nodes)
+        unavailable = []
+        quorum_lost = []
+        degraded = []
+        rereplication_bytes = 0
+        for group in self._get_affected_groups(failed_nodes):
+            lost = bin(group.mask & failed_mask).count('1')
+            surviving = group.n_copies - lost
+            rereplication_bytes += lost * group.size
+            degraded.append(group)
+            if surviving < get_quorum(group.n_copies):
+                quorum_lost.append(group)
+            if not surviving:
+                unavailable.append(group)
+
+        if include_ranges:
+            def _summarize(groups):
+                return sorted(db_range for group in groups for db_range in group.ranges)
+        else:
+            def _summarize(groups):
+                return sum(len(group.ranges) for group in groups)
+
+        return ScenarioResult(failed_nodes, _summarize(unavailable), _summarize(quorum_lost),
+                              _summarize(degraded), rereplication_bytes)
+
+    def sweep(self, n_failed):
+        """
+        Simulate every combination of n_failed nodes failing at once
+        """
+        for failed_nodes in itertools.combinations(self.nodes, n_failed):
+            yield self.simulate(failed_nodes)
+
+
+def get_ranges_from_db_info(db_info, plan=None):
+    """
+    :param db_info: as returned by suggest_shard_allocation.get_db_info
+    :param plan: optionally, a plan (as returned by read_plan_file) to simulate instead of the current allocation
+    :return: list of (db_name, shard, nodes, size), with db and view sizes split evenly between shards,
+             as in suggest_shard_allocation.get_shard_sizes
+    """
+    ranges = []
+    for db_name, size, view_sizes, shards, shard_allocation_doc in db_info:
+        if plan and db_name in plan:
+            shard_allocation_doc = plan[db_name]
+        shard_size = 1.0 * sum([size] + list(view_sizes.values())) / len(shards)
+        for shard, nodes in sorted(shard_allocation_doc.by_range.items()):
+            ranges.append((db_name, shard, nodes, shard_size))
+    return ranges
+
+
+def print_scenarios(config, results, n_ranges):
+    row = u"{: <40}\t{: >12}\t{: >12}\t{: >12}\t{: >14}"
+    print(row.format(u"Failed", u"Unavailable", u"No quorum", u"Degraded", u"Re-replicate"))
+    for result in results:
+        print(row.format(
+            u','.join(map(config.format_node_name, result.failed_nodes)),
+            result.unavailable_ranges,
+            result.quorum_lost_ranges,
+            result.degraded_ranges,
+            humansize(result.rereplication_bytes),
+        ))
+    print(u'(out of {} ranges)'.format(n_ranges))
+
+
+def main():
+    parser = get_arg_parser(u'Simulate node and zone failures against the shard allocation')
+    parser.add_argument('--fail', dest='scenarios', nargs='+', default=[],
+                        help=u'Scenarios to simulate, each a comma-separated list of nodes that fail together, '
+                             u'like couch1 couch2,couch3')
+    parser.add_argument('--sweep', dest='sweep', type=int, choices=[1, 2],
+                        help=u'Simulate every combination of this many nodes failing')
+    parser.add_argument('--zones', dest='zones', action='store_true',
+                        help=u'Simulate each zone listed under "zones" in the config file failing')
+    parser.add_argument('--from-plan', dest='plan_file',
+                        help=u'Simulate the allocation in this plan file instead of the current one')
+    parser.add_argument('--top', dest='top', type=int, default=20,
+                        help=u'Only show the worst scenarios. Default: 20')
+    args = parser.parse_args()
+
+    from .file_plan import read_plan_file
+    from .suggest_shard_allocation import get_db_info
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    plan = read_plan_file(args.plan_file) if args.plan_file else None
+    simulator = FailureSimulator(get_ranges_from_db_info(get_db_info(config), plan))
+
+    named_scenarios = [[config.get_formal_node_name(node) for node in scenario.split(',')]
+                       for scenario in args.scenarios]
+    if args.zones:
+        named_scenarios.extend([config.get_formal_node_name(node) for node in nodes]
+                               for _, nodes in sorted(config.zones.items()))
+    results = [simulator.simulate(failed_nodes) for failed_nodes in named_scenarios]
+    if args.sweep or not results:
+        results.extend(simulator.sweep(args.sweep or 1))
+
+    results.sort(key=lambda result: (result.unavailable_ranges, result.quorum_lost_ranges,
+                                     result.rereplication_bytes), reverse=True)
+    print_scenarios(config, results[:args.top], sum(len(group.ranges) for group in simulator.groups))
+
+    worst = results[0] if results else None
+    if worst and worst.unavailable_ranges:
+        print(u'Unavailable if {} fail:'.format(u','.join(map(config.format_node_name, worst.failed_nodes))))
+        for db_name, shard in simulator.simulate(worst.failed_nodes, include_ranges=True).unavailable_ranges:
+            print(indent(u'{} {}'.format(db_name, shard)))
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
@@ -1,17 +1,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import argparse
+from array import array
 from collections import defaultdict
 import json
 
-import requests
-from memoized import memoized_property
-
+from .cluster_state import get_cluster_state
 from .utils import humansize, get_arg_parser, get_config_from_args, check_connection, \
-    get_db_list, get_db_metadata, get_shard_allocation, do_couch_request, put_shard_allocation
+    iter_db_pages, do_couch_request, put_shard_allocation
 from .describe import print_shard_table
-from .file_plan import read_plan_file
-from .doc_models import ShardAllocationDoc, AllocationSpec
+from .file_plan import check_verification_reports, read_plan_file
+from .instrumentation import phase
+from .plan_cost import get_allocation_changes
 
 
 class _NodeAllocation(object):
@@ -30,35 +30,86 @@ class _NodeAllocation(object):
         return '_NodeAllocation({self.i!r}, {self.size!r}, {self.shards!r})'.format(self=self)
 
 
-def suggest_shard_allocation(shard_sizes, n_nodes, n_copies, existing_allocation=None):
-    return Allocator(shard_sizes, n_nodes, n_copies, existing_allocation).suggest_shard_allocation()
+def suggest_shard_allocation(shard_sizes, n_nodes, n_copies, existing_allocation=None, capacities=None):
+    return Allocator(shard_sizes, n_nodes, n_copies, existing_allocation, capacities).suggest_shard_allocation()
+
+
+class ShardIndex(object):
+    """
+    Dense integer ids for the (shard_name, db_name) pairs being allocated, so the planner
+    can work with arrays indexed by shard rather than sets and dicts of string tuples
+
+    Ids are given out in sorted order of the pairs, so ordering by id is the same as ordering by name,
+    and results come out the same as if the names were used throughout.
+    """
+    def __init__(self, shard_sizes, n_nodes, existing_allocation=None):
+        # id -> (shard_name, db_name)
+        self.shards = sorted({shard for _, shard in shard_sizes})
+        ids = {shard: shard_id for shard_id, shard in enumerate(self.shards)}
+        self.sizes = array('d', bytes(8 * len(self.shards)))
+        for size, shard in shard_sizes:
+            self.sizes[ids[shard]] = size
+        # one byte per shard for each node: whether the node holds a copy of it now
+        self.existing = [bytearray(len(self.shards)) for _ in range(n_nodes)]
+        self.n_existing_copies = array('i', bytes(4 * len(self.shards)))
+        for i, shards in enumerate(existing_allocation or []):
+            for shard in shards:
+                if shard in ids:
+                    self.existing[i][ids[shard]] = 1
+                    self.n_existing_copies[ids[shard]] += 1
+
+    def __len__(self):
+        return len(self.shards)
+
+    def get_node_allocations(self, nodes):
+        """
+        Map nodes whose shards are ids back to names
+        """
+        return [_NodeAllocation(node.i, node.size, [self.shards[shard_id] for shard_id in node.shards])
+                for node in nodes]
 
 
 class Allocator(object):
-    def __init__(self, shard_sizes, n_nodes, n_copies, existing_allocation=None):
+    """
+    :param capacities: optional list of how much each node can hold, in any unit (e.g. GB of disk);
+                       each node is filled in proportion to its capacity. By default all nodes are equal.
+    :param shard_index: a ShardIndex of shard_sizes and existing_allocation, to share between allocators
+    """
+    def __init__(self, shard_sizes, n_nodes, n_copies, existing_allocation=None, capacities=None,
+                 shard_index=None):
         self.shard_sizes = shard_sizes
         self.n_nodes = n_nodes
         self.n_copies = n_copies
-        self.existing_allocation = existing_allocation or ([set()] * self.n_nodes)
+        self.index = shard_index or ShardIndex(shard_sizes, n_nodes, existing_allocation)
+        self.capacities = capacities or [1] * self.n_nodes
+        # nodes' shards are shard ids until suggest_shard_allocation maps them back to names
         self.nodes = [_NodeAllocation(i, 0, []) for i in range(self.n_nodes)]
-        self._average_size = sum([size for size, _ in shard_sizes]) * n_copies * 1.0 / n_nodes
-        self._copies_still_in_original_location_by_shard = defaultdict(int)
-        for shards in self.existing_allocation:
-            for shard in shards:
-                self._copies_still_in_original_location_by_shard[shard] += 1
+        self._holds = [bytearray(len(self.index)) for _ in range(self.n_nodes)]
+        total_size = sum([size for size, _ in shard_sizes]) * n_copies * 1.0
+        self._target_sizes = [total_size * capacity / sum(self.capacities) for capacity in self.capacities]
+        self._copies_still_in_original_location_by_shard = array('i', self.index.n_existing_copies)
 
     def suggest_shard_allocation(self):
+        return self.index.get_node_allocations(self.allocate())
+
+    def allocate(self):
+        """
+        :return: list of _NodeAllocation whose shards are shard ids
+        """
         # First distribute, preferring shards' current locations
-        for shard in self._get_shard_sizes_largest_to_smallest():
-            for node in self._select_shard_locations(shard):
-                self._add_shard_to_node(node, shard)
+        with phase('allocator.distribute'):
+            for shard in self._get_shard_sizes_largest_to_smallest():
+                for node in self._select_shard_locations(shard):
+                    self._add_shard_to_node(node, shard)
 
         # Then rebalance
-        self._rebalance_nodes()
+        with phase('allocator.rebalance'):
+            self._rebalance_nodes()
         return self.nodes
 
     def _get_shard_sizes_largest_to_smallest(self):
-        return [shard for _, shard in reversed(sorted(self.shard_sizes))]
+        sizes = self.index.sizes
+        return sorted(range(len(self.index)), key=lambda shard: (sizes[shard], shard), reverse=True)
 
     def _select_shard_locations(self, shard):
         """
@@ -69,16 +120,16 @@ class Allocator(object):
         """
         return sorted(
             self.nodes,
-            key=lambda node: (shard not in self.existing_allocation[node.i], node.size)
+            key=lambda node: (not self._is_original_location(node, shard), self._get_fill(node))
         )[:self.n_copies]
 
-    @memoized_property
-    def _sizes_by_shard(self):
-        return {shard: size for size, shard in self.shard_sizes}
+    def _get_fill(self, node):
+        return node.size / self.capacities[node.i]
 
     def _add_shard_to_node(self, node, shard):
         node.shards.append(shard)
-        node.size += self._sizes_by_shard[shard]
+        node.size += self.index.sizes[shard]
+        self._holds[node.i][shard] = 1
 
     def _rebalance_nodes(self):
         larger_nodes, smaller_nodes = self._split_nodes_by_under_allocated()
@@ -87,12 +138,12 @@ class Allocator(object):
 
         while True:
             # Move copies from larger_nodes to smaller_nodes
-            # until doing so would make a larger node smaller than average_size
+            # until doing so would make a larger node smaller than its target size
             # Never move more than half - 1 copies of a shard from their original location
             # (as given by existing_allocation)---these are the shard's "pivot locations"
-            larger_nodes.sort(key=lambda node: node.size, reverse=True)
-            smallest_node = min(smaller_nodes, key=lambda node: node.size)
-            if smallest_node.size >= self._average_size:
+            larger_nodes.sort(key=self._get_fill, reverse=True)
+            smallest_node = min(smaller_nodes, key=self._get_fill)
+            if smallest_node.size >= self._target_sizes[smallest_node.i]:
                 break
             try:
                 large_node, shard = self._find_shard_to_move(larger_nodes, smallest_node)
@@ -105,22 +156,23 @@ class Allocator(object):
         if self._is_original_location(node1, shard):
             self._copies_still_in_original_location_by_shard[shard] -= 1
         node1.shards.remove(shard)
-        node1.size -= self._sizes_by_shard[shard]
+        node1.size -= self.index.sizes[shard]
+        self._holds[node1.i][shard] = 0
         self._add_shard_to_node(node2, shard)
 
     def _split_nodes_by_under_allocated(self):
         """
         Split nodes into okay nodes and under-allocated nodes
 
-        Any node whose size is less than half the size of the largest node
+        Any node that is less than half as full (relative to its capacity) as the fullest node
         is deemed under-allocated
 
         :return: (okay_nodes, under_allocated_nodes)
         """
-        threshold = max(self.nodes, key=lambda node: node.size).size / 2
+        threshold = max(self._get_fill(node) for node in self.nodes) / 2
         return (
-            [node for node in self.nodes if node.size >= threshold],
-            [node for node in self.nodes if node.size < threshold]
+            [node for node in self.nodes if self._get_fill(node) >= threshold],
+            [node for node in self.nodes if self._get_fill(node) < threshold]
         )
 
     class NoEligibleMove(Exception):
@@ -129,11 +181,11 @@ class Allocator(object):
     def _find_shard_to_move(self, larger_nodes, smallest_node):
         for large_node in larger_nodes:
             for shard in large_node.shards:
-                if shard in smallest_node.shards:
+                if self._holds[smallest_node.i][shard]:
                     # don't move a shard if a copy of it is already on the target node
                     continue
-                if large_node.size - self._sizes_by_shard[shard] < self._average_size:
-                    # don't move a shard if it would make the source node smaller than average
+                if large_node.size - self.index.sizes[shard] < self._target_sizes[large_node.i]:
+                    # don't move a shard if it would make the source node smaller than its target
                     continue
                 if self._is_original_location(large_node, shard) \
                         and not self._can_still_move_original_copies(shard):
@@ -145,23 +197,31 @@ class Allocator(object):
         raise self.NoEligibleMove()
 
     def _is_original_location(self, node, shard):
-        return shard in self.existing_allocation[node.i]
+        return self.index.existing[node.i][shard]
 
     def _can_still_move_original_copies(self, shard):
         # unmoved original shards is larger than half of n_copies
         return self._copies_still_in_original_location_by_shard[shard] > (self.n_copies / 2 + 1)
 
 
-def get_db_size(node_details, db_name):
-    return get_db_metadata(node_details, db_name)['sizes']['file']
+# 'file' is what a database takes up on disk, including what compaction would reclaim;
+# 'active' is roughly what it would take up after compaction
+SIZE_METRICS = ('file', 'active')
 
 
-def get_view_signature_and_size(node_details, db_name, view_name):
+def get_view_signature_and_size(node_details, db_name, view_name, size_metric='file'):
     view_info = do_couch_request(
         node_details,
         '/{db_name}/_design/{view_name}/_info'.format(db_name=db_name, view_name=view_name)
     )
-    return view_info['view_index']['signature'], view_info['view_index']['sizes']['file']
+    return view_info['view_index']['signature'], view_info['view_index']['sizes'][size_metric]
+
+
+def add_size_metric_argument(parser):
+    parser.add_argument('--size-metric', dest='size_metric', choices=SIZE_METRICS, default='file',
+                        help=u'Size databases and views by their file size on disk (file), '
+                             u'or by the size of their live data (active), i.e. what they would be after compaction. '
+                             u'Default: file')
 
 
 def get_views_list(node_details, db_name):
@@ -172,26 +232,28 @@ def get_views_list(node_details, db_name):
     return [row['id'][len('_design/'):] for row in view_response['rows'] if row['id'].startswith('_design/')]
 
 
-def get_db_info(config):
+def get_db_info(config, size_metric='file'):
     import gevent
-    processes = []
+    import gevent.event
     node_details = config.get_control_node()
-    db_names = get_db_list(node_details)
+    cluster_state = get_cluster_state(config)
+    db_names = []
     db_sizes = {}
     db_shards = {}
     shard_allocation_docs = {}
     view_sizes = defaultdict(dict)
 
-    def _gather_db_size(db_name):
-        db_sizes[db_name] = get_db_size(node_details, db_name)
+    def _gather_db_sizes(page):
+        db_sizes.update({db_name: metadata['sizes'][size_metric]
+                         for db_name, metadata in cluster_state.get_dbs_metadata(page).items()})
 
-    def _gather_db_shard_names(db_name):
-        doc = get_shard_allocation(config, db_name)
-        shard_allocation_docs[db_name] = doc
-        db_shards[db_name] = sorted(doc.by_range)
+    def _gather_db_shard_names(page):
+        for doc in cluster_state.get_shard_allocations(page):
+            shard_allocation_docs[doc.db_name] = doc
+            db_shards[doc.db_name] = sorted(doc.by_range)
 
     def _gather_view_size(db_name, view_name):
-        signature, size = get_view_signature_and_size(node_details, db_name, view_name)
+        signature, size = get_view_signature_and_size(node_details, db_name, view_name, size_metric)
         view_sizes[db_name][signature] = (view_name, size)
 
     def _gather_view_sizes(db_name):
@@ -201,11 +263,33 @@ def get_db_info(config):
             subprocesses.append(gevent.spawn(_gather_view_size, db_name, view_name))
         gevent.joinall(subprocesses, raise_error=True)
 
-    processes.extend([gevent.spawn(_gather_view_sizes, db_name) for db_name in db_names])
-    processes.extend([gevent.spawn(_gather_db_size, db_name) for db_name in db_names])
-    processes.extend([gevent.spawn(_gather_db_shard_names, db_name) for db_name in db_names])
-
-    gevent.joinall(processes, raise_error=True)
+    size_jobs = []
+    shard_map_jobs = []
+    view_jobs = []
+    listed = gevent.event.Event()
+
+    def _time_jobs(phase_name, jobs):
+        # the stages overlap, so each phase runs from the start of the crawl until its last job is done
+        with phase(phase_name):
+            listed.wait()
+            gevent.joinall(jobs, raise_error=True)
+
+    with phase('get_db_info.crawl'):
+        processes = [
+            gevent.spawn(_time_jobs, 'get_db_info.sizes', size_jobs),
+            gevent.spawn(_time_jobs, 'get_db_info.shard_maps', shard_map_jobs),
+            gevent.spawn(_time_jobs, 'get_db_info.views', view_jobs),
+        ]
+        with phase('get_db_info.list_dbs'):
+            # start on each page of databases while the next one is loading;
+            # sizes and shard maps are fetched in bulk for the whole page
+            for page in iter_db_pages(node_details):
+                db_names.extend(page)
+                view_jobs.extend([gevent.spawn(_gather_view_sizes, db_name) for db_name in page])
+                size_jobs.append(gevent.spawn(_gather_db_sizes, page))
+                shard_map_jobs.append(gevent.spawn(_gather_db_shard_names, page))
+        listed.set()
+        gevent.joinall(processes, raise_error=True)
 
     view_sizes = {db_name: {name: size for name, size in view_sizes[db_name].values()}
                   for db_name in db_names}
@@ -266,16 +350,34 @@ def get_existing_shard_allocation(db_info, databases, nodes):
     ]
 
 
-def make_suggested_allocation_by_db(config, db_info, allocation_specs):
+def make_suggested_allocation_by_db(config, db_info, allocation_specs, search_options=None):
+    """
+    :param search_options: if given, kwargs for allocation_search.search_shard_allocation
+                           (e.g. time_budget, workers), to search for a better allocation
+                           than the Allocator's single pass
+    """
     suggested_allocation_by_db = defaultdict(list)
     normalize_allocation_specs(db_info, allocation_specs)
 
     for allocation in allocation_specs:
         existing_allocation = get_existing_shard_allocation(db_info, allocation.databases, allocation.nodes)
-        suggested_shard_allocation = suggest_shard_allocation(
-            get_shard_sizes(db_info, allocation.databases), len(allocation.nodes), allocation.copies,
-            existing_allocation=existing_allocation
-        )
+        shard_sizes = get_shard_sizes(db_info, allocation.databases)
+        capacities = config.get_capacities(allocation.nodes)
+        if search_options is not None:
+            from .allocation_search import search_shard_allocation
+            with phase('allocator.search'):
+                result = search_shard_allocation(
+                    shard_sizes, len(allocation.nodes), allocation.copies,
+                    existing_allocation=existing_allocation, capacities=capacities, **search_options
+                )
+            print(u"Best of {} starts: {} over targets, {} to copy".format(
+                result.n_starts, humansize(result.excess), humansize(result.moved)))
+            suggested_shard_allocation = result.nodes
+        else:
+            suggested_shard_allocation = suggest_shard_allocation(
+                shard_sizes, len(allocation.nodes), allocation.copies,
+                existing_allocation=existing_allocation, capacities=capacities
+            )
         for node_allocation in suggested_shard_allocation:
             print("{}\t{}".format(config.format_node_name(allocation.nodes[node_allocation.i]), humansize(node_allocation.size)))
             for shard_name, db_name in node_allocation.shards:
@@ -286,6 +388,7 @@ def make_suggested_allocation_by_db(config, db_info, allocation_specs):
         for db_name, _, _, _, shard_allocation_doc in db_info
     }
 
+    from .doc_models import ShardAllocationDoc
     suggested_allocation_docs_by_db = {}
     for db_name, allocation in suggested_allocation_by_db.items():
         by_range = defaultdict(list)
@@ -307,22 +410,11 @@ def apply_suggested_allocation(shard_allocations, plan):
         db_name = shard_allocation_doc.db_name
         suggested_allocation = plan[db_name]
         assert suggested_allocation.validate_allocation()
-        suggested_allocation_set = {(node, shard)
-                                    for shard, nodes in suggested_allocation.by_range.items()
-                                    for node in nodes}
-        current_allocation_set = {(node, shard)
-                                  for shard, nodes in shard_allocation_doc.by_range.items()
-                                  for node in nodes}
+        added, removed = get_allocation_changes(shard_allocation_doc.by_range, suggested_allocation.by_range)
         shard_allocation_doc.by_range = suggested_allocation.by_range
         shard_allocation_doc.by_node = suggested_allocation.by_node
-        shard_allocation_doc.changelog.extend([
-            ["add", shard, node]
-            for node, shard in suggested_allocation_set - current_allocation_set
-        ])
-        shard_allocation_doc.changelog.extend([
-            ["delete", shard, node]
-            for node, shard in current_allocation_set - suggested_allocation_set
-        ])
+        shard_allocation_doc.changelog.extend([["add", shard, node] for node, shard in added])
+        shard_allocation_doc.changelog.extend([["delete", shard, node] for node, shard in removed])
         if shard_allocation_doc.shard_suffix:
             assert shard_allocation_doc.shard_suffix == suggested_allocation.shard_suffix
         else:
@@ -350,6 +442,21 @@ def main():
                         help='Save the suggested allocation directly to couchdb, '
                              'changing the live shard allocation.')
 
+    parser.add_argument('--require-verified', dest='verification_reports', nargs='+', default=[],
+                        help=u'Only commit if these reports from "file_plan verify --report" '
+                             u'all passed, for this same allocation.')
+
+    add_size_metric_argument(parser)
+
+    parser.add_argument('--time-budget', dest='time_budget', type=float,
+                        help=u'Spend up to this many seconds searching for a more even allocation '
+                             u'that moves less data, using every core. By default a single quick pass is made.')
+    parser.add_argument('--search-workers', dest='search_workers', type=int,
+                        help=u'How many processes to search with. Default: one per core')
+    parser.add_argument('--move-weight', dest='move_weight', type=float,
+                        help=u'When searching, how much copying a byte costs compared to leaving '
+                             u'a byte more than its target on a node. Default: 0.1')
+
     parser.add_argument('--create-missing-databases', dest='create', action='store_true', required=False,
                         help="Create databases in the cluster if they don't exist.")
 
@@ -365,7 +472,12 @@ def main():
         raise argparse.ArgumentError(None, "You cannot use --save-plan with --from-plan.")
 
     if args.allocation:
-        shard_allocations = generate_shard_allocation(config, args.allocation)
+        search_options = None
+        if args.time_budget:
+            search_options = {'time_budget': args.time_budget, 'workers': args.search_workers}
+            if args.move_weight is not None:
+                search_options['move_weight'] = args.move_weight
+        shard_allocations = generate_shard_allocation(config, args.allocation, args.size_metric, search_options)
     else:
         plan = read_plan_file(args.plan_file)
         create = args.create
@@ -379,6 +491,12 @@ def main():
                        for shard_allocation_doc in shard_allocations}, f)
 
     if args.commit:
+        import requests
+        if args.verification_reports:
+            nodes = check_verification_reports(
+                {shard_allocation_doc.db_name: shard_allocation_doc for shard_allocation_doc in shard_allocations},
+                args.verification_reports)
+            print(u'Files verified on {}'.format(u', '.join(map(config.format_node_name, nodes))))
         for shard_allocation_doc in shard_allocations:
             db_name = shard_allocation_doc.db_name
             try:
@@ -391,7 +509,7 @@ def main():
 
 
 def get_shard_allocation_from_plan(config, plan, create=False):
-    shard_allocations_docs = [get_shard_allocation(config, db_name, create) for db_name in plan]
+    shard_allocations_docs = get_cluster_state(config).get_shard_allocations(plan, create)
     shard_allocations = apply_suggested_allocation(
         shard_allocations_docs, plan
     )
@@ -399,6 +517,7 @@ def get_shard_allocation_from_plan(config, plan, create=False):
 
 
 def parse_allocation_line(config, allocation_line):
+    from .doc_models import AllocationSpec
     try:
         nodes, copies, databases = allocation_line.split(':')
     except ValueError:
@@ -416,16 +535,16 @@ def parse_allocation_line(config, allocation_line):
     )
 
 
-def generate_shard_allocation(config, allocation):
+def generate_shard_allocation(config, allocation, size_metric='file', search_options=None):
     allocation = [
         parse_allocation_line(config, allocation_line) for allocation_line in allocation
     ]
-    db_info = get_db_info(config)
+    db_info = get_db_info(config, size_metric)
     shard_allocations_docs = [shard_allocation_doc
                               for _, _, _, _, shard_allocation_doc in db_info]
     shard_allocations = apply_suggested_allocation(
         shard_allocations_docs,
-        make_suggested_allocation_by_db(config, db_info, allocation)
+        make_suggested_allocation_by_db(config, db_info, allocation, search_options)
     )
     return shard_allocations
 
@@ -1,74 +1,284 @@
 from __future__ import absolute_import
 import argparse
 import getpass
+import itertools
 from collections import namedtuple
+import json as jsonlib
 import os
-from jsonobject import JsonObject, StringProperty, IntegerProperty, DictProperty
-from distutils.version import LooseVersion
+import sys
+import threading
 
-import requests
 import time
-import yaml
-from requests import HTTPError
 
-from .doc_models import MembershipDoc, ShardAllocationDoc
+from .balancer import add_balancer_arguments, get_read_balancer, set_up_read_balancer
+from .instrumentation import add_profile_arguments, record_request, set_up_profiling
+from .retry import add_retry_arguments, get_circuit_breaker, get_retry_policy, is_idempotent, is_retryable_error, \
+    set_up_retries
 
 NodeDetails = namedtuple('NodeDetails', 'ip port node_local_port couchdb_version username password socks_port')
 
+# What a node supports, detected once per node by get_capabilities
+Capabilities = namedtuple('Capabilities', 'version features node_local_api dbs_info dbs_bulk_docs')
 
-def do_couch_request(node_details, path, method='get', params=None, json=None):
+_capabilities_by_node = {}
+_capabilities_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # Config lives in .config so that parsing arguments (e.g. --help) doesn't import jsonobject
+    if name == 'Config':
+        from .config import Config
+        return Config
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def do_couch_request(node_details, path, method='get', params=None, json=None, pinned=False):
+    """
+    :param pinned: send the request to node_details even with --spread-reads,
+                   for requests whose answer depends on which node is asked
+    """
+    read_balancer = None if pinned else get_read_balancer(node_details)
+    if read_balancer and is_idempotent(method, path):
+        with read_balancer.acquire() as node_details:
+            return _do_request(node_details, path, node_details.port, method=method, params=params, json=json)
     return _do_request(node_details, path, node_details.port, method=method, params=params, json=json)
 
 
 def do_node_local_request(node_details, path, method='get', params=None, json=None):
-    if LooseVersion(node_details.couchdb_version) >= LooseVersion('3.0.0'):
-        node_local_port = node_details.port
-        path = '_node/_local/' + path
-    else:
-        node_local_port = node_details.node_local_port
+    # never balanced: each node's _dbs is its own copy, and writes to it must go to the node we were given
+    path, node_local_port = get_node_local_path_and_port(node_details, path)
     return _do_request(node_details, path, node_local_port, method=method, params=params, json=json)
 
 
+def get_node_local_path_and_port(node_details, path, capabilities=None):
+    capabilities = capabilities or get_capabilities(node_details)
+    if capabilities.node_local_api:
+        return '_node/_local/' + path, node_details.port
+    else:
+        return path, node_details.node_local_port
+
+
+def get_capabilities(node_details):
+    """
+    Find out what a node supports by asking it, the first time we talk to it
+
+    The result is cached for the life of the process.
+    """
+    key = (node_details.ip, node_details.port)
+    with _capabilities_lock:
+        if key not in _capabilities_by_node:
+            _capabilities_by_node[key] = _detect_capabilities(node_details)
+        return _capabilities_by_node[key]
+
+
+def get_cached_capabilities(node_details):
+    """
+    :return: the Capabilities of the node if they have already been detected, otherwise None
+    """
+    with _capabilities_lock:
+        return _capabilities_by_node.get((node_details.ip, node_details.port))
+
+
+def cache_capabilities(node_details, capabilities):
+    with _capabilities_lock:
+        _capabilities_by_node[(node_details.ip, node_details.port)] = capabilities
+
+
+def _detect_capabilities(node_details):
+    # Only GETs are used, so probing never writes anything.
+    # GET _node/_local/_dbs succeeds where the node-local API is available, and
+    # _bulk_docs only takes POSTs, so a GET gets a 405 (rather than a 404) where it exists.
+    from requests import HTTPError
+
+    def _get_status(path, port):
+        try:
+            _do_request(node_details, path, port)
+        except HTTPError as e:
+            return e.response.status_code
+        return 200
+
+    welcome = _do_request(node_details, '', node_details.port)
+    node_local_api = _get_status('_node/_local/_dbs', node_details.port) == 200
+    if node_local_api:
+        dbs_path, node_local_port = '_node/_local/_dbs', node_details.port
+    else:
+        dbs_path, node_local_port = '_dbs', node_details.node_local_port
+    capabilities = make_capabilities(
+        welcome, node_local_api,
+        dbs_bulk_docs=_get_status(dbs_path + '/_bulk_docs', node_local_port) == 405,
+    )
+    warn_about_configured_version(node_details, capabilities)
+    return capabilities
+
+
+def make_capabilities(welcome, node_local_api, dbs_bulk_docs):
+    """
+    :param welcome: the response to GET /
+    """
+    version = welcome['version']
+    return Capabilities(
+        version=version,
+        features=welcome.get('features', []),
+        node_local_api=node_local_api,
+        # POST /_dbs_info was added in 2.2
+        dbs_info=parse_version(version) >= (2, 2, 0),
+        dbs_bulk_docs=dbs_bulk_docs,
+    )
+
+
+def warn_about_configured_version(node_details, capabilities):
+    if node_details.couchdb_version and \
+            parse_version(node_details.couchdb_version)[:2] != parse_version(capabilities.version)[:2]:
+        sys.stderr.write('Warning: {} is running CouchDB {}, not {} as configured. Using {}.\n'.format(
+            node_details.ip, capabilities.version, node_details.couchdb_version, capabilities.version))
+
+
+def parse_version(version):
+    """
+    Turn a version string like '2.3.1' into a tuple that compares correctly, like (2, 3, 1)
+    """
+    parts = []
+    for part in version.split('.'):
+        digits = ''.join(itertools.takewhile(str.isdigit, part))
+        parts.append(int(digits) if digits else 0)
+    while len(parts) < 3:
+        parts.append(0)
+    return tuple(parts)
+
+
 def _do_request(node_details, path, port, method='get', params=None, json=None):
+    import requests
     proxies = {}
     if node_details.socks_port:
         proxy = 'socks5://localhost:%s' % port
         proxies['http'] = proxy
         proxies['https'] = proxy
 
-    response = requests.request(
-        method=method,
-        url="http://{}:{}/{}".format(node_details.ip, port, path),
-        auth=(node_details.username, node_details.password) if node_details.username else None,
-        params=params,
-        json=json,
-        proxies=proxies
-    )
-    response.raise_for_status()
-    return response.json()
+    retry_policy = get_retry_policy()
+    circuit_breaker = get_circuit_breaker(node_details.ip, port)
+    can_retry = is_idempotent(method, path)
+    attempt = 0
+    start = time.perf_counter()
+    while True:
+        probe = circuit_breaker.before_request()
+        try:
+            response = requests.request(
+                method=method,
+                url="http://{}:{}/{}".format(node_details.ip, port, path),
+                auth=(node_details.username, node_details.password) if node_details.username else None,
+                params=params,
+                json=json,
+                proxies=proxies,
+                timeout=retry_policy.timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if is_retryable_error(e):
+                circuit_breaker.on_failure()
+                if can_retry and attempt < retry_policy.max_retries:
+                    time.sleep(retry_policy.get_backoff(attempt))
+                    attempt += 1
+                    continue
+            else:
+                circuit_breaker.on_success()
+            response = e.response
+            record_request(method, path, time.perf_counter() - start, retries=attempt, error=e,
+                           **_get_request_sizes(response) if response is not None else {})
+            raise
+        finally:
+            # a no-op unless the request was interrupted by something other than a RequestException
+            circuit_breaker.release_probe(probe)
+        circuit_breaker.on_success()
+        record_request(method, path, time.perf_counter() - start, retries=attempt, **_get_request_sizes(response))
+        return response.json()
+
+
+def _get_request_sizes(response):
+    return {
+        'bytes_sent': len(response.request.body or b'') if response.request is not None else 0,
+        'bytes_received': len(response.content),
+    }
 
 
 def get_db_list(node_details):
-    db_names = do_couch_request(node_details, '_all_dbs')
-    return db_names
+    return list(iter_db_list(node_details))
+
+
+def iter_db_list(node_details, page_size=1000):
+    """
+    Yield the name of every database in the cluster, fetching _all_dbs one page at a time
+
+    Each page is requested in the background as soon as the previous one arrives,
+    so (with gevent monkey-patching) callers can start working on the first databases
+    while later pages are still loading.
+    """
+    for page in iter_db_pages(node_details, page_size):
+        for db_name in page:
+            yield db_name
+
+
+def iter_db_pages(node_details, page_size=1000):
+    """
+    Like iter_db_list, but yield each page of database names as a list
+    """
+    import gevent
+
+    def _get_page(last_db_name):
+        params = {'limit': page_size}
+        if last_db_name is not None:
+            params['start_key'] = jsonlib.dumps(last_db_name)
+            params['skip'] = 1
+        return do_couch_request(node_details, '_all_dbs', params=params)
+
+    page = _get_page(None)
+    while page:
+        next_page = gevent.spawn(_get_page, page[-1]) if len(page) == page_size else None
+        yield page
+        page = next_page.get() if next_page is not None else None
 
 
 def get_db_metadata(node_details, db_name):
     return do_couch_request(node_details, db_name)
 
 
+def get_dbs_metadata(node_details, db_names, batch_size=100):
+    """
+    Get the db info of many databases, with POST /_dbs_info where the cluster supports it
+
+    100 is CouchDB's default max_db_number_for_dbs_info_req.
+
+    :return: dict of db_name->db info
+    """
+    db_names = list(db_names)
+    if not get_capabilities(node_details).dbs_info:
+        return {db_name: get_db_metadata(node_details, db_name) for db_name in db_names}
+
+    metadata_by_db_name = {}
+    for i in range(0, len(db_names), batch_size):
+        response = do_couch_request(node_details, '_dbs_info', method='post',
+                                    json={'keys': db_names[i:i + batch_size]})
+        for row in response:
+            if 'info' in row:
+                metadata_by_db_name[row['key']] = row['info']
+    return metadata_by_db_name
+
+
 def get_membership(config):
+    from .doc_models import MembershipDoc
     if isinstance(config, NodeDetails):
         node_details = config
         config = None
     else:
         node_details = config.get_control_node()
-    membership_doc = MembershipDoc.wrap(do_couch_request(node_details, '_membership'))
+    # which nodes are connected is as seen by this node
+    membership_doc = MembershipDoc.wrap(do_couch_request(node_details, '_membership', pinned=True))
     membership_doc.set_config(config)
     return membership_doc
 
 
 def get_shard_allocation(config, db_name, create=False):
+    from requests import HTTPError
+    from .doc_models import ShardAllocationDoc
     if isinstance(config, NodeDetails):
         node_details = config
         config = None
@@ -90,14 +300,99 @@ def get_shard_allocation(config, db_name, create=False):
     return shard_allocation_doc
 
 
+def _query_db_docs(node_details, db_names, include_docs, batch_size):
+    db_names = list(db_names)
+    for i in range(0, len(db_names), batch_size):
+        response = do_node_local_request(
+            node_details, '_dbs/_all_docs', method='post',
+            params={'include_docs': 'true'} if include_docs else None,
+            json={'keys': db_names[i:i + batch_size]},
+        )
+        for row in response['rows']:
+            if 'error' in row or row['value'].get('deleted'):
+                continue
+            yield row
+
+
+def get_existing_db_names(node_details, db_names, batch_size=1000):
+    """
+    Check which of db_names exist, using one _dbs/_all_docs request per batch
+    """
+    return {row['id'] for row in _query_db_docs(node_details, db_names, False, batch_size)}
+
+
+def get_db_docs(node_details, db_names, batch_size=1000):
+    """
+    Fetch the _dbs docs (shard maps) of db_names in bulk
+
+    :return: dict of db_name->doc; databases that do not exist are left out
+    """
+    return {row['id']: row['doc'] for row in _query_db_docs(node_details, db_names, True, batch_size)}
+
+
+def get_shard_allocations(config, db_names, create=False):
+    """
+    Bulk version of get_shard_allocation
+
+    :return: list of ShardAllocationDoc in the same order as db_names
+    """
+    if isinstance(config, NodeDetails):
+        node_details = config
+        config = None
+    else:
+        node_details = config.get_control_node()
+    db_names = list(db_names)
+    db_docs = get_db_docs(node_details, db_names)
+    return [make_shard_allocation_doc(config, db_name, db_docs.get(db_name), create) for db_name in db_names]
+
+
+def make_shard_allocation_doc(config, db_name, db_doc, create=False):
+    """
+    :param db_doc: the database's _dbs doc, or None if it doesn't exist
+    """
+    from .doc_models import ShardAllocationDoc
+    if db_doc is not None:
+        shard_allocation_doc = ShardAllocationDoc.wrap(db_doc)
+    elif create:
+        shard_allocation_doc = ShardAllocationDoc(_id=db_name)
+    else:
+        raise Exception('Database "{}" does not exist. Use "--create-missing-databases" flag if you want'
+                        ' to have the database created when the plan is committed.'.format(db_name))
+    shard_allocation_doc.set_config(config)
+    return shard_allocation_doc
+
+
+def bulk_put_db_docs(node_details, db_docs):
+    """
+    Write _dbs docs, with a single _bulk_docs request where the node supports it
+
+    :return: the list of per-doc results from couchdb
+    """
+    if get_capabilities(node_details).dbs_bulk_docs:
+        return do_node_local_request(node_details, '_dbs/_bulk_docs', method='post', json={'docs': db_docs})
+
+    from requests import HTTPError
+    results = []
+    for db_doc in db_docs:
+        try:
+            result = do_node_local_request(node_details, '_dbs/{}'.format(db_doc['_id']), method='put', json=db_doc)
+        except HTTPError as e:
+            result = dict(e.response.json(), id=db_doc['_id'])
+        results.append(result)
+    return results
+
+
 def put_shard_allocation(config, shard_allocation_doc):
+    from .cluster_state import get_cluster_state
     node_details = config.get_control_node()
-    return do_node_local_request(
+    response = do_node_local_request(
         node_details,
         '_dbs/{}'.format(shard_allocation_doc.db_name),
         method='PUT',
         json=shard_allocation_doc.to_json(),
     )
+    get_cluster_state(config).forget_shard_allocations([shard_allocation_doc.db_name])
+    return response
 
 
 def confirm(msg):
@@ -120,49 +415,37 @@ def set_up_parser(parser):
                         help='Port of control node. Default: 15984')
     parser.add_argument('--control-node-local-port', dest='control_node_local_port', default=15986, type=int,
                         help='Port of control node for local operations. Default: 15986')
-    parser.add_argument('--couchdb-version', dest='couchdb_version', default='2.3.1',
-                        help='Version of CouchDB. Default: 2.3.1')
-
+    parser.add_argument('--couchdb-version', dest='couchdb_version',
+                        help='Version of CouchDB you expect. The actual version is detected from the server '
+                             'and a warning is printed if they differ.')
+    add_retry_arguments(parser)
+    add_profile_arguments(parser)
+    add_balancer_arguments(parser)
 
-class Config(JsonObject):
-    control_node_ip = StringProperty()
-    control_node_port = IntegerProperty()
-    control_node_local_port = IntegerProperty()
-    couchdb_version = StringProperty()
-    username = StringProperty()
-    aliases = DictProperty(str)
 
-    def set_password(self, password):
-        self._password = password
+def read_config_file(filename):
+    from .config import Config
+    import yaml
+    with open(filename) as f:
+        # https://github.com/yaml/pyyaml/wiki/PyYAML-yaml.load(input)-Deprecation
+        return Config.wrap(yaml.safe_load(f))
 
-    def get_control_node(self):
-        return NodeDetails(
-            self.control_node_ip, self.control_node_port, self.control_node_local_port, self.couchdb_version,
-            self.username, self._password, None
-        )
-
-    def format_node_name(self, node):
-        if node in self.aliases:
-            return self.aliases[node]
-        elif node.startswith('couchdb@'):
-            return node[len('couchdb@'):]
-        else:
-            return node
 
-    def get_formal_node_name(self, node_nickname):
-        if not hasattr(self, '_formal_name_lookup'):
-            self._formal_name_lookup = {
-                nickname: formal_name
-                for formal_name, nickname in self.aliases.items()
-            }
-        return self._formal_name_lookup[node_nickname]
+def get_password(config):
+    if 'COUCHDB_CLUSTER_ADMIN_PASSWORD' in os.environ:
+        return os.environ['COUCHDB_CLUSTER_ADMIN_PASSWORD']
+    elif config.username:
+        return getpass.getpass('Password for "{}@{}":'.format(config.username, config.control_node_ip))
+    else:
+        return None
 
 
 def get_config_from_args(args):
+    from .config import Config
+    set_up_profiling(args)
+    set_up_retries(args)
     if args.conf:
-        with open(args.conf) as f:
-            # https://github.com/yaml/pyyaml/wiki/PyYAML-yaml.load(input)-Deprecation
-            config = Config.wrap(yaml.load(f))
+        config = read_config_file(args.conf)
     else:
         config = Config(
             control_node_ip=args.control_node_ip,
@@ -171,15 +454,12 @@ def get_config_from_args(args):
             couchdb_version=args.couchdb_version,
             username=args.username,
             aliases=None,
+            zones=None,
+            capacities=None,
         )
 
-    if 'COUCHDB_CLUSTER_ADMIN_PASSWORD' in os.environ:
-        password = os.environ['COUCHDB_CLUSTER_ADMIN_PASSWORD']
-    elif config.username:
-        password = getpass.getpass('Password for "{}@{}":'.format(config.username, config.control_node_ip))
-    else:
-        password = None
-    config.set_password(password)
+    config.set_password(get_password(config))
+    set_up_read_balancer(args, config)
     return config
 
 
@@ -209,7 +489,7 @@ def remove_node_from_cluster(node_details, node_to_remove):
 
 
 def check_connection(node_details):
-    do_couch_request(node_details, '')
+    do_couch_request(node_details, '', pinned=True)
 
 
 def is_node_in_cluster(node_details, node_to_check):
@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+from collections import defaultdict, namedtuple
+
+from .file_plan import figure_out_what_you_can_and_cannot_delete, read_plan_file
+from .suggest_shard_allocation import add_size_metric_argument
+from .utils import (
+    check_connection,
+    get_arg_parser,
+    get_config_from_args,
+    humansize,
+)
+
+RangeMove = namedtuple('RangeMove', 'db_name shard size current_nodes target_nodes')
+
+
+def get_added_nodes(move):
+    return sorted(set(move.target_nodes) - set(move.current_nodes))
+
+
+def get_removed_nodes(move):
+    return sorted(set(move.current_nodes) - set(move.target_nodes))
+
+
+def get_range_moves(db_info, plan):
+    """
+    Find every range whose nodes differ between the cluster and the plan
+
+    :param db_info: as returned by suggest_shard_allocation.get_db_info
+    :param plan: as returned by read_plan_file
+    :return: list of RangeMove, with db and view sizes split evenly between shards
+             as in suggest_shard_allocation.get_shard_sizes
+    """
+    current_by_db_name = {db_name: (size, view_sizes, shards, shard_allocation_doc)
+                          for db_name, size, view_sizes, shards, shard_allocation_doc in db_info}
+    moves = []
+    for db_name, plan_allocation_doc in sorted(plan.items()):
+        if db_name in current_by_db_name:
+            size, view_sizes, shards, shard_allocation_doc = current_by_db_name[db_name]
+            shard_size = 1.0 * sum([size] + list(view_sizes.values())) / len(shards)
+            current_by_range = shard_allocation_doc.by_range
+        else:
+            # a database the plan will create; there's nothing to copy
+            shard_size = 0
+            current_by_range = {}
+        for shard, nodes in sorted(plan_allocation_doc.by_range.items()):
+            current_nodes = current_by_range.get(shard, [])
+            if set(nodes) != set(current_nodes):
+                moves.append(RangeMove(db_name, shard, shard_size, list(current_nodes), list(nodes)))
+    return moves
+
+
+class WavePlanningError(Exception):
+    pass
+
+
+def plan_waves(moves, free_space_by_node=None, max_bytes_in_flight=None, headroom=0):
+    """
+    Split range moves into stages that can be carried out one after another
+
+    Within a stage, every range's new copies are copied to their nodes before the stage's plan is committed;
+    the copies it drops are only pruned once it has been. So a node needs room for everything a stage
+    copies to it, on top of `headroom`, and only gets back the space of the copies it drops in later stages.
+    No stage copies more than max_bytes_in_flight in total. Ranges are placed largest first,
+    each in the first stage with room for it.
+
+    :param moves: list of RangeMove
+    :param free_space_by_node: dict of node->bytes free before the first stage; nodes not in it are unlimited
+    :return: list of stages, each a list of RangeMove
+    """
+    free_space_by_node = dict(free_space_by_node or {})
+    pending = sorted(moves, key=lambda move: (-move.size, move.db_name, move.shard))
+    stages = []
+    while pending:
+        stage = []
+        still_pending = []
+        incoming_by_node = defaultdict(int)
+        in_flight = 0
+        for move in pending:
+            added_nodes = get_added_nodes(move)
+            copied = move.size * len(added_nodes)
+            fits = (max_bytes_in_flight is None or in_flight + copied <= max_bytes_in_flight) and all(
+                node not in free_space_by_node
+                or incoming_by_node[node] + move.size <= free_space_by_node[node] - headroom
+                for node in added_nodes
+            )
+            if fits:
+                stage.append(move)
+                in_flight += copied
+                for node in added_nodes:
+                    incoming_by_node[node] += move.size
+            else:
+                still_pending.append(move)
+
+        if not stage:
+            move = still_pending[0]
+            raise WavePlanningError(
+                u'No room to move the {} ranges left, starting with {} {} ({} to copy to {}). '
+                u'Free up disk space or raise the limit on bytes in flight.'.format(
+                    len(still_pending), move.db_name, move.shard, humansize(move.size),
+                    u', '.join(get_added_nodes(move))))
+        for move in stage:
+            for node in get_added_nodes(move):
+                if node in free_space_by_node:
+                    free_space_by_node[node] -= move.size
+            for node in get_removed_nodes(move):
+                if node in free_space_by_node:
+                    free_space_by_node[node] += move.size
+        stages.append(stage)
+        pending = still_pending
+    return stages
+
+
+def get_stage_plans(db_info, stages):
+    """
+    Turn stages into plans that can each be committed with `suggest-shard-allocation --from-plan`
+
+    Each stage's plan has every database the stage touches,
+    with its ranges as they'll be once that stage (and every earlier one) is done.
+
+    :return: list of plans, each a dict of db_name->ShardAllocationDoc
+    """
+    from .doc_models import ShardAllocationDoc
+    by_range_by_db_name = {db_name: dict(shard_allocation_doc.by_range)
+                           for db_name, _, _, _, shard_allocation_doc in db_info}
+    shard_suffix_by_db_name = {db_name: list(shard_allocation_doc.shard_suffix)
+                               for db_name, _, _, _, shard_allocation_doc in db_info}
+    stage_plans = []
+    for stage in stages:
+        for move in stage:
+            by_range_by_db_name.setdefault(move.db_name, {})[move.shard] = list(move.target_nodes)
+        stage_plan = {}
+        for db_name in sorted({move.db_name for move in stage}):
+            doc = ShardAllocationDoc(_id=db_name, shard_suffix=shard_suffix_by_db_name.get(db_name, []))
+            doc.populate_from_range(dict(by_range_by_db_name[db_name]))
+            stage_plan[db_name] = doc
+        stage_plans.append(stage_plan)
+    return stage_plans
+
+
+def write_stage_files(config, stages, stage_plans, shard_suffix_by_db_name, output_dir):
+    """
+    Write each stage's plan file along with its `file_plan important`/`prune` lists for every node
+
+    :return: list of the plan files written
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    plan_files = []
+    for i, (stage, stage_plan) in enumerate(zip(stages, stage_plans), 1):
+        stage_name = u'stage-{:02d}'.format(i)
+        plan_file = os.path.join(output_dir, u'{}.plan.json'.format(stage_name))
+        with open(plan_file, 'w') as f:
+            json.dump({db_name: doc.to_plan_json() for db_name, doc in stage_plan.items()}, f)
+        plan_files.append(plan_file)
+
+        important_files_by_node, deletable_files_by_node = figure_out_what_you_can_and_cannot_delete(
+            stage_plan, shard_suffix_by_db_name)
+        # a node the stage takes every copy of these databases off has nothing important, and so no prune list
+        all_filenames = {file.filename for files in important_files_by_node.values() for file in files}
+        for move in stage:
+            for node in get_removed_nodes(move):
+                if node not in important_files_by_node:
+                    deletable_files_by_node[node] = all_filenames
+        manifests = [('important', {node: {file.filename for file in files}
+                                    for node, files in important_files_by_node.items()}),
+                     ('prune', deletable_files_by_node)]
+        for kind, filenames_by_node in manifests:
+            for node, filenames in filenames_by_node.items():
+                manifest_file = os.path.join(output_dir, u'{}.{}.{}.txt'.format(
+                    stage_name, kind, config.format_node_name(node)))
+                with open(manifest_file, 'w') as f:
+                    for filename in sorted(filenames):
+                        f.write(u'{}\n'.format(filename))
+    return plan_files
+
+
+def parse_free_disk(config, values):
+    """
+    Parse --free-disk-gb values: either node:GB, or a bare GB value for every node not named
+
+    :return: tuple(dict of node->bytes, default bytes or None)
+    """
+    free_space_by_node = {}
+    default = None
+    for value in values:
+        if ':' in value:
+            node, gb = value.rsplit(':', 1)
+            free_space_by_node[config.get_formal_node_name(node)] = float(gb) * 1024 ** 3
+        else:
+            default = float(value) * 1024 ** 3
+    return free_space_by_node, default
+
+
+def print_stages(config, stages):
+    row = u"{: <10}\t{: >8}\t{: >12}\t{}"
+    print(row.format(u"Stage", u"Ranges", u"To copy", u"Copied to"))
+    for i, stage in enumerate(stages, 1):
+        incoming_by_node = defaultdict(int)
+        for move in stage:
+            for node in get_added_nodes(move):
+                incoming_by_node[node] += move.size
+        print(row.format(
+            i, len(stage), humansize(sum(incoming_by_node.values())),
+            u', '.join(u'{} {}'.format(config.format_node_name(node), humansize(size))
+                       for node, size in sorted(incoming_by_node.items())),
+        ))
+
+
+def main():
+    parser = get_arg_parser(u'Split a plan into stages that fit the free disk space on each node')
+    parser.add_argument('--from-plan', dest='plan_file', required=True,
+                        help=u'The target shard allocation to split into stages')
+    parser.add_argument('--free-disk-gb', dest='free_disk', nargs='+', default=[],
+                        help=u'Free disk space on each node, like couch1:500 couch2:320, '
+                             u'or a single number for every node not listed. '
+                             u'Nodes without a value are treated as having unlimited space.')
+    parser.add_argument('--headroom-gb', dest='headroom_gb', type=float, default=0,
+                        help=u'Disk space to leave free on every node. Default: 0')
+    parser.add_argument('--max-in-flight-gb', dest='max_in_flight_gb', type=float,
+                        help=u'Most data any one stage may copy between nodes')
+    parser.add_argument('--output-dir', dest='output_dir', required=True,
+                        help=u'Where to write the plan file and file lists of each stage')
+    add_size_metric_argument(parser)
+    args = parser.parse_args()
+
+    from .suggest_shard_allocation import get_db_info
+
+    config = get_config_from_args(args)
+    check_connection(config.get_control_node())
+    plan = read_plan_file(args.plan_file)
+    db_info = get_db_info(config, args.size_metric)
+    moves = get_range_moves(db_info, plan)
+
+    free_space_by_node, default_free_space = parse_free_disk(config, args.free_disk)
+    if default_free_space is not None:
+        for move in moves:
+            for node in move.target_nodes:
+                free_space_by_node.setdefault(node, default_free_space)
+
+    stages = plan_waves(
+        moves, free_space_by_node,
+        max_bytes_in_flight=args.max_in_flight_gb * 1024 ** 3 if args.max_in_flight_gb else None,
+        headroom=args.headroom_gb * 1024 ** 3,
+    )
+
+    print_stages(config, stages)
+    shard_suffix_by_db_name = {db_name: shard_allocation_doc.usable_shard_suffix
+                               for db_name, _, _, _, shard_allocation_doc in db_info}
+    for db_name in plan:
+        # databases the plan creates don't have a suffix yet
+        shard_suffix_by_db_name.setdefault(db_name, '.*')
+    plan_files = write_stage_files(
+        config, stages, get_stage_plans(db_info, stages), shard_suffix_by_db_name, args.output_dir)
+    print(u'Wrote {} stages to {}. For each stage in order: copy the files in its important lists, '
+          u'commit its plan, wait for the monitor to finish, then remove the files in its prune lists.'.format(
+              len(plan_files), args.output_dir))
+
+
+if __name__ == '__main__':
+    from gevent import monkey; monkey.patch_all()
+    main()
@@ -1,19 +1,63 @@
 from __future__ import absolute_import
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import requests
+from aiohttp import web
 from mock.mock import patch
 
-from couchdb_cluster_admin.suggest_shard_allocation import suggest_shard_allocation, _NodeAllocation
+from benchmarks.crawl import find_regressions
+from couchdb_cluster_admin.aio import AsyncClient
+from couchdb_cluster_admin.allocation_search import _Problem, search_shard_allocation
+from couchdb_cluster_admin.balancer import ReadBalancer, set_read_balancer
+from couchdb_cluster_admin.cli import COMMANDS
+from couchdb_cluster_admin.cluster_state import get_cluster_state
+from couchdb_cluster_admin.suggest_shard_allocation import get_db_info, ShardIndex, suggest_shard_allocation, \
+    _NodeAllocation
+from couchdb_cluster_admin.describe import ShardMapWatcher
 from couchdb_cluster_admin.doc_models import ShardAllocationDoc
-from couchdb_cluster_admin.file_plan import get_missing_files_by_node_and_source, Nodefile
+from couchdb_cluster_admin.fake_cluster import FakeCluster
+from couchdb_cluster_admin.fleet import crawl_fleet, get_capacity_by_node, get_imbalance
+from couchdb_cluster_admin.file_plan import check_verification_reports, FileMismatch, \
+    get_missing_files_by_node_and_source, get_node_files, get_plan_digest, hash_file, Nodefile, verify_node_files, \
+    write_node_manifests
+from couchdb_cluster_admin.compact import CompactionOrchestrator, get_all_shard_copy_sizes, \
+    get_copies_to_compact, get_reclaimable
+from couchdb_cluster_admin.add_replica_node import _update_db_doc_with_new_node
+from couchdb_cluster_admin.copy_db_to_new_cluster import _copy_db_docs
+from couchdb_cluster_admin.journal import Journal, open_journal, undo_journal
+from couchdb_cluster_admin.instrumentation import add_instrument, classify_endpoint, Profiler, \
+    record_request, remove_instrument
+from couchdb_cluster_admin.monitor import ConvergenceMonitor, get_backlog, get_replica_status, get_replicas_to_monitor, \
+    get_shard_file_path, ReplicaStatus
+from couchdb_cluster_admin.plan_cost import AllocationIndex, get_allocation_changes, get_transfer_seconds
+from couchdb_cluster_admin.reshard import get_split_shard_sizes, plan_splits, split_shard, split_shard_to_depth
+from couchdb_cluster_admin.waves import get_range_moves, get_stage_plans, plan_waves, WavePlanningError
+from couchdb_cluster_admin.simulate import FailureSimulator, ScenarioResult
+from couchdb_cluster_admin.retry import CircuitBreaker, get_circuit_breaker, RetryPolicy, set_retry_policy
+from couchdb_cluster_admin.config import Config
+from couchdb_cluster_admin.utils import _detect_capabilities, bulk_put_db_docs, Capabilities, check_connection, \
+    get_db_docs, get_db_list, get_dbs_metadata, get_membership, get_node_local_path_and_port, make_capabilities, \
+    do_couch_request, iter_db_list, iter_db_pages, NodeDetails, parse_version
 
 
 @patch('couchdb_cluster_admin.file_plan.get_node_files', return_value=({'node1': [
     Nodefile('db1', 'node2', 'shard3', 'f3'),
+    Nodefile('db1', 'node3', 'shard4', 'f4'),
+    Nodefile('db2', 'node3', 'shard1', 'f5'),
     Nodefile('db1', 'node3', 'shard1', 'f1'),
     Nodefile('db1', 'node3', 'shard2', 'f2'),
-    Nodefile('db1', 'node3', 'shard4', 'f4'),
 ]}, None))
-@patch('couchdb_cluster_admin.file_plan.get_shard_allocation', return_value=ShardAllocationDoc.from_plan_json(
-    'db1', {
+@patch('couchdb_cluster_admin.cluster_state.get_db_docs', return_value={
+    db_name: ShardAllocationDoc.from_plan_json(db_name, {
         'shard_suffix': '123132',
         'by_range': {
             'shard1': ['node1'],
@@ -21,8 +65,9 @@ from couchdb_cluster_admin.file_plan import get_missing_files_by_node_and_source
             'shard3': ['node2'],
             'shard4': ['node2'],
         }
-    }
-))
+    }).to_json()
+    for db_name in ['db1', 'db2']
+})
 def test_get_missing_files(m1, m2):
     """
     from:
@@ -33,13 +78,166 @@ def test_get_missing_files(m1, m2):
     node2: shard3
     node3: shard1, shard2, shard4
     """
-    missing_files = get_missing_files_by_node_and_source(None, None)
+    config = Config(control_node_ip='10.0.0.1')
+    config.set_password(None)
+    missing_files = get_missing_files_by_node_and_source(config, None)
     assert missing_files == {
         'node3': {
-            'node1': [Nodefile('db1', 'node3', 'shard1', 'f1'), Nodefile('db1', 'node3', 'shard2', 'f2')],
+            'node1': [Nodefile('db1', 'node3', 'shard1', 'f1'), Nodefile('db1', 'node3', 'shard2', 'f2'),
+                      Nodefile('db2', 'node3', 'shard1', 'f5')],
             'node2': [Nodefile('db1', 'node3', 'shard4', 'f4')],
         }
     }
+    # files of the same database don't have to be next to each other for its shard map to be fetched only once
+    m1.assert_called_once_with(config.get_control_node(), ['db1', 'db2'])
+
+
+def test_write_node_manifests():
+    with FakeCluster(n_nodes=3, n=1, q=2) as cluster:
+        node1, node2, node3 = cluster.nodes
+        cluster.add_db('a', by_range={'00000000-7fffffff': [node1], '80000000-ffffffff': [node2]})
+        config = cluster.get_config()
+        suffix = get_db_docs(config.get_control_node(), ['a'])['a']['shard_suffix']
+        suffix = ''.join(map(chr, suffix))
+        plan = {'a': ShardAllocationDoc.from_plan_json('a', {
+            'shard_suffix': suffix, 'by_range': {'00000000-7fffffff': [node1, node3], '80000000-ffffffff': [node3]}})}
+        output_dir = tempfile.mkdtemp()
+        try:
+            with patch('couchdb_cluster_admin.cluster_state.get_db_docs', wraps=get_db_docs) as mock:
+                manifest_files = write_node_manifests(config, plan, output_dir, workers=2)
+            # every node's lists from a single fetch of the shard maps
+            mock.assert_called_once()
+            assert len(manifest_files) == 9
+
+            def _read(name):
+                with open(os.path.join(output_dir, name)) as f:
+                    return f.read().splitlines()
+
+            important_files_by_node, _ = get_node_files(config, plan)
+            assert _read('important.node3.txt') == sorted(file.filename for file in important_files_by_node[node3])
+            assert _read('prune.node1.txt') == [
+                '.shards/80000000-ffffffff/a{}_design'.format(suffix), 'shards/80000000-ffffffff/a{}.couch'.format(suffix)]
+            # node2 keeps nothing, so everything on it can go
+            assert _read('important.node2.txt') == []
+            assert len(_read('prune.node2.txt')) == 4
+            assert _read('missing.node1.txt') == []
+            assert _read('missing.node3.txt') == sorted(
+                '{}\t{}'.format('node1' if file.shard == '00000000-7fffffff' else 'node2', file.filename)
+                for file in important_files_by_node[node3])
+        finally:
+            shutil.rmtree(output_dir)
+
+
+def test_cluster_state_single_flight():
+    import gevent
+    calls = []
+
+    def _get_db_docs(node_details, db_names):
+        calls.append(list(db_names))
+        gevent.sleep(0.01)
+        return {db_name: {'_id': db_name, 'by_range': {}, 'by_node': {}} for db_name in db_names if db_name != 'gone'}
+
+    config = Config(control_node_ip='10.0.0.1')
+    config.set_password(None)
+    cluster_state = get_cluster_state(config)
+    assert get_cluster_state(config) is cluster_state
+    with patch('couchdb_cluster_admin.cluster_state.get_db_docs', side_effect=_get_db_docs):
+        jobs = [gevent.spawn(cluster_state.get_shard_allocations, ['db1', 'db2']),
+                gevent.spawn(cluster_state.get_shard_allocations, ['db2', 'db3'])]
+        gevent.joinall(jobs, raise_error=True)
+        assert calls == [['db1', 'db2'], ['db3']]
+        # each caller gets its own copy to change
+        jobs[0].value[1].by_range['00000000-ffffffff'] = ['node1']
+        assert cluster_state.get_shard_allocation('db2').by_range == {}
+        assert len(calls) == 2
+
+        try:
+            cluster_state.get_shard_allocation('gone')
+        except Exception as e:
+            assert 'does not exist' in str(e)
+        else:
+            assert False, 'expected an exception'
+        assert cluster_state.get_shard_allocation('gone', create=True).db_name == 'gone'
+
+        cluster_state.forget_shard_allocations(['db1'])
+        cluster_state.get_shard_allocation('db1')
+        assert calls[-1] == ['db1']
+
+
+def test_verify_node_files():
+    root = tempfile.mkdtemp()
+    try:
+        def _write(path, content):
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+
+        _write('source/shards/0-f/good.1.couch', b'abc' * 1000)
+        _write('target/shards/0-f/good.1.couch', b'abc' * 1000)
+        # the source has had more written to it since it was copied, which is only fine with allow_partial
+        _write('source/shards/0-f/grown.1.couch', b'abc' * 1000 + b'more')
+        _write('target/shards/0-f/grown.1.couch', b'abc' * 1000)
+        _write('source/shards/0-f/empty.1.couch', b'abc' * 1000)
+        _write('target/shards/0-f/empty.1.couch', b'')
+        _write('source/shards/0-f/bad.1.couch', b'abc')
+        _write('target/shards/0-f/bad.1.couch', b'abd')
+        _write('source/shards/0-f/missing.1.couch', b'abc')
+        _write('source/.shards/0-f/good.1_design/mrview/1.view', b'view')
+        _write('source/.shards/0-f/good.1_design/mrview/2.view', b'view')
+        _write('target/.shards/0-f/good.1_design/mrview/1.view', b'view')
+
+        assert hash_file(os.path.join(root, 'source/shards/0-f/grown.1.couch'), length=3000, chunk_size=7) == \
+            hash_file(os.path.join(root, 'target/shards/0-f/grown.1.couch'))
+        files = [Nodefile(db_name, 'node2', '0-f', filename) for db_name, filename in [
+            ('good', 'shards/0-f/good.1.couch'), ('grown', 'shards/0-f/grown.1.couch'),
+            ('empty', 'shards/0-f/empty.1.couch'), ('bad', 'shards/0-f/bad.1.couch'),
+            ('missing', 'shards/0-f/missing.1.couch'), ('good', '.shards/0-f/good.1_design'),
+        ]]
+        source_dir_by_file = {file: os.path.join(root, 'source') for file in files}
+        mismatches = verify_node_files(files, os.path.join(root, 'target'), source_dir_by_file, workers=2)
+        assert mismatches == [
+            FileMismatch('shards/0-f/grown.1.couch', '3000 bytes, smaller than the source (3004 bytes)'),
+            FileMismatch('shards/0-f/empty.1.couch', '0 bytes, smaller than the source (3000 bytes)'),
+            FileMismatch('shards/0-f/bad.1.couch', 'contents differ from the source'),
+            FileMismatch('shards/0-f/missing.1.couch', 'missing'),
+            FileMismatch('.shards/0-f/good.1_design/mrview/2.view', 'missing'),
+        ]
+        # an empty copy never passes
+        mismatches = verify_node_files(files, os.path.join(root, 'target'), source_dir_by_file, workers=2,
+                                       allow_partial=True)
+        assert [mismatch.filename for mismatch in mismatches] == [
+            'shards/0-f/empty.1.couch', 'shards/0-f/bad.1.couch', 'shards/0-f/missing.1.couch',
+            '.shards/0-f/good.1_design/mrview/2.view',
+        ]
+    finally:
+        shutil.rmtree(root)
+
+
+def test_check_verification_reports():
+    plan = {'db1': ShardAllocationDoc.from_plan_json('db1', {'shard_suffix': '.1', 'by_range': {
+        '00000000-ffffffff': ['node1', 'node2']}})}
+    other_plan = {'db1': ShardAllocationDoc.from_plan_json('db1', {'shard_suffix': '.1', 'by_range': {
+        '00000000-ffffffff': ['node1', 'node3']}})}
+    root = tempfile.mkdtemp()
+    try:
+        reports = []
+        for i, (report_plan, ok) in enumerate([(plan, True), (plan, False), (other_plan, True)]):
+            reports.append(os.path.join(root, '{}.json'.format(i)))
+            with open(reports[-1], 'w') as f:
+                json.dump({'node': 'node2', 'plan_digest': get_plan_digest(report_plan), 'ok': ok,
+                           'mismatches': [] if ok else [{'filename': 'f', 'problem': 'missing'}]}, f)
+        assert check_verification_reports(plan, reports[:1]) == ['node2']
+        for report in reports[1:]:
+            try:
+                check_verification_reports(plan, [report])
+            except Exception:
+                pass
+            else:
+                assert False, 'expected {} to block the commit'.format(report)
+    finally:
+        shutil.rmtree(root)
 
 
 def test_suggest_shard_allocation():
@@ -181,3 +379,837 @@ def test_suggest_shard_allocation__increase_copies():
     for i, node in enumerate(new_allocation):
         # the nodes should now be properly balanced with 3 shard-copies per node
         assert len(node.shards) == 3
+
+
+@patch('couchdb_cluster_admin.utils.get_capabilities',
+       return_value=make_capabilities({'version': '2.3.1'}, node_local_api=False, dbs_bulk_docs=True))
+def test_copy_db_docs_in_bulk(m1):
+    from_details = NodeDetails('10.0.0.1', 15984, 15986, '2.3.1', None, None, None)
+    to_details = [NodeDetails(ip, 15984, 15986, '2.3.1', None, None, None) for ip in ('10.0.1.1', '10.0.1.2')]
+    db_names = ['db{}'.format(i) for i in range(50)]
+    requests_made = []
+
+    def fake_request(node_details, path, method='get', params=None, json=None):
+        requests_made.append((node_details.ip, path))
+        if path == '_dbs/_all_docs' and node_details.ip == '10.0.1.1':
+            return {'rows': [
+                {'id': 'db0', 'key': 'db0', 'value': {'rev': '1-a'}},
+                {'id': 'db1', 'key': 'db1', 'value': {'rev': '2-a', 'deleted': True}},
+            ] + [{'key': key, 'error': 'not_found'} for key in json['keys'][2:]]}
+        if path == '_dbs/_all_docs':
+            return {'rows': [
+                {'id': key, 'key': key, 'value': {'rev': '1-a'}, 'doc': {
+                    '_id': key, 'shard_suffix': [46, 49], 'by_node': {'couchdb@10.0.0.1': ['00000000-ffffffff']},
+                }} for key in json['keys']
+            ]}
+        if path == '_dbs/_bulk_docs':
+            written.extend(json['docs'])
+            return [{'ok': True, 'id': doc['_id'], 'rev': '1-b'} for doc in json['docs']]
+        raise AssertionError(path)
+
+    written = []
+    with patch('couchdb_cluster_admin.utils.do_node_local_request', side_effect=fake_request):
+        _copy_db_docs(from_details, to_details, db_names)
+
+    assert requests_made == [
+        ('10.0.1.1', '_dbs/_all_docs'), ('10.0.0.1', '_dbs/_all_docs'), ('10.0.1.1', '_dbs/_bulk_docs'),
+    ]
+    assert [doc['_id'] for doc in written] == db_names[1:]
+    assert written[0]['by_range'] == {'00000000-ffffffff': ['couchdb@10.0.1.1', 'couchdb@10.0.1.2']}
+
+
+def test_copy_db_docs_journal_resume_and_undo():
+    journal_file = os.path.join(tempfile.mkdtemp(), 'copy.journal')
+    args = argparse.Namespace(journal=journal_file, resume=False, undo=False)
+    with FakeCluster(n_nodes=1, n=1, q=2) as source, FakeCluster(n_nodes=2, n=1, q=2) as destination:
+        for db_name in ('a', 'b', 'c'):
+            source.add_db(db_name)
+        destination.add_db('b')
+        from_details = source.get_config().get_control_node()
+        to_details = [destination.get_config().get_control_node()]
+        params = {'from_ip': from_details.ip}
+        with open_journal(args, 'copy-db-to-new-cluster', params) as journal:
+            # stopped part way through
+            _copy_db_docs(from_details, to_details, ['a', 'b'], journal=journal)
+        with open(journal_file, 'a') as f:
+            f.write('{"db_name": "c", "act')
+
+        try:
+            open_journal(args, 'copy-db-to-new-cluster', params)
+        except Exception as e:
+            assert '--resume' in str(e)
+        else:
+            assert False, 'expected a journal with progress in it to need --resume'
+        args.resume = True
+        try:
+            open_journal(args, 'copy-db-to-new-cluster', {'from_ip': '10.0.0.1'})
+        except Exception as e:
+            assert 'different run' in str(e)
+        else:
+            assert False, 'expected a journal of another run to be refused'
+
+        with open_journal(args, 'copy-db-to-new-cluster', params) as journal:
+            assert journal.get_done() == {'a', 'b'}
+            with patch('couchdb_cluster_admin.copy_db_to_new_cluster.get_db_docs', wraps=get_db_docs) as mock:
+                _copy_db_docs(from_details, to_details, ['a', 'b', 'c'], journal=journal)
+            assert mock.call_args[0][1] == ['c']
+        assert sorted(get_db_docs(to_details[0], ['a', 'b', 'c'])) == ['a', 'b', 'c']
+
+        args.resume, args.undo = False, True
+        with open_journal(args, 'copy-db-to-new-cluster', params) as journal:
+            undo_journal(to_details[0], journal)
+            assert journal.get_done() == {'b'}
+            assert journal.get_changes_to_undo() == []
+        # only what the copy created is gone
+        assert sorted(get_db_docs(to_details[0], ['a', 'b', 'c'])) == ['b']
+
+
+def test_add_replica_node_undo():
+    with FakeCluster(n_nodes=2, n=1, q=2) as cluster:
+        cluster.add_db('a', by_range={'00000000-7fffffff': [cluster.nodes[0]],
+                                      '80000000-ffffffff': [cluster.nodes[0]]})
+        node_details = cluster.get_config().get_control_node()
+        before = get_db_docs(node_details, ['a'])['a']
+        journal = Journal(None, 'add-replica-node')
+        _update_db_doc_with_new_node(node_details, 'a', cluster.nodes[1], journal)
+        _update_db_doc_with_new_node(node_details, 'a', cluster.nodes[1], journal)
+        after = get_db_docs(node_details, ['a'])['a']
+        assert sorted(after['by_node']) == cluster.nodes
+        assert [entry['changed'] for entry in journal.entries] == [True, False]
+
+        undo_journal(node_details, journal)
+        restored = get_db_docs(node_details, ['a'])['a']
+        assert restored['by_node'] == before['by_node'] and restored['by_range'] == before['by_range']
+        assert restored['_rev'] != after['_rev']
+
+
+def test_get_backlog():
+    backlog_by_node, unconverged_ranges = get_backlog([
+        ReplicaStatus('db1', 'shard1', 'node1', 100, '100-a'),
+        ReplicaStatus('db1', 'shard1', 'node2', 40, '40-b'),
+        ReplicaStatus('db1', 'shard2', 'node1', 7, '7-a'),
+        ReplicaStatus('db1', 'shard2', 'node2', 7, '9-b'),
+        ReplicaStatus('db2', 'shard1', 'node1', 0, None),
+        ReplicaStatus('db2', 'shard1', 'node2', 0, '0-b'),
+    ])
+    assert backlog_by_node == {'node1': 0, 'node2': 60}
+    assert unconverged_ranges == {('db1', 'shard1'), ('db2', 'shard1')}
+
+
+def test_get_replica_status_of_db_name_with_slash():
+    assert get_shard_file_path('a/b', '00000000-ffffffff', '.123') == 'shards%2F00000000-ffffffff%2Fa%2Fb.123'
+    with FakeCluster(n_nodes=1, n=1, q=1) as cluster:
+        cluster.add_db('a/b')
+        config = cluster.get_config()
+        db_doc = get_db_docs(config.get_control_node(), ['a/b'])['a/b']
+        shard, = db_doc['by_range']
+        status = get_replica_status(config, 'a/b', shard, ''.join(map(chr, db_doc['shard_suffix'])), cluster.nodes[0])
+    assert status.doc_total == 100 and status.update_seq is not None
+
+
+def test_get_replicas_to_monitor_uses_plan_suffix():
+    plan = {
+        'db1': ShardAllocationDoc.from_plan_json('db1', {
+            'shard_suffix': '.123', 'by_range': {'shard1': ['node1', 'node2']}}),
+        'db2': ShardAllocationDoc.from_plan_json('db2', {
+            'shard_suffix': '', 'by_range': {'shard1': ['node1']}}),
+    }
+    config = Config(control_node_ip='10.0.0.1', control_node_port=15984, control_node_local_port=15986,
+                    couchdb_version='2.3.1')
+    config.set_password(None)
+    with patch('couchdb_cluster_admin.monitor.get_db_docs',
+               return_value={'db2': {'shard_suffix': [ord(c) for c in '.456']}}) as get_db_docs:
+        replicas = get_replicas_to_monitor(config, plan)
+    # only the database missing a suffix in the plan is looked up, in one bulk request
+    get_db_docs.assert_called_once_with(config.get_control_node(), ['db2'])
+    assert replicas == [
+        ('db1', 'shard1', '.123', 'node1'),
+        ('db1', 'shard1', '.123', 'node2'),
+        ('db2', 'shard1', '.456', 'node1'),
+    ]
+
+
+@patch('couchdb_cluster_admin.monitor.get_replicas_to_monitor', return_value=[])
+def test_convergence_monitor_interval_and_eta(m1):
+    monitor = ConvergenceMonitor(None, {}, min_interval=5, max_interval=40)
+    polls = [
+        (0, [ReplicaStatus('db1', 'shard1', 'node1', 100, '1-a'),
+             ReplicaStatus('db1', 'shard1', 'node2', 0, '0-b')]),
+        (10, [ReplicaStatus('db1', 'shard1', 'node1', 100, '1-a'),
+              ReplicaStatus('db1', 'shard1', 'node2', 50, '50-b')]),
+        (20, [ReplicaStatus('db1', 'shard1', 'node1', 100, '1-a'),
+              ReplicaStatus('db1', 'shard1', 'node2', 50, '50-b')]),
+    ]
+    with patch('couchdb_cluster_admin.monitor.poll_replicas') as poll_replicas, \
+            patch('couchdb_cluster_admin.monitor.time.time') as time:
+        poll_time, poll_replicas.return_value = polls[0]
+        time.return_value = poll_time
+        monitor.poll()
+        # nothing to compare against yet
+        assert monitor.interval == 5
+        assert monitor.get_eta('node2') is None
+
+        time.return_value, poll_replicas.return_value = polls[1]
+        monitor.poll()
+        # 50 docs in 10s, 50 to go
+        assert monitor.interval == 5
+        assert monitor.get_eta('node2') == 10
+        assert monitor.get_eta('node1') == 0
+
+        poll_time, poll_replicas.return_value = polls[2]
+        for i in range(4):
+            time.return_value = poll_time + i
+            monitor.poll()
+        # no progress: back off up to max_interval
+        assert monitor.interval == 40
+        assert monitor.get_eta('node2') is None
+
+
+def test_failure_simulator():
+    simulator = FailureSimulator([
+        ('db1', 'shard1', ['node1', 'node2', 'node3'], 100),
+        ('db1', 'shard2', ['node2', 'node3', 'node4'], 100),
+        ('db2', 'shard1', ['node1', 'node2', 'node3'], 10),
+        ('db3', 'shard1', ['node4'], 5),
+    ])
+    assert simulator.simulate(['node4']) == ScenarioResult(('node4',), 1, 1, 2, 105)
+    assert simulator.simulate(['node2', 'node3'], include_ranges=True) == ScenarioResult(
+        ('node2', 'node3'), [], [('db1', 'shard1'), ('db1', 'shard2'), ('db2', 'shard1')],
+        [('db1', 'shard1'), ('db1', 'shard2'), ('db2', 'shard1')], 420)
+    assert simulator.simulate(['node1', 'node2', 'node3']).unavailable_ranges == 2
+    # unknown nodes hold nothing
+    assert simulator.simulate(['node5']) == ScenarioResult(('node5',), 0, 0, 0, 0)
+    pairs = list(simulator.sweep(2))
+    assert len(pairs) == 6
+    assert max(pairs, key=lambda result: result.rereplication_bytes).failed_nodes == ('node2', 'node3')
+
+
+def test_split_shard():
+    assert split_shard('00000000-ffffffff') == ['00000000-7fffffff', '80000000-ffffffff']
+    assert split_shard_to_depth('80000000-ffffffff', 2) == [
+        '80000000-9fffffff', 'a0000000-bfffffff', 'c0000000-dfffffff', 'e0000000-ffffffff']
+
+
+def test_shard_index():
+    index = ShardIndex(
+        [(30, ('80000000-ffffffff', 'b')), (10, ('00000000-7fffffff', 'b')), (20, ('00000000-7fffffff', 'a'))],
+        n_nodes=2,
+        existing_allocation=[{('00000000-7fffffff', 'b'), ('80000000-ffffffff', 'b')}, {('00000000-7fffffff', 'b')}],
+    )
+    # ids follow the names' sort order
+    assert index.shards == [('00000000-7fffffff', 'a'), ('00000000-7fffffff', 'b'), ('80000000-ffffffff', 'b')]
+    assert list(index.sizes) == [20, 10, 30]
+    assert [list(existing) for existing in index.existing] == [[0, 1, 1], [0, 1, 0]]
+    assert list(index.n_existing_copies) == [0, 2, 1]
+    assert index.get_node_allocations([_NodeAllocation(1, 50, [2, 0])]) == [
+        _NodeAllocation(1, 50, [('80000000-ffffffff', 'b'), ('00000000-7fffffff', 'a')])]
+
+
+def test_suggest_shard_allocation_with_capacities():
+    shard_sizes = [(100, ('{:08x}-{:08x}'.format(i, i), 'db')) for i in range(40)]
+    nodes = suggest_shard_allocation(shard_sizes, n_nodes=3, n_copies=2, capacities=[1, 1, 2])
+    # 8000 in all, filled 1:1:2 to within a shard
+    assert [node.size for node in nodes] == [2100, 2000, 3900]
+    assert all(len(set(node.shards)) == len(node.shards) for node in nodes)
+    # the same as leaving capacities out when they're all equal
+    assert suggest_shard_allocation(shard_sizes, n_nodes=3, n_copies=2, capacities=[5, 5, 5]) == \
+        suggest_shard_allocation(shard_sizes, n_nodes=3, n_copies=2)
+
+    config = Config(aliases={'couchdb@1': 'couch1', 'couchdb@2': 'couch2'}, capacities={'couch1': 2000})
+    assert Config().get_capacities(['couchdb@1']) is None
+    assert config.get_capacities(['couchdb@1']) == [2000]
+    try:
+        config.get_capacities(['couchdb@1', 'couchdb@2'])
+    except Exception as e:
+        assert 'couch2' in str(e)
+    else:
+        assert False, 'expected an exception'
+
+
+def test_search_shard_allocation():
+    rand = random.Random(0)
+    shard_sizes = [(int(rand.lognormvariate(0, 1.5) * 1000), ('{:08x}'.format(i), 'db{}'.format(db)))
+                   for db in range(20) for i in range(8)]
+    existing_allocation = [set() for _ in range(5)]
+    for _, shard in shard_sizes:
+        for i in rand.sample(range(4), 3):
+            existing_allocation[i].add(shard)
+
+    problem = _Problem(shard_sizes, 5, 3, existing_allocation)
+    greedy = problem.make_allocator().allocate()
+    greedy_score = problem.get_score(problem.get_excess([node.size for node in greedy]),
+                                     problem.get_moved([set(node.shards) for node in greedy]))
+
+    result = search_shard_allocation(shard_sizes, 5, 3, existing_allocation, time_budget=60, max_starts=4, workers=2)
+    assert result.n_starts == 4
+    assert result.score < greedy_score
+    for _, shard in shard_sizes:
+        nodes = [node.i for node in result.nodes if shard in node.shards]
+        assert len(nodes) == len(set(nodes)) == 3
+        assert len([i for i in nodes if shard in existing_allocation[i]]) >= 2
+    # the best start is picked the same way however many processes there are
+    assert search_shard_allocation(
+        shard_sizes, 5, 3, existing_allocation, time_budget=60, max_starts=4, workers=1).nodes == result.nodes
+
+
+def test_plan_splits():
+    def _doc(db_name, by_range):
+        return ShardAllocationDoc.from_plan_json(db_name, {'shard_suffix': '.1', 'by_range': by_range})
+
+    nodes = ['node1', 'node2', 'node3', 'node4']
+    db_info = [
+        # one big database with two ranges of 400 each
+        ('big', 800, {}, ['00000000-7fffffff', '80000000-ffffffff'], _doc('big', {
+            '00000000-7fffffff': nodes[:2], '80000000-ffffffff': nodes[2:]})),
+        ('small', 40, {'views': 40}, ['00000000-ffffffff'], _doc('small', {'00000000-ffffffff': nodes[:2]})),
+    ]
+    # (400 * 4 + 80 * 2) / 4 nodes = 440 per node; a quarter of that is 110
+    splits = plan_splits(db_info, max_node_fraction=0.25)
+    assert [(split.db_name, split.shard, split.depth) for split in splits] == [
+        ('big', '00000000-7fffffff', 2), ('big', '80000000-ffffffff', 2)]
+    assert plan_splits(db_info, target_shard_size=50, max_node_fraction=0.25)[-1][:4] == (
+        'small', '00000000-ffffffff', 80, 1)
+
+    shard_sizes = [(400, ('00000000-7fffffff', 'big')), (80, ('00000000-ffffffff', 'small'))]
+    assert get_split_shard_sizes(shard_sizes, splits) == [
+        (100, ('00000000-1fffffff', 'big')), (100, ('20000000-3fffffff', 'big')),
+        (100, ('40000000-5fffffff', 'big')), (100, ('60000000-7fffffff', 'big')),
+        (80, ('00000000-ffffffff', 'small')),
+    ]
+
+
+def test_plan_cost():
+    def _doc(db_name, by_range):
+        return ShardAllocationDoc.from_plan_json(db_name, {'shard_suffix': '.1', 'by_range': by_range})
+
+    db_info = [
+        ('a', 300, {'views': 100}, ['00000000-7fffffff', '80000000-ffffffff'], _doc('a', {
+            '00000000-7fffffff': ['node1', 'node2'], '80000000-ffffffff': ['node1', 'node2']})),
+        ('b', 50, {}, ['00000000-ffffffff'], _doc('b', {'00000000-ffffffff': ['node2', 'node1']})),
+    ]
+    assert get_allocation_changes(db_info[0][4].by_range, {'00000000-7fffffff': ['node1', 'node3']}) == (
+        {('node3', '00000000-7fffffff')},
+        {('node2', '00000000-7fffffff'), ('node1', '80000000-ffffffff'), ('node2', '80000000-ffffffff')})
+
+    index = AllocationIndex(db_info)
+    plan_cost = index.get_cost({
+        'a': _doc('a', {'00000000-7fffffff': ['node2', 'node3'], '80000000-ffffffff': ['node1', 'node2']}),
+        'b': _doc('b', {'00000000-ffffffff': ['node3', 'node1']}),
+        'new': _doc('new', {'00000000-ffffffff': ['node3']}),
+    })
+    assert plan_cost.added_by_node == {'node3': 250}
+    assert plan_cost.removed_by_node == {'node1': 200, 'node2': 50}
+    # each range is sent from the first node holding it
+    assert plan_cost.sent_by_node == {'node1': 200, 'node2': 50}
+    assert plan_cost.added_by_db == {'a': 200, 'b': 50, 'new': 0}
+    assert plan_cost.peak_by_node == {'node1': 450, 'node2': 450, 'node3': 250}
+    assert plan_cost.final_by_node == {'node1': 250, 'node2': 400, 'node3': 250}
+    assert get_transfer_seconds(plan_cost, 50) == 5
+
+
+def test_plan_waves():
+    def _doc(db_name, by_range):
+        return ShardAllocationDoc.from_plan_json(db_name, {'shard_suffix': '.1', 'by_range': by_range})
+
+    db_info = [
+        ('a', 300, {'views': 100}, ['00000000-7fffffff', '80000000-ffffffff'], _doc('a', {
+            '00000000-7fffffff': ['node1', 'node2'], '80000000-ffffffff': ['node1', 'node2']})),
+        ('b', 50, {}, ['00000000-ffffffff'], _doc('b', {'00000000-ffffffff': ['node1', 'node2']})),
+        ('c', 200, {}, ['00000000-ffffffff'], _doc('c', {'00000000-ffffffff': ['node2', 'node3']})),
+    ]
+    # a and b move from node1 to node3, and c the other way
+    plan = {
+        'a': _doc('a', {'00000000-7fffffff': ['node2', 'node3'], '80000000-ffffffff': ['node2', 'node3']}),
+        'b': _doc('b', {'00000000-ffffffff': ['node2', 'node3']}),
+        'c': _doc('c', {'00000000-ffffffff': ['node1', 'node2']}),
+    }
+    moves = get_range_moves(db_info, plan)
+    assert [(move.db_name, move.shard, move.size) for move in moves] == [
+        ('a', '00000000-7fffffff', 200), ('a', '80000000-ffffffff', 200), ('b', '00000000-ffffffff', 50),
+        ('c', '00000000-ffffffff', 200)]
+
+    assert [len(stage) for stage in plan_waves(moves)] == [4]
+    assert [len(stage) for stage in plan_waves(moves, max_bytes_in_flight=450)] == [3, 1]
+    # node3 only has room for one of a's ranges until c's copy is pruned from it
+    stages = plan_waves(moves, {'node3': 300}, headroom=50)
+    assert [[(move.db_name, move.shard) for move in stage] for stage in stages] == [
+        [('a', '00000000-7fffffff'), ('c', '00000000-ffffffff'), ('b', '00000000-ffffffff')],
+        [('a', '80000000-ffffffff')]]
+    try:
+        plan_waves(moves, {'node3': 150})
+    except WavePlanningError as e:
+        assert 'a 80000000-ffffffff' in str(e)
+    else:
+        assert False, 'expected WavePlanningError'
+
+    stage_plans = get_stage_plans(db_info, stages)
+    assert sorted(stage_plans[0]) == ['a', 'b', 'c']
+    assert stage_plans[0]['a'].by_range == {
+        '00000000-7fffffff': ['node2', 'node3'], '80000000-ffffffff': ['node1', 'node2']}
+    assert list(stage_plans[1]) == ['a']
+    assert stage_plans[1]['a'].by_range == plan['a'].by_range
+    assert stage_plans[1]['a'].shard_suffix == db_info[0][4].shard_suffix
+
+
+def test_classify_endpoint():
+    assert classify_endpoint('_node/_local/_dbs/mydb') == '_dbs'
+    assert classify_endpoint('_all_dbs') == '_all_dbs'
+    assert classify_endpoint('mydb') == 'db info'
+    assert classify_endpoint('/mydb/_design/views/_info') == '_design/*/_info'
+    assert classify_endpoint('/mydb/_all_docs?startkey="_design%2F"') == 'db _all_docs'
+
+
+def test_profiler():
+    profiler = Profiler(trace_memory=True)
+    add_instrument(profiler)
+    try:
+        suggest_shard_allocation([(10, ('00000000-ffffffff', 'db1'))], n_nodes=2, n_copies=1)
+        record_request('GET', '_all_dbs', 0.02, bytes_received=100)
+        record_request('GET', 'mydb', 0.3, error=Exception())
+    finally:
+        remove_instrument(profiler)
+        tracemalloc.stop()
+    profile = profiler.to_json()
+    assert profile['endpoints']['_all_dbs']['bytes_received'] == 100
+    assert profile['endpoints']['_all_dbs']['latency_histogram']['0.025'] == 1
+    assert profile['endpoints']['db info']['errors'] == 1
+    assert set(profile['phases']) == {'allocator.distribute', 'allocator.rebalance'}
+    assert profile['phases']['allocator.distribute']['memory_peak'] is not None
+    assert 'couchdb_cluster_admin_request_duration_seconds_bucket{endpoint="_all_dbs",le="+Inf"} 1' \
+        in profiler.to_prometheus()
+
+
+@patch('couchdb_cluster_admin.suggest_shard_allocation.iter_db_pages', return_value=iter([['db1', 'db2']]))
+@patch('couchdb_cluster_admin.cluster_state.get_dbs_metadata',
+       return_value={'db1': {'sizes': {'file': 10}}, 'db2': {'sizes': {'file': 10}}})
+@patch('couchdb_cluster_admin.suggest_shard_allocation.get_views_list', return_value=['views'])
+@patch('couchdb_cluster_admin.suggest_shard_allocation.get_view_signature_and_size', return_value=('abc', 5))
+@patch('couchdb_cluster_admin.cluster_state.get_db_docs', return_value={
+    db_name: ShardAllocationDoc.from_plan_json(
+        db_name, {'shard_suffix': '.1', 'by_range': {'00000000-ffffffff': ['node1']}}).to_json()
+    for db_name in ['db1', 'db2']
+})
+def test_get_db_info_phases(*mocks):
+    config = Config(control_node_ip='10.0.0.1')
+    config.set_password(None)
+    profiler = Profiler(trace_memory=True)
+    add_instrument(profiler)
+    try:
+        db_info = get_db_info(config)
+    finally:
+        remove_instrument(profiler)
+        tracemalloc.stop()
+    assert [(db_name, size, view_sizes, shards) for db_name, size, view_sizes, shards, _ in db_info] == [
+        ('db1', 10, {'views': 5}, ['00000000-ffffffff']),
+        ('db2', 10, {'views': 5}, ['00000000-ffffffff']),
+    ]
+    phases = profiler.to_json()['phases']
+    assert set(phases) == {'get_db_info.crawl', 'get_db_info.list_dbs', 'get_db_info.sizes',
+                           'get_db_info.shard_maps', 'get_db_info.views'}
+    assert all(stats['count'] == 1 and stats['memory_peak'] is not None for stats in phases.values())
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body
+        self.request = requests.Request('GET', 'http://localhost/').prepare()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(response=self)
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def test_retry_idempotent_requests():
+    node_details = NodeDetails('10.0.0.9', 15984, 15986, '2.3.1', None, None, None)
+    responses = [_FakeResponse(503, b'{}'), _FakeResponse(500, b'{}'), _FakeResponse(200, b'["db1"]')]
+    set_retry_policy(RetryPolicy(max_retries=2, backoff=0))
+    try:
+        with patch('requests.request', side_effect=lambda **kwargs: responses.pop(0)):
+            assert do_couch_request(node_details, '_all_dbs') == ['db1']
+
+        responses = [_FakeResponse(503, b'{}'), _FakeResponse(200, b'{}')]
+        with patch('requests.request', side_effect=lambda **kwargs: responses.pop(0)):
+            try:
+                do_couch_request(node_details, '_dbs/db1', method='put', json={})
+            except Exception as e:
+                assert e.response.status_code == 503
+            else:
+                assert False, 'PUT should not have been retried'
+    finally:
+        set_retry_policy(RetryPolicy())
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10)
+    breaker.on_failure()
+    assert breaker.is_closed
+    breaker.on_failure()
+    assert not breaker.is_closed
+
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        breaker.open_until -= seconds
+
+    with patch('time.sleep', side_effect=fake_sleep):
+        probe = breaker.before_request()
+    assert probe is not None
+    assert 9 < sum(sleeps) <= 10
+    breaker.on_failure()
+    assert breaker.cooldown == 20
+    breaker.on_success()
+    assert breaker.is_closed and breaker.cooldown == 10
+
+
+def test_interrupted_probe_is_released():
+    set_retry_policy(RetryPolicy(max_retries=0))
+    node_details = NodeDetails('10.0.0.9', 15984, 15986, '2.3.1', None, None, None)
+    breaker = get_circuit_breaker('10.0.0.9', 15984)
+    breaker.failures = breaker.failure_threshold
+    breaker.open_until = 0
+    try:
+        with patch('requests.request', side_effect=KeyboardInterrupt):
+            try:
+                do_couch_request(node_details, '')
+            except KeyboardInterrupt:
+                pass
+        # the next request gets to probe instead of waiting forever
+        with patch('requests.request', return_value=_FakeResponse(200, b'{}')):
+            assert do_couch_request(node_details, '') == {}
+        assert breaker.is_closed
+    finally:
+        set_retry_policy(RetryPolicy())
+
+
+def test_async_client_must_be_opened():
+    node_details = NodeDetails('127.0.0.1', 15984, 15986, '3.1.1', None, None, None)
+    try:
+        asyncio.run(AsyncClient(node_details).get_membership())
+    except RuntimeError as e:
+        assert 'async with' in str(e)
+    else:
+        assert False, 'expected RuntimeError'
+
+
+def test_read_balancer():
+    control_node, *other_nodes = nodes = [
+        NodeDetails('10.0.3.{}'.format(i), 15984, 15986, '3.1.1', None, None, None) for i in range(1, 4)]
+    read_balancer = ReadBalancer(control_node, nodes)
+    get_circuit_breaker('10.0.3.3', 15984).open_until = float('inf')
+    requests_by_ip = []
+
+    def fake_request(node_details, path, port, method='get', params=None, json=None):
+        requests_by_ip.append((node_details.ip, method))
+        return {}
+
+    other_cluster_nodes = [
+        NodeDetails('10.0.4.{}'.format(i), 15984, 15986, '3.1.1', None, None, None) for i in range(1, 3)]
+    set_read_balancer(control_node, read_balancer)
+    set_read_balancer(other_cluster_nodes[0], ReadBalancer(other_cluster_nodes[0], other_cluster_nodes))
+    try:
+        with patch('couchdb_cluster_admin.utils._do_request', side_effect=fake_request):
+            with read_balancer.acquire() as busy_node:
+                assert busy_node == control_node
+                # the control node has a request in flight and 10.0.3.3's breaker is open
+                do_couch_request(control_node, 'mydb')
+                do_couch_request(control_node, '_dbs_info', method='post', json={'keys': []})
+                # checking a connection checks the node it was given
+                check_connection(control_node)
+            do_couch_request(control_node, 'mydb')
+            # writes and requests meant for another node aren't moved
+            do_couch_request(control_node, 'mydb', method='put')
+            do_couch_request(other_nodes[1], 'mydb')
+            # another cluster's reads are spread over its own nodes
+            do_couch_request(other_cluster_nodes[0], 'mydb')
+    finally:
+        set_read_balancer(control_node, None)
+        set_read_balancer(other_cluster_nodes[0], None)
+        get_circuit_breaker('10.0.3.3', 15984).on_success()
+    assert requests_by_ip == [
+        ('10.0.3.2', 'get'), ('10.0.3.2', 'post'), ('10.0.3.1', 'get'), ('10.0.3.1', 'get'), ('10.0.3.1', 'put'),
+        ('10.0.3.3', 'get'), ('10.0.4.1', 'get'),
+    ]
+    assert set(read_balancer.get_outstanding().values()) == {0}
+
+
+def test_iter_db_list_pages():
+    node_details = NodeDetails('10.0.0.1', 15984, 15986, '2.3.1', None, None, None)
+    all_dbs = ['db{:02d}'.format(i) for i in range(25)]
+    requested_params = []
+
+    def fake_request(node_details, path, method='get', params=None, json=None):
+        requested_params.append(params)
+        start = 0
+        if 'start_key' in params:
+            start = all_dbs.index(params['start_key'].strip('"')) + params['skip']
+        return all_dbs[start:start + params['limit']]
+
+    with patch('couchdb_cluster_admin.utils.do_couch_request', side_effect=fake_request):
+        assert list(iter_db_list(node_details, page_size=10)) == all_dbs
+    assert requested_params == [
+        {'limit': 10},
+        {'limit': 10, 'start_key': '"db09"', 'skip': 1},
+        {'limit': 10, 'start_key': '"db19"', 'skip': 1},
+    ]
+
+
+def test_iter_db_pages_when_consumer_yields():
+    import gevent
+    with FakeCluster(n_nodes=1, n_dbs=25, latency=0.002) as cluster:
+        pages = []
+        for page in iter_db_pages(cluster.get_config().get_control_node(), page_size=10):
+            pages.append(page)
+            # long enough for the next page to have been fetched already
+            gevent.sleep(0.05)
+    assert [len(page) for page in pages] == [10, 10, 5]
+
+
+def test_async_client_get_db_info():
+    probes = []
+
+    async def all_dbs(request):
+        return web.json_response(['db{}'.format(i) for i in range(1, 31)])
+
+    async def db_doc(request):
+        db_name = request.match_info['db_name']
+        return web.json_response({'_id': db_name, 'shard_suffix': [46, 49], 'by_node': {'node1': ['shard1']},
+                                  'by_range': {'shard1': ['node1']}, 'changelog': []})
+
+    async def db_info(request):
+        return web.json_response({'sizes': {'file': 1000}})
+
+    async def all_docs(request):
+        assert request.query['startkey'] == '"_design/"'
+        return web.json_response({'rows': [{'id': '_design/views'}]})
+
+    async def view_info(request):
+        return web.json_response({'view_index': {'signature': 'abc', 'sizes': {'file': 50}}})
+
+    async def welcome(request):
+        probes.append(request.path)
+        return web.json_response({'couchdb': 'Welcome', 'version': '3.1.1', 'features': []})
+
+    async def dbs(request):
+        probes.append(request.path)
+        return web.json_response({'db_name': '_dbs'})
+
+    async def bulk_docs(request):
+        probes.append(request.path)
+        return web.json_response({'error': 'method_not_allowed'}, status=405)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/', welcome)
+        app.router.add_get('/_all_dbs', all_dbs)
+        app.router.add_get('/_node/_local/_dbs', dbs)
+        app.router.add_get('/_node/_local/_dbs/_bulk_docs', bulk_docs)
+        app.router.add_get('/_node/_local/_dbs/{db_name}', db_doc)
+        app.router.add_get('/{db_name}', db_info)
+        app.router.add_get('/{db_name}/_all_docs', all_docs)
+        app.router.add_get('/{db_name}/_design/{view_name}/_info', view_info)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            node_details = NodeDetails('127.0.0.1', port, port, '3.1.1', None, None, None)
+            async with AsyncClient(node_details, concurrency=4) as client:
+                return await client.get_db_info()
+        finally:
+            await runner.cleanup()
+
+    db_info = asyncio.run(run())
+    assert len(db_info) == 30
+    assert [(db_name, size, view_sizes, shards) for db_name, size, view_sizes, shards, _ in db_info[:2]] == [
+        ('db1', 1000, {'views': 50}, ['shard1']),
+        ('db2', 1000, {'views': 50}, ['shard1']),
+    ]
+    # the node is probed once, not by every task that needs its shard map
+    assert probes == ['/', '/_node/_local/_dbs', '/_node/_local/_dbs/_bulk_docs']
+
+
+def test_cli_help_starts_without_heavy_imports():
+    # timings are left to benchmarks/startup.py; this only checks what gets imported
+    script = (
+        'import sys\n'
+        'from couchdb_cluster_admin.cli import main\n'
+        'try:\n'
+        '    main(sys.argv[1:])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'heavy = [name for name in ("requests", "gevent", "yaml", "distutils", "aiohttp", "jsonobject", "memoized")\n'
+        '         if name in sys.modules]\n'
+        'sys.stderr.write(",".join(heavy))\n'
+    )
+    for argv in [['--help']] + [[command.name, '--help'] for command in COMMANDS]:
+        result = subprocess.run([sys.executable, '-c', script] + argv, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, check=True, universal_newlines=True)
+        assert result.stderr == '', (argv, result.stderr)
+
+
+def test_detect_capabilities_only_reads():
+    requests_made = []
+
+    def fake_request(node_details, path, port, method='get', params=None, json=None):
+        requests_made.append((method, path, port))
+        if path == '':
+            return {'couchdb': 'Welcome', 'version': '2.3.1', 'features': ['scheduler']}
+        if path == '_node/_local/_dbs':
+            raise requests.HTTPError(response=_FakeResponse(404, b'{}'))
+        if path == '_dbs/_bulk_docs':
+            raise requests.HTTPError(response=_FakeResponse(405, b'{}'))
+        raise AssertionError(path)
+
+    node_details = NodeDetails('10.0.0.1', 15984, 15986, '3.1.1', None, None, None)
+    with patch('couchdb_cluster_admin.utils._do_request', side_effect=fake_request), \
+            patch('sys.stderr') as stderr:
+        capabilities = _detect_capabilities(node_details)
+    assert capabilities == Capabilities(version='2.3.1', features=['scheduler'], node_local_api=False,
+                                        dbs_info=True, dbs_bulk_docs=True)
+    assert all(method == 'get' for method, _, _ in requests_made)
+    assert ('get', '_dbs/_bulk_docs', 15986) in requests_made
+    # the configured version was wrong
+    assert '2.3.1' in stderr.write.call_args[0][0]
+    assert get_node_local_path_and_port(node_details, '_dbs/mydb', capabilities) == ('_dbs/mydb', 15986)
+
+
+@patch('couchdb_cluster_admin.utils.get_capabilities',
+       return_value=make_capabilities({'version': '3.1.1'}, node_local_api=True, dbs_bulk_docs=True))
+def test_get_dbs_metadata_in_batches(m1):
+    node_details = NodeDetails('10.0.0.1', 15984, 15986, None, None, None, None)
+    batches = []
+
+    def fake_request(node_details, path, method='get', params=None, json=None):
+        assert (method, path) == ('post', '_dbs_info')
+        batches.append(json['keys'])
+        return [{'key': key, 'info': {'sizes': {'file': 1}}} if key != 'missing' else {'key': key, 'error': 'not_found'}
+                for key in json['keys']]
+
+    db_names = ['db{}'.format(i) for i in range(150)] + ['missing']
+    with patch('couchdb_cluster_admin.utils.do_couch_request', side_effect=fake_request):
+        metadata = get_dbs_metadata(node_details, db_names)
+    assert [len(batch) for batch in batches] == [100, 51]
+    assert len(metadata) == 150 and 'missing' not in metadata
+
+
+def test_fake_cluster_crawl():
+    for couchdb_version in ['2.3.1', '3.1.1']:
+        with FakeCluster(n_nodes=3, n_dbs=30, q=4, couchdb_version=couchdb_version) as cluster:
+            cluster.add_db('big', size=10 ** 9, views={'a': 100, 'b': 200})
+            config = cluster.get_config()
+            db_info = get_db_info(config)
+            assert len(db_info) == 31
+            db_name, size, view_sizes, shards, shard_allocation_doc = db_info[0]
+            assert (db_name, size, view_sizes, len(shards)) == ('big', 10 ** 9, {'a': 100, 'b': 200}, 4)
+            assert sorted(shard_allocation_doc.get_node_list()) == cluster.nodes
+            assert get_membership(config).cluster_nodes == cluster.nodes
+            assert cluster.in_flight == 0 and cluster.request_count > 0
+
+
+def test_fake_cluster_writes_and_errors():
+    set_retry_policy(RetryPolicy(max_retries=10, backoff=0))
+    try:
+        with FakeCluster(n_nodes=2, n_dbs=5, error_rate=0.1, seed=1) as cluster:
+            node_details = cluster.get_config().get_control_node()
+            docs = get_db_docs(node_details, ['db-0000001', 'db-0000002', 'missing'])
+            assert sorted(docs) == ['db-0000001', 'db-0000002']
+            docs['db-0000001']['by_range'] = {'00000000-ffffffff': [cluster.nodes[0]]}
+            results = bulk_put_db_docs(node_details, list(docs.values()) + [dict(docs['db-0000002'], _rev='9-x')])
+            assert [result.get('ok', result.get('error')) for result in results] == [True, True, 'conflict']
+            assert get_db_docs(node_details, ['db-0000001'])['db-0000001']['by_range'] == {
+                '00000000-ffffffff': [cluster.nodes[0]]}
+            assert get_db_list(node_details) == ['db-000000{}'.format(i) for i in range(5)]
+    finally:
+        set_retry_policy(RetryPolicy())
+
+
+def test_find_regressions():
+    baseline = {'requests': 100, 'wall_seconds': 2.0}
+    assert find_regressions({'requests': 100, 'wall_seconds': 2.9}, baseline, tolerance=0.5) == []
+    assert find_regressions({'requests': 90, 'wall_seconds': 1.0}, baseline, tolerance=0.5) == []
+    assert find_regressions({'requests': 101, 'wall_seconds': 3.1}, baseline, tolerance=0.5) == [
+        'requests 101 > 100', 'wall time 3.10s > 2.00s']
+
+
+def test_compact_before_moving():
+    with FakeCluster(n_nodes=3, n=2, q=2) as cluster:
+        cluster.add_db('big', size=1000, active_size=400, by_range={
+            '00000000-7fffffff': cluster.nodes[:2], '80000000-ffffffff': cluster.nodes[1:]})
+        cluster.add_db('small', size=100, by_range={'00000000-ffffffff': cluster.nodes[:2]})
+        config = cluster.get_config()
+        assert [size for _, size, _, _, _ in get_db_info(config, size_metric='active')] == [400, 100]
+        # only big's first range gets a new copy, copied from its first node
+        plan = {
+            'big': ShardAllocationDoc.from_plan_json('big', {'shard_suffix': '', 'by_range': {
+                '00000000-7fffffff': cluster.nodes[1:], '80000000-ffffffff': cluster.nodes[1:]}}),
+            'small': ShardAllocationDoc.from_plan_json('small', {'shard_suffix': '', 'by_range': {
+                '00000000-ffffffff': cluster.nodes[:2]}}),
+        }
+        shard_copies = get_copies_to_compact(config, plan)
+        assert [(shard_copy.db_name, shard_copy.shard, shard_copy.node) for shard_copy in shard_copies] == [
+            ('big', '00000000-7fffffff', cluster.nodes[0])]
+        sizes, = get_all_shard_copy_sizes(config, shard_copies)
+        assert (sizes.file, sizes.active, get_reclaimable(sizes)) == (500, 200, 300)
+
+        CompactionOrchestrator(config, poll_interval=0).run(shard_copies)
+        sizes, = get_all_shard_copy_sizes(config, shard_copies)
+        assert get_reclaimable(sizes) == 0
+
+
+def test_crawl_fleet():
+    assert get_imbalance({'node1': 100, 'node2': 300}) == 0.5
+    assert get_imbalance({}) == 0
+    # a node with three times the capacity holding three times as much is even
+    assert get_imbalance({'node1': 100, 'node2': 300}, {'node1': 2, 'node2': 6}) == 0
+    assert get_imbalance({'node1': 200, 'node2': 200}, {'node1': 2, 'node2': 6}) == 1
+    config = Config(control_node_ip='10.0.0.1', aliases={'couchdb@10.0.0.1': 'node1', 'couchdb@10.0.0.2': 'node2'},
+                    capacities={'node1': 2, 'node2': 6})
+    assert get_capacity_by_node(config, ['couchdb@10.0.0.1', 'couchdb@10.0.0.2']) == {
+        'couchdb@10.0.0.1': 2, 'couchdb@10.0.0.2': 6}
+    set_retry_policy(RetryPolicy(max_retries=0))
+    try:
+        with FakeCluster(n_nodes=2, n_dbs=150, n=1, q=2) as small, FakeCluster(n_nodes=3, n_dbs=40) as big:
+            small.add_db('lopsided', size=10 ** 6, by_range={
+                '00000000-7fffffff': [small.nodes[0]], '80000000-ffffffff': [small.nodes[0]]})
+            unreachable = Config(control_node_ip='127.0.0.1', control_node_port=1, control_node_local_port=1)
+            unreachable.set_password(None)
+            summaries = crawl_fleet([('small', small.get_config()), ('big', big.get_config()),
+                                     ('unreachable', unreachable)], concurrency=2)
+            assert [(summary.name, summary.n_dbs, len(summary.size_by_node)) for summary in summaries[:2]] == [
+                ('small', 151, 2), ('big', 40, 3)]
+            assert summaries[0].size == sum(summaries[0].size_by_node.values())
+            assert get_imbalance(summaries[0].size_by_node) > get_imbalance(summaries[1].size_by_node)
+            assert summaries[2].error is not None and summaries[2].n_dbs is None
+    finally:
+        set_retry_policy(RetryPolicy())
+
+
+def test_shard_map_watcher():
+    with FakeCluster(n_nodes=2, n_dbs=20, q=2) as cluster:
+        config = cluster.get_config()
+        watcher = ShardMapWatcher(config, timeout=0.1)
+        assert len(watcher.load()) == 20
+        assert watcher.poll() == ([], [])
+
+        db_name, untouched_db_name = [doc.db_name for doc in watcher.get_shard_allocation_docs()[:2]]
+        docs = get_db_docs(config.get_control_node(), [db_name, untouched_db_name])
+        doc = docs[db_name]
+        doc['by_range'] = {shard: [cluster.nodes[1]] for shard in doc['by_range']}
+        # saved again as it was, so its row shouldn't be printed again
+        bulk_put_db_docs(config.get_control_node(), [doc, docs[untouched_db_name]])
+        cluster.add_db('new_db')
+        changed, deleted = watcher.poll()
+        assert [shard_allocation_doc.db_name for shard_allocation_doc in changed] == [db_name, 'new_db']
+        assert changed[0].by_range == doc['by_range']
+        assert deleted == []
+        assert len(watcher.get_shard_allocation_docs()) == 21
+
+
+def test_parse_version():
+    assert parse_version('2.3.1') < parse_version('3.0.0') <= parse_version('3.0') < parse_version('3.10.0-rc1')